@@ -0,0 +1,450 @@
+"""
+Aggregator mode: federate several collector Pis behind one API
+
+Every collector's api.py serves /sync/readings, an incremental feed of its
+usage table keyed by rowid. An aggregator is an api.py whose data directory
+holds a nodes.json listing the collectors:
+
+    {
+        "interval": 10,
+        "nodes": [
+            {"id": "garage", "url": "http://192.168.1.21:8000"},
+            {"id": "kitchen", "url": "http://192.168.1.22:8000"}
+        ]
+    }
+
+It pulls every node concurrently, page by page from the last saved rowid
+cursor, into its own energy_data.db. Each (node, remote appliance id) pair
+gets an appliance id of its own in the node_appliances table, taken from
+the registry's reserved range (appliances.reserve()) so it never merges
+with one of the aggregator's own appliances. It is registered as
+"node/appliance" in the appliances table, so every existing endpoint
+(history, rollups, consumption, streaming) answers across all nodes
+unchanged. A node's disaggregated appliances keep the "nilm" source, so
+site totals leave them out here as they do on the node.
+
+A page's readings, their rollups and energy totals and the node's new
+cursor are committed in one transaction, so an interrupted pull never
+stores a row twice or skips one.
+
+For testing without the hardware, run stand-in collectors that serve
+/sync/readings from any database, optionally writing synthetic readings:
+
+    python3 aggregator.py collector --db /tmp/garage.db --port 8101 --simulate 3
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import appliances
+import metrics
+from appliances import register as register_appliance
+from consumption import ConsumptionMaintainer, load_tariff
+from disaggregate import VIRTUAL_SOURCE
+from db_writer import INSERT_SQL, TIMESTAMP_FORMAT, BufferedWriter, configure_connection
+from migrate_database import run_migrations
+from rollups import RollupMaintainer
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+NODES_PATH = SCRIPT_DIR / "nodes.json"
+
+DEFAULT_PULL_INTERVAL = 10.0  # Seconds between pull rounds once every node is caught up
+DEFAULT_PAGE_SIZE = 5000      # Rows per /sync/readings request and per commit
+MAX_PAGE_SIZE = 50000
+DEFAULT_TIMEOUT = 10.0        # Seconds per HTTP request to a node
+
+SYNC_SQL = '''
+    SELECT usage.rowid, ts, watts, appliance_id, COALESCE(appliances.name, appliance_name), appliances.source
+    FROM usage LEFT JOIN appliances ON appliances.id = usage.appliance_id
+    WHERE usage.rowid > ? ORDER BY usage.rowid LIMIT ?
+'''
+
+MAX_ROWID_SQL = "SELECT MAX(rowid) FROM usage"
+
+CURSOR_UPSERT_SQL = '''
+    INSERT INTO node_cursors (node_id, cursor, rows, last_sync) VALUES (?, ?, ?, ?)
+    ON CONFLICT (node_id) DO UPDATE SET
+        cursor = excluded.cursor,
+        rows = rows + excluded.rows,
+        last_sync = excluded.last_sync
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def create_tables(conn):
+    """Appliance id mapping and pull cursor per collector node"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS node_appliances (
+        appliance_id INTEGER PRIMARY KEY,
+        node_id TEXT NOT NULL,
+        remote_appliance_id INTEGER NOT NULL,
+        name TEXT,
+        source TEXT,
+        UNIQUE (node_id, remote_appliance_id)
+    )''')
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(node_appliances)")}
+    if "source" not in columns:  # Created before sync carried the appliance's source
+        conn.execute("ALTER TABLE node_appliances ADD COLUMN source TEXT")
+    conn.execute('''CREATE TABLE IF NOT EXISTS node_cursors (
+        node_id TEXT PRIMARY KEY,
+        cursor INTEGER NOT NULL,
+        rows INTEGER NOT NULL DEFAULT 0,
+        last_sync INTEGER
+    )''')
+
+
+def appliance_name(node_id, name):
+    """Name an aggregated appliance is stored under"""
+    return f"{node_id}/{name}"
+
+
+def sync_page(node_id, since, rows, max_rowid):
+    """Body of a /sync/readings response for rows fetched with SYNC_SQL"""
+    rows = [list(row) for row in rows]
+    next_cursor = rows[-1][0] if rows else since
+    return {
+        "node": node_id,
+        "since": since,
+        "next": next_cursor,
+        "max_rowid": max_rowid,
+        "more": next_cursor < max_rowid,
+        "rows": rows,
+    }
+
+
+def read_page(conn, node_id, since, limit=DEFAULT_PAGE_SIZE):
+    """sync_page() straight from a connection, used by the stand-in collector"""
+    rows = conn.execute(SYNC_SQL, (since, limit)).fetchall()
+    max_rowid = conn.execute(MAX_ROWID_SQL).fetchone()[0] or 0
+    return sync_page(node_id, since, rows, max_rowid)
+
+
+def http_fetch(url, since, limit, timeout=DEFAULT_TIMEOUT):
+    """One /sync/readings page from the node at url"""
+    query = urllib.parse.urlencode({"since": since, "limit": limit})
+    with urllib.request.urlopen(f"{url.rstrip('/')}/sync/readings?{query}", timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def load_nodes(path=NODES_PATH):
+    """(nodes {id: url}, settings) from a nodes.json file"""
+    with open(path) as f:
+        config = json.load(f)
+    nodes = {}
+    for node in config.get("nodes", []):
+        node_id, url = node.get("id"), node.get("url")
+        if not node_id or not url:
+            raise ValueError(f"Node entries need an id and a url: {node}")
+        if node_id in nodes:
+            raise ValueError(f"Duplicate node id: {node_id}")
+        nodes[node_id] = url
+    if not nodes:
+        raise ValueError(f"No nodes configured in {path}")
+    settings = {key: config[key] for key in ("interval", "page_size", "timeout") if key in config}
+    return nodes, settings
+
+
+class Aggregator:
+    """Pulls every node's new readings into one database
+
+    fetch(url, since, limit, timeout) returns one sync_page() dict; the
+    default requests it over HTTP. Pulls run concurrently in threads, while
+    all writes go through a single writer thread that owns the connection.
+    """
+
+    def __init__(self, db_path, nodes, interval=DEFAULT_PULL_INTERVAL, page_size=DEFAULT_PAGE_SIZE,
+                 timeout=DEFAULT_TIMEOUT, hooks=None, fetch=http_fetch):
+        self.db_path = Path(db_path)
+        self.nodes = dict(nodes)
+        self.interval = interval
+        self.page_size = page_size
+        self.timeout = timeout
+        if hooks is None:
+            hooks = [RollupMaintainer(), ConsumptionMaintainer(load_tariff())]
+        self.hooks = list(hooks)
+        self.fetch = fetch
+
+        self._conn = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aggregator")
+        self._appliances = {}  # (node id, remote appliance id) -> (appliance id, name, source)
+        self._nodes_by_id = {}  # appliance id -> (node id, remote appliance id, name)
+        self._task = None
+        self._status = {
+            node_id: {"cursor": 0, "rows": 0, "last_sync": None, "last_attempt": None,
+                      "lag_rows": None, "last_error": None}
+            for node_id in self.nodes
+        }
+
+    @classmethod
+    def from_config(cls, db_path, path=NODES_PATH, **kwargs):
+        nodes, settings = load_nodes(path)
+        settings.update(kwargs)
+        return cls(db_path, nodes, **settings)
+
+    def open(self):
+        """Create or migrate the aggregate database and load the saved cursors"""
+        conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        configure_connection(conn)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        run_migrations(conn)
+        with conn:
+            create_tables(conn)
+        self._conn = conn
+        self._load_appliances()
+        for node_id, cursor, rows, last_sync in conn.execute(
+            "SELECT node_id, cursor, rows, last_sync FROM node_cursors"
+        ):
+            if node_id in self._status:
+                self._status[node_id].update(cursor=cursor, rows=rows, last_sync=last_sync)
+
+    def _load_appliances(self):
+        self._appliances.clear()
+        self._nodes_by_id.clear()
+        for appliance_id, node_id, remote_id, name, source in self._conn.execute(
+            "SELECT appliance_id, node_id, remote_appliance_id, name, source FROM node_appliances"
+        ):
+            self._appliances[(node_id, remote_id)] = (appliance_id, name, source)
+            self._nodes_by_id[appliance_id] = (node_id, remote_id, name)
+
+    def _local_id(self, node_id, remote_id, name, source):
+        known = self._appliances.get((node_id, remote_id))
+        if known is not None and known[1:] == (name, source):
+            return known[0]
+        if known is None:
+            appliance_id = appliances.reserve(self._conn, f"node:{node_id}:{remote_id}")
+            self._conn.execute(
+                "INSERT INTO node_appliances (appliance_id, node_id, remote_appliance_id, name, source) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (appliance_id, node_id, remote_id, name, source)
+            )
+        else:
+            appliance_id = known[0]  # Renamed on the node
+            self._conn.execute(
+                "UPDATE node_appliances SET name = ?, source = ? WHERE appliance_id = ?",
+                (name, source, appliance_id)
+            )
+        # Estimates would count twice in whole-house totals next to the node's mains
+        local_source = VIRTUAL_SOURCE if source == VIRTUAL_SOURCE else f"node:{node_id}"
+        register_appliance(self._conn, appliance_id, appliance_name(node_id, name), source=local_source)
+        self._appliances[(node_id, remote_id)] = (appliance_id, name, source)
+        self._nodes_by_id[appliance_id] = (node_id, remote_id, name)
+        return appliance_id
+
+    def _store(self, node_id, page):
+        """Write one page and the node's new cursor in a single transaction"""
+        readings = []
+        try:
+            with self._conn:
+                for row in page["rows"]:
+                    _, ts, watts, remote_id, name = row[:5]
+                    source = row[5] if len(row) > 5 else None  # Collectors before source was synced
+                    appliance_id = self._local_id(node_id, remote_id, name, source)
+                    timestamp = time.strftime(TIMESTAMP_FORMAT, time.localtime(ts))
+                    readings.append((timestamp, ts, watts, appliance_id))
+                self._conn.executemany(INSERT_SQL, readings)
+                for hook in self.hooks:
+                    hook(self._conn, [(row[3], row[1], row[2]) for row in readings])
+                self._conn.execute(CURSOR_UPSERT_SQL, (node_id, page["next"], len(readings), int(time.time())))
+        except Exception:
+            self._load_appliances()  # Forget ids assigned in the rolled-back transaction
+            raise
+        return len(readings)
+
+    async def _write(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def sync_node(self, node_id):
+        """Pull node_id until caught up, returns the number of rows stored"""
+        status = self._status[node_id]
+        status["last_attempt"] = int(time.time())
+        stored = 0
+        try:
+            while True:
+                page = await asyncio.to_thread(
+                    self.fetch, self.nodes[node_id], status["cursor"], self.page_size, self.timeout
+                )
+                if page["max_rowid"] < status["cursor"]:
+                    raise RuntimeError(
+                        f"Cursor {status['cursor']} is past the node's newest row {page['max_rowid']}, "
+                        "was its database replaced?"
+                    )
+                if page["rows"]:
+                    count = await self._write(self._store, node_id, page)
+                    stored += count
+                    status["rows"] += count
+                status["cursor"] = page["next"]
+                status["lag_rows"] = page["max_rowid"] - page["next"]
+                if not page["more"] or not page["rows"]:
+                    break
+            status["last_sync"] = int(time.time())
+            status["last_error"] = None
+        except Exception as e:
+            status["last_error"] = str(e)
+            logger.warning(f"Pull from node {node_id} failed: {e}")
+        return stored
+
+    async def sync_all(self):
+        """One pull round over every node concurrently, returns rows stored per node"""
+        counts = await asyncio.gather(*(self.sync_node(node_id) for node_id in self.nodes))
+        return dict(zip(self.nodes, counts))
+
+    async def _run(self):
+        while True:
+            await self.sync_all()
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        """Open the database, then pull in the background every interval"""
+        await self._write(self.open)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Aggregating {len(self.nodes)} nodes into {self.db_path}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await self._write(self._conn.close)
+            self._conn = None
+        self._writer.shutdown(wait=True)
+
+    def node_of(self, appliance_id):
+        """(node id, remote appliance id, name) of an aggregated appliance, or None"""
+        return self._nodes_by_id.get(appliance_id)
+
+    def status(self):
+        """Cursor, lag and last error of every node"""
+        nodes = []
+        for node_id, url in self.nodes.items():
+            appliances = [
+                {"appliance_id": appliance_id, "remote_appliance_id": remote_id, "name": name,
+                 "source": self._appliances[(node, remote_id)][2]}
+                for appliance_id, (node, remote_id, name) in sorted(self._nodes_by_id.items())
+                if node == node_id
+            ]
+            nodes.append({"node": node_id, "url": url, **self._status[node_id], "appliances": appliances})
+        return nodes
+
+    def register_metrics(self, registry=metrics.REGISTRY):
+        """Rows pulled and rows still to pull per node"""
+        metrics.CallbackMetric(
+            "energy_aggregator_rows_pulled", "Readings stored from each collector node",
+            lambda: [((node_id,), s["rows"]) for node_id, s in self._status.items()],
+            type="counter", labelnames=["node"], registry=registry
+        )
+        metrics.CallbackMetric(
+            "energy_aggregator_lag_rows", "Rows a node had beyond the cursor at the last pull",
+            lambda: [((node_id,), s["lag_rows"] or 0) for node_id, s in self._status.items()],
+            labelnames=["node"], registry=registry
+        )
+        metrics.CallbackMetric(
+            "energy_aggregator_node_up", "1 if the last pull from a node succeeded",
+            lambda: [((node_id,), 0 if s["last_error"] else 1) for node_id, s in self._status.items()],
+            labelnames=["node"], registry=registry
+        )
+
+
+class _CollectorHandler(BaseHTTPRequestHandler):
+    db_path = None
+    node_id = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/sync/readings":
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            since = int(query.get("since", ["0"])[0])
+            limit = min(int(query.get("limit", [DEFAULT_PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+        except ValueError:
+            self.send_error(400)
+            return
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        try:
+            body = json.dumps(read_page(conn, self.node_id, since, limit)).encode()
+        finally:
+            conn.close()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_collector(db_path, port, addr="127.0.0.1", node_id="standin"):
+    """Serve /sync/readings for db_path from a daemon thread, returns the server"""
+    handler = type("CollectorHandler", (_CollectorHandler,), {"db_path": str(db_path), "node_id": node_id})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="collector", daemon=True).start()
+    return server
+
+
+def simulate(db_path, appliances, interval, stop):
+    """Write a random-walk reading per appliance every interval until stop is set"""
+    conn = sqlite3.connect(str(db_path))
+    configure_connection(conn)
+    run_migrations(conn)
+    writer = BufferedWriter(conn, batch_size=appliances)
+    watts = [random.uniform(50, 500) for _ in range(appliances)]
+    try:
+        while not stop.wait(interval):
+            ts = int(time.time())
+            for i in range(appliances):
+                watts[i] = max(0.0, watts[i] + random.gauss(0, 25))
+                writer.add(time.strftime(TIMESTAMP_FORMAT, time.localtime(ts)), round(watts[i], 2),
+                           i + 1, f"Appliance {i + 1}", ts=ts)
+    finally:
+        writer.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-node aggregation tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    collector = sub.add_parser("collector", help="Serve /sync/readings from a database as a stand-in node")
+    collector.add_argument("--db", required=True, help="Path to the SQLite database")
+    collector.add_argument("--port", type=int, default=8101)
+    collector.add_argument("--addr", default="0.0.0.0")
+    collector.add_argument("--node", default="standin", help="Node id reported in responses")
+    collector.add_argument("--simulate", type=int, default=0, metavar="N",
+                           help="Also write synthetic readings for N appliances")
+    collector.add_argument("--interval", type=float, default=5.0, help="Seconds between synthetic readings")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    conn = sqlite3.connect(args.db)
+    run_migrations(conn)
+    conn.close()
+
+    stop = threading.Event()
+    if args.simulate:
+        threading.Thread(target=simulate, args=(args.db, args.simulate, args.interval, stop),
+                         daemon=True).start()
+    server = serve_collector(args.db, args.port, args.addr, args.node)
+    logger.info(f"Stand-in collector {args.node} on http://{args.addr}:{args.port}/sync/readings")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stop.set()
+        server.shutdown()
@@ -1,17 +1,45 @@
 from fastapi import FastAPI, HTTPException, Query, status
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import sqlite3
+import asyncio
+import itertools
 import os
+import socket
 from pathlib import Path
-import json
 from datetime import datetime, timedelta
-import re
+from db_reader import ReadPool
+from latest_cache import LatestReadingCache
+import appliances
+from appliances import ApplianceRegistry
+from broadcast import Broadcaster, sse_frame
+from response_cache import ResponseCache, request_key
+import numpy as np
+import metrics
+import managed_logging
+import rollups
+import consumption
+import disaggregate
+import downsample
+import encoding
+from encoding import FastJSONResponse
+import events
+import export
+import forecast
+from forecast import Forecaster
+import ingest
+from ingest import Ingestor, IngestError
+import aggregator as aggregator_module
+from aggregator import Aggregator
+import archive as archive_module
+from archive import Archive, merge_newest_first
+from log_index import LogIndex, RotatedLog, ENERGY_RECORD_RE, TIMESTAMP_RE
 
 app = FastAPI(
     title="Energy Monitoring System API",
     description="API for monitoring energy consumption data",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse
 )
 
 # Add CORS middleware
@@ -23,13 +51,156 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/brotli for clients that accept it, streamed responses included
+app.add_middleware(encoding.CompressionMiddleware)
+
+# Per-route latency for /metrics, timed until the last byte of the response
+REQUEST_SECONDS = metrics.Histogram(
+    "api_request_seconds", "HTTP request duration by route template", ["method", "route", "status"]
+)
+app.add_middleware(metrics.RequestMetricsMiddleware, histogram=REQUEST_SECONDS)
+
 # Get the directory where this script is located
 SCRIPT_DIR = Path(__file__).parent.absolute()
-DB_PATH = SCRIPT_DIR / "energy_data.db"
+# Database, logs and archive live next to the scripts unless ENERGY_DATA_DIR
+# points elsewhere (benchmark.py uses this to serve a synthetic dataset)
+DATA_DIR = Path(os.environ.get("ENERGY_DATA_DIR", SCRIPT_DIR))
+DB_PATH = DATA_DIR / "energy_data.db"
+ARCHIVE_DIR = DATA_DIR / "archive"
+
+# Name this node reports in /sync/readings and /nodes
+NODE_ID = os.environ.get("ENERGY_NODE_ID", socket.gethostname())
+# Present on an aggregator only: the collector nodes to pull (see aggregator.py)
+NODES_PATH = DATA_DIR / "nodes.json"
 
 # Log file paths
-API_LOG_PATH = SCRIPT_DIR / "api.log"
-ENERGY_MONITOR_LOG_PATH = SCRIPT_DIR / "energy_monitor.log"
+API_LOG_PATH = DATA_DIR / "api.log"
+ENERGY_MONITOR_LOG_PATH = DATA_DIR / "energy_monitor.log"
+
+# Page sizes for the history, event and log endpoints
+HISTORY_DEFAULT_LIMIT = 24
+HISTORY_MAX_LIMIT = 5000
+# from/to/points mode of the history endpoints
+HISTORY_DEFAULT_POINTS = 500
+HISTORY_MAX_POINTS = 5000
+HISTORY_DEFAULT_SPAN = 24 * 3600
+# Downsample from a rollup table once each output bucket spans this many of its rows
+ROLLUP_SOURCE_MIN_ROWS = 10
+EVENTS_PAGE_SIZE = 100
+EVENTS_PAGE_MAX = 1000
+NDJSON_CHUNK_RECORDS = 500  # Records per streamed chunk
+LOG_PAGE_SIZE = 1000
+LOG_PAGE_MAX = 10000
+
+# Incremental offset/record-count indexes over the log files, plus their
+# rotated segments (see managed_logging.py)
+energy_log_index = LogIndex(ENERGY_MONITOR_LOG_PATH, ENERGY_RECORD_RE)
+api_log_index = LogIndex(API_LOG_PATH, TIMESTAMP_RE)
+energy_log = RotatedLog(energy_log_index)
+api_log = RotatedLog(api_log_index)
+
+# Readings moved out of the usage table by archive.py, merged back into history queries
+archive = Archive(ARCHIVE_DIR)
+
+# Shared read-only connection pool used by every database endpoint
+DB_POOL_SIZE = 4
+db = ReadPool(DB_PATH, size=DB_POOL_SIZE)
+
+# Latest reading per appliance, refreshed when PRAGMA data_version changes
+LATEST_POLL_INTERVAL = 0.5
+LATEST_MAX_AGE = 1  # Cache-Control max-age for /energy responses, in seconds
+# The appliances table, reloaded by the cache on the same data_version change
+appliance_registry = ApplianceRegistry()
+latest = LatestReadingCache(DB_PATH, poll_interval=LATEST_POLL_INTERVAL, registry=appliance_registry)
+
+# Serialised history and log responses, dropped when their appliance's data or the log changes
+RESPONSE_CACHE_ENTRIES = 256
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+RESPONSE_CACHE_TTL = 300
+RESPONSE_CACHE_NOW_TTL = 10  # For windows ending "now", which move on without new data
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+
+# Prices and band times for /energy/consumption; restart the API after editing tariff.json
+tariff = consumption.load_tariff()
+
+# /energy/stream subscribers, fed with each poll's new readings by the cache
+STREAM_KEEPALIVE = 15.0  # Seconds between SSE keepalive comments
+broadcaster = Broadcaster()
+latest.add_listener(broadcaster.publish)
+
+# POST /ingest writer, with the same rollup and energy total hooks as the sampler
+ingestor = Ingestor(DB_PATH, hooks=[rollups.RollupMaintainer(), consumption.ConsumptionMaintainer(tariff)])
+
+# Aggregator mode pulls every collector's readings into DB_PATH in the background
+aggregator = Aggregator.from_config(DB_PATH, NODES_PATH) if NODES_PATH.exists() else None
+
+# Hourly consumption models, updated in the background and served from memory
+forecaster = Forecaster(DB_PATH)
+
+# Figures other modules already count, read when /metrics is scraped
+def cache_counts():
+    chunks = archive_module._decode.cache_info()
+    latest_stats = latest.stats()
+    return {
+        "latest": (latest_stats["hits"], latest_stats["misses"]),
+        "archive_chunks": (chunks.hits, chunks.misses),
+        "responses": (response_cache.hits, response_cache.misses),
+    }
+
+metrics.CallbackMetric(
+    "api_cache_hits", "Requests served from a cache",
+    lambda: [((name,), hits) for name, (hits, _) in cache_counts().items()],
+    type="counter", labelnames=["cache"]
+)
+metrics.CallbackMetric(
+    "api_cache_misses", "Cache lookups that fell through to the database or disk",
+    lambda: [((name,), misses) for name, (_, misses) in cache_counts().items()],
+    type="counter", labelnames=["cache"]
+)
+metrics.CallbackMetric(
+    "api_response_cache_dropped", "Cached responses dropped, by reason",
+    lambda: [(("evicted",), response_cache.evictions), (("invalidated",), response_cache.invalidations),
+             (("expired",), response_cache.expirations)],
+    type="counter", labelnames=["reason"]
+)
+metrics.CallbackMetric("api_response_cache_bytes", "Bytes of cached response bodies",
+                       lambda: response_cache.bytes)
+metrics.CallbackMetric("db_pool_in_use", "Pooled connections running a query",
+                       lambda: db.stats()["in_use"])
+metrics.CallbackMetric("api_stream_subscribers", "Open /energy/stream clients",
+                       lambda: broadcaster.stats()["subscribers"])
+metrics.CallbackMetric("api_stream_dropped", "Readings dropped for slow stream clients",
+                       lambda: broadcaster.dropped, type="counter")
+managed_logging.register_metrics()
+metrics.register_process_metrics()
+if aggregator is not None:
+    aggregator.register_metrics()
+
+@app.on_event("startup")
+async def start_latest_cache():
+    if aggregator is not None:
+        await aggregator.start()  # Creates the aggregate database before the cache opens it
+    await latest.start()
+    await forecaster.start()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    if aggregator is not None:
+        await aggregator.stop()
+    await forecaster.stop()
+    await latest.stop()
+    ingestor.close()
+    db.close()
+
+def cached_reading_response(request, entry, body):
+    """Serve a cached reading, or 304 if the client already has it"""
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": f"max-age={LATEST_MAX_AGE}",
+    }
+    if request.headers.get("if-none-match") == entry.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/")
 async def root():
@@ -40,9 +211,19 @@ async def root():
         "endpoints": {
             "current_energy": "/energy",
             "energy_history": "/energy/history",
+            "energy_consumption": "/energy/consumption",
+            "energy_forecast": "/energy/forecast",
+            "export": "/export",
+            "events": "/events",
             "logs": "/logs/energy-monitor",
             "api_logs": "/logs/api",
-            "health": "/health"
+            "live_stream": "/energy/stream",
+            "health": "/health",
+            "db_stats": "/stats/db",
+            "metrics": "/metrics",
+            "nodes": "/nodes",
+            "sync": "/sync/readings",
+            "ingest": "/ingest"
         }
     }
 
@@ -70,14 +251,31 @@ async def health_check():
             detail=f"Health check failed: {str(e)}"
         )
 
+@app.get("/stats/db")
+async def get_db_stats():
+    """Connection pool wait times, per-query timings and cache hits"""
+    stats = db.stats()
+    stats["latest_cache"] = latest.stats()
+    stats["response_cache"] = response_cache.stats()
+    stats["stream"] = broadcaster.stats()
+    stats["forecast"] = forecaster.stats()
+    return stats
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text format: request, query and cache figures of this process"""
+    return Response(content=metrics.REGISTRY.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
 @app.get("/energy")
-async def get_energy(appliance_id: int = Query(1)):
+async def get_energy(request: Request, appliance_id: int = Query(1)):
+    entry = latest.get(appliance_id)
+    if entry is not None:
+        return cached_reading_response(request, entry, entry.body)
     try:
-        conn = sqlite3.connect(str(DB_PATH))
-        c = conn.cursor()
-        c.execute("SELECT timestamp, watts FROM usage WHERE appliance_id = ? ORDER BY timestamp DESC LIMIT 1", (appliance_id,))
-        data = c.fetchone()
-        conn.close()
+        data = await db.fetchone(
+            "SELECT timestamp, watts FROM usage WHERE appliance_id = ? ORDER BY ts DESC LIMIT 1",
+            (appliance_id,)
+        )
         if data:
             return {"timestamp": data[0], "watts": data[1]}
         return {"error": "No data available"}
@@ -87,31 +285,28 @@ async def get_energy(appliance_id: int = Query(1)):
 @app.get("/appliances")
 async def get_appliances():
     """Get list of all appliances being monitored"""
-    try: 
-        conn = sqlite3.connect(str(DB_PATH))
-        c = conn.cursor()
-        c.execute("SELECT DISTINCT appliance_id, appliance_name FROM usage ORDER BY appliance_id")
-        data = c.fetchall()
-        conn.close()
-
-        appliances = [{"id": row[0], "name": row[1]} for row in data]
-        return {"appliances": appliances}
+    if appliance_registry.loaded:
+        return Response(content=appliance_registry.body, media_type="application/json")
+    try:
+        data = await db.fetchall(appliances.SELECT_SQL)
+        return {"appliances": [appliances.row_to_dict(row) for row in data]}
     except Exception as e:
         return {"error": f"Database error: {str(e)}"}
 
-@app.get("/energy/{appliance_id}")
-async def get_energy_for_appliance(appliance_id: int):
+@app.get("/energy/{appliance_id:int}")
+async def get_energy_for_appliance(request: Request, appliance_id: int):
     """Get the latest energy data for a specific appliance"""
+    entry = latest.get(appliance_id)
+    if entry is not None:
+        return cached_reading_response(request, entry, entry.appliance_body)
     try:
-        conn = sqlite3.connect(str(DB_PATH))
-        c = conn.cursor()
-        c.execute(
-            "SELECT timestamp, watts, appliance_name FROM usage WHERE appliance_id = ? ORDER BY timestamp DESC LIMIT 1", 
+        data = await db.fetchone(
+            "SELECT timestamp, watts, COALESCE(appliances.name, appliance_name) "
+            "FROM usage LEFT JOIN appliances ON appliances.id = usage.appliance_id "
+            "WHERE appliance_id = ? ORDER BY ts DESC LIMIT 1",
             (appliance_id,)
         )
-        data = c.fetchone()
-        conn.close()
-        
+
         if data:
             return {
                 "timestamp": data[0], 
@@ -123,101 +318,739 @@ async def get_energy_for_appliance(appliance_id: int):
     except Exception as e:
         return {"error": f"Database error: {str(e)}"}
 
-@app.get("/energy/history/{appliance_id}")
-async def get_history_for_appliance(appliance_id: int, limit: int = 24):
-    """Get historical data for specific appliance"""
+@app.get("/energy/stream")
+async def stream_energy(appliance_id: int = Query(None)):
+    """Server-Sent Events: the latest reading(s), then every new reading as it is stored
+
+    Pass appliance_id to follow a single appliance. No database query is made
+    per client; all subscribers share the latest-reading cache's poll.
+    """
+    async def events():
+        subscription = broadcaster.subscribe(appliance_id)
+        try:
+            yield b"retry: 5000\n\n"
+            for entry in latest.entries(appliance_id):
+                yield sse_frame(entry)
+            while True:
+                message = await subscription.get(timeout=STREAM_KEEPALIVE)
+                yield message.frame if message is not None else b": keepalive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/energy/stream/ws")
+async def stream_energy_ws(websocket: WebSocket, appliance_id: int = None):
+    """WebSocket version of /energy/stream, one JSON text message per reading"""
+    await websocket.accept()
+    subscription = broadcaster.subscribe(appliance_id)
+    # Watch for the client going away while we wait for readings
+    receiver = asyncio.ensure_future(websocket.receive())
     try:
-        conn = sqlite3.connect(str(DB_PATH))
-        c = conn.cursor()
-        c.execute(
-            "SELECT timestamp, watts FROM usage WHERE appliance_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (appliance_id, limit)
+        for entry in latest.entries(appliance_id):
+            await websocket.send_text(entry.appliance_body.decode())
+        while True:
+            getter = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait({receiver, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                getter.cancel()
+                if receiver.result()["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.ensure_future(websocket.receive())  # Ignore client messages
+                continue
+            await websocket.send_text(getter.result().body.decode())
+    except (WebSocketDisconnect, OSError, RuntimeError):
+        pass  # Client went away mid-send
+    finally:
+        receiver.cancel()
+        broadcaster.unsubscribe(subscription)
+
+async def cached_response(request, token, compute, ttl=None):
+    """compute()'s response, served from response_cache while token is unchanged
+
+    token describes the data the response is built from; None (data not
+    loaded yet) bypasses the cache. Error bodies are never stored.
+    """
+    key = request_key(request)
+    if token is not None:
+        entry = response_cache.get(key, token)
+        if entry is not None:
+            return Response(content=entry.body, media_type=entry.media_type, headers=entry.headers)
+    response = await compute()
+    if isinstance(response, dict):
+        if "error" in response:
+            return response
+        response = FastJSONResponse(response)
+    if token is not None:
+        response_cache.put(key, token, response, ttl)
+    return response
+
+async def usage_version(appliance_id):
+    """Response cache token for the readings of one appliance"""
+    await asyncio.to_thread(latest.refresh)
+    return latest.data_version(appliance_id)
+
+def ndjson_lines(records):
+    """Serialise an iterable of dicts as newline-delimited JSON, a chunk of records at a time"""
+    records = iter(records)
+    while True:
+        chunk = [encoding.dumps(record) for record in itertools.islice(records, NDJSON_CHUNK_RECORDS)]
+        if not chunk:
+            return
+        yield b"\n".join(chunk) + b"\n"
+
+def columnar(records, fields):
+    """Dict of parallel lists from a list of dicts"""
+    return {field: [record[field] for record in records] for field in fields}
+
+def history_response(format, meta, ts, watts, timestamps=None):
+    """History body in the requested format; meta holds the non-reading fields
+
+    timestamps are the formatted reading times for json, derived from ts
+    when not given.
+    """
+    if format == "binary":
+        headers = {f"X-{key.title().replace('_', '-')}": str(value) for key, value in meta.items()
+                   if value is not None}
+        return Response(content=encoding.packed_history(ts, watts), media_type=encoding.BINARY_MEDIA_TYPE,
+                        headers=headers)
+    if format == "columns":
+        return FastJSONResponse({**meta, "ts": ts, "watts": watts})
+    if timestamps is None:
+        timestamps = [datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') for t in ts]
+    return FastJSONResponse({**meta, "data": [
+        {"timestamp": stamp, "ts": t, "watts": w} for stamp, t, w in zip(timestamps, ts, watts)
+    ]})
+
+RAW_RANGE_SQL = "SELECT ts, watts FROM usage WHERE appliance_id = ? AND ts >= ? AND ts < ? ORDER BY ts"
+RAW_RANGE_DTYPE = [("ts", "i8"), ("watts", "f8")]
+ROLLUP_RANGE_SQL = (
+    "SELECT bucket, min_watts, max_watts, sum_watts / count FROM rollup_{resolution} "
+    "WHERE appliance_id = ? AND bucket >= ? AND bucket < ? ORDER BY bucket"
+)
+ROLLUP_RANGE_DTYPE = [("ts", "i8"), ("low", "f8"), ("high", "f8"), ("avg", "f8")]
+
+def range_source(bucket_width):
+    """Coarsest table with at least ROLLUP_SOURCE_MIN_ROWS rows per output bucket"""
+    source = "raw"
+    for resolution, size in rollups.RESOLUTIONS.items():
+        if bucket_width >= size * ROLLUP_SOURCE_MIN_ROWS:
+            source = resolution
+    return source
+
+async def downsampled_history(appliance_id, from_, to, points, method, format="json"):
+    """At most points readings covering [from, to), downsampled server-side"""
+    end = parse_time_param(to, "to") if to else int(datetime.now().timestamp())
+    start = parse_time_param(from_, "from") if from_ else end - HISTORY_DEFAULT_SPAN
+    if end <= start:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="'to' must be after 'from'"
         )
-        data = c.fetchall()
-        conn.close()
 
-        return {
+    buckets = points // 2 if method == "minmax" else points
+    source = range_source((end - start) / buckets)
+    try:
+        if source == "raw":
+            rows = await db.fetcharray(RAW_RANGE_SQL, (appliance_id, start, end), RAW_RANGE_DTYPE)
+            ts, low = rows["ts"], rows["watts"]
+            archived_ts, archived_watts = await asyncio.to_thread(
+                archive.read_range, appliance_id, start, end
+            )
+            if len(archived_ts):
+                ts = np.concatenate((archived_ts, ts))
+                low = np.concatenate((archived_watts.astype(float), low))
+                order = np.argsort(ts, kind="stable")
+                ts, low = ts[order], low[order]
+            high = avg = low
+        else:
+            # Rollups cover archived days too
+            rows = await db.fetcharray(
+                ROLLUP_RANGE_SQL.format(resolution=source),
+                (appliance_id, rollups.bucket_start(start, source), end),
+                ROLLUP_RANGE_DTYPE
+            )
+            ts, low, high, avg = rows["ts"], rows["low"], rows["high"], rows["avg"]
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
+    total_rows = len(ts)
+    if method == "minmax":
+        ts, watts = await asyncio.to_thread(downsample.minmax, ts, low, high, start, end, points)
+    else:
+        ts, watts = await asyncio.to_thread(downsample.lttb, ts, avg, points)
+
+    meta = {
+        "appliance_id": appliance_id,
+        "from": start,
+        "to": end,
+        "method": method,
+        "source": source,
+        "rows": total_rows,
+    }
+    if format == "binary":
+        return history_response(format, meta, ts, watts)
+    return history_response(format, meta, ts.tolist(), watts.tolist())
+
+def newest_readings_query(appliance_id, before=None):
+    where = "appliance_id = ?"
+    params = [appliance_id]
+    if before is not None:
+        where += " AND ts < ?"
+        params.append(before)
+    return f"SELECT timestamp, watts, ts FROM usage WHERE {where} ORDER BY ts DESC", params
+
+async def newest_readings(appliance_id, before, limit):
+    """Up to limit (timestamp, watts, ts) rows with ts < before, newest first
+
+    Merges the usage table with the archive, so paging carries on past the
+    archive cut-off.
+    """
+    sql, params = newest_readings_query(appliance_id, before)
+    hot = await db.fetchall(sql + " LIMIT ?", (*params, limit))
+    days = archive.days(appliance_id)
+    # Skip the archive when it is empty or every row wanted is newer than its last day
+    if not days or (len(hot) == limit and hot[-1][2] >= days[-1] + 25 * 3600):
+        return hot
+    archived = await asyncio.to_thread(
+        lambda: list(itertools.islice(archive.iter_newest_first(appliance_id, before), limit))
+    )
+    return list(itertools.islice(merge_newest_first(hot, archived), limit))
+
+async def history_page(appliance_id, after, limit, format):
+    """One page of readings, newest first"""
+    try:
+        # One extra row tells us whether there is a next page
+        data = await newest_readings(appliance_id, after, limit + 1)
+        next_cursor = data[limit - 1][2] if len(data) > limit else None
+        page = data[:limit]
+
+        if format != "json":
+            meta = {"appliance_id": appliance_id, "next": next_cursor}
+            return history_response(format, meta, [row[2] for row in page], [row[1] for row in page])
+        return FastJSONResponse({
             "appliance_id": appliance_id,
+            "data": [{"timestamp": row[0], "watts": row[1]} for row in page],
+            "next": next_cursor
+        })
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
+def range_ttl(to):
+    return RESPONSE_CACHE_TTL if to is not None else RESPONSE_CACHE_NOW_TTL
+
+@app.get("/energy/history/{appliance_id:int}")
+async def get_history_for_appliance(
+    request: Request,
+    appliance_id: int,
+    limit: int = Query(None, ge=1, le=HISTORY_MAX_LIMIT),
+    after: int = Query(None),
+    format: str = Query("json", pattern="^(json|ndjson|columns|binary)$"),
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    points: int = Query(None, ge=3, le=HISTORY_MAX_POINTS),
+    method: str = Query("minmax", pattern="^(minmax|lttb)$")
+):
+    """Get historical data for specific appliance, newest first
+
+    Pass the "next" value of a response as after= to get the following page.
+    format=ndjson streams every matching row (or the first limit rows);
+    columns and binary are the compact formats described in encoding.py.
+    With from/to/points the range is instead returned oldest first,
+    downsampled to at most points readings.
+    """
+    if from_ is not None or to is not None or points is not None:
+        token = await usage_version(appliance_id)
+        return await cached_response(request, token, lambda: downsampled_history(
+            appliance_id, from_, to, points or HISTORY_DEFAULT_POINTS, method, format
+        ), range_ttl(to))
+
+    if format == "ndjson":
+        # Paged: a slow client holds no pool connection between pages
+        rows = export.iter_newest_readings(db, archive, appliance_id, before=after, limit=limit)
+        return StreamingResponse(
+            ndjson_lines({"timestamp": row[0], "watts": row[1]} for row in rows),
+            media_type="application/x-ndjson"
+        )
+
+    token = await usage_version(appliance_id)
+    return await cached_response(request, token, lambda: history_page(
+        appliance_id, after, limit or HISTORY_DEFAULT_LIMIT, format
+    ))
+
+async def newest_history(appliance_id, format):
+    try:
+        data = await newest_readings(appliance_id, None, HISTORY_DEFAULT_LIMIT)
+        if format != "json":
+            return history_response(format, {}, [row[2] for row in data], [row[1] for row in data])
+        # Return in the format expected by Flutter app
+        return {
             "data": [{"timestamp": row[0], "watts": row[1]} for row in data]
         }
     except Exception as e:
         return {"error": f"Database error: {str(e)}"}
 
 @app.get("/energy/history")
-async def get_history(appliance_id: int = 1):
+async def get_history(
+    request: Request,
+    appliance_id: int = 1,
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    points: int = Query(None, ge=3, le=HISTORY_MAX_POINTS),
+    method: str = Query("minmax", pattern="^(minmax|lttb)$"),
+    format: str = Query("json", pattern="^(json|columns|binary)$")
+):
     """Get energy history for specific appliance (defaults to appliance 1)"""
+    token = await usage_version(appliance_id)
+    if from_ is not None or to is not None or points is not None:
+        return await cached_response(request, token, lambda: downsampled_history(
+            appliance_id, from_, to, points or HISTORY_DEFAULT_POINTS, method, format
+        ), range_ttl(to))
+    return await cached_response(request, token, lambda: newest_history(appliance_id, format))
+
+# Fields of /energy/rollup?format=columns, the timestamp strings left out
+ROLLUP_COLUMNS = ("ts", "count", "avg_watts", "min_watts", "max_watts", "wh")
+
+# Window returned by /energy/rollup when "from" is not given, in seconds
+ROLLUP_DEFAULT_SPAN = {
+    "minute": 24 * 3600,
+    "hour": 7 * 24 * 3600,
+    "day": 90 * 24 * 3600,
+}
+
+def parse_time_param(value, name):
+    """Epoch seconds, or an ISO 8601 / 'YYYY-MM-DD HH:MM:SS' local time"""
     try:
-        conn = sqlite3.connect(str(DB_PATH))
-        c = conn.cursor()
-        c.execute(
-            "SELECT timestamp, watts FROM usage WHERE appliance_id = ? ORDER BY timestamp DESC LIMIT 24", 
-            (appliance_id,)
+        return int(float(value))
+    except (ValueError, OverflowError):  # OverflowError: inf, 1e400
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid '{name}' time: {value}"
         )
-        data = c.fetchall()
-        conn.close()
-        # Return in the format expected by Flutter app
+
+@app.get("/energy/rollup")
+async def get_rollup(
+    appliance_id: int = 1,
+    resolution: str = "hour",
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    format: str = Query("json", pattern="^(json|columns)$")
+):
+    """Pre-aggregated count/avg/min/max/Wh per minute, hour or day"""
+    if resolution not in rollups.RESOLUTIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"resolution must be one of: {', '.join(rollups.RESOLUTIONS)}"
+        )
+
+    end = parse_time_param(to, "to") if to else int(datetime.now().timestamp())
+    start = parse_time_param(from_, "from") if from_ else end - ROLLUP_DEFAULT_SPAN[resolution]
+    start = rollups.bucket_start(start, resolution)
+
+    try:
+        data = await db.fetchall(
+            rollups.QUERY_SQL.format(resolution=resolution),
+            (appliance_id, start, end)
+        )
+        records = [rollups.row_to_dict(row) for row in data]
+        body = {
+            "appliance_id": appliance_id,
+            "resolution": resolution,
+            "from": start,
+            "to": end,
+        }
+        if format == "columns":
+            body.update(columnar(records, ROLLUP_COLUMNS))
+        else:
+            body["data"] = records
+        return FastJSONResponse(body)
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
+@app.get("/energy/consumption")
+async def get_consumption(
+    period: str = "day",
+    appliance_id: int = Query(None),
+    date: str = Query(None)
+):
+    """kWh and cost per tariff band for the day/week/month/year containing date (default now)
+
+    Read from the energy_totals accumulators, so the cost is the same for a
+    day or a year. Without appliance_id the whole house is returned,
+    including the standing charge; disaggregated appliances are left out
+    of it, their energy is already in the main channel's.
+    """
+    if period not in consumption.PERIODS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"period must be one of: {', '.join(consumption.PERIODS)}"
+        )
+
+    now = int(datetime.now().timestamp())
+    start = consumption.period_start(parse_time_param(date, "date") if date else now, period)
+    end = consumption.next_period_start(start, period)
+
+    try:
+        sql = consumption.QUERY_SQL
+        params = [period, start]
+        if appliance_id is not None:
+            sql += " AND appliance_id = ?"
+            params.append(appliance_id)
+        else:
+            sql += disaggregate.MEASURED_FILTER
+        rows = await db.fetchall(sql, params)
+        return consumption.summarize(rows, tariff, period, start, end, now, appliance_id)
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
+@app.get("/energy/forecast")
+async def get_forecast(
+    appliance_id: int = 1,
+    hours: int = Query(24, ge=1, le=forecast.MAX_HORIZON)
+):
+    """Predicted average power for each of the next hours, from the current one on
+
+    Answered from the fitted model in memory; models are updated in the
+    background every forecast.UPDATE_INTERVAL seconds.
+    """
+    result = forecaster.forecast(appliance_id, hours)
+    if result is None:
+        return {"error": "No forecast available, needs a day of readings"}
+    return FastJSONResponse(result)
+
+@app.get("/export")
+async def export_readings(
+    appliance_id: int = 1,
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    format: str = Query("csv", pattern="^(csv|ndjson|parquet|arrow)$")
+):
+    """Download every reading of one appliance in [from, to), oldest first
+
+    Streamed from a database cursor a chunk at a time, archived days
+    included, so any range can be exported in constant memory. from
+    defaults to the first reading, to to now.
+    """
+    end = parse_time_param(to, "to") if to else int(datetime.now().timestamp()) + 1
+    start = parse_time_param(from_, "from") if from_ else 0
+    if end <= start:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="'to' must be after 'from'"
+        )
+    if format in export.COLUMNAR_FORMATS and not export.columnar_available():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"format={format} needs pyarrow installed on the server"
+        )
+
+    rows = export.iter_readings(db, archive, appliance_id, start, end)
+    name = export.filename(appliance_id, start, end, format)
+    return StreamingResponse(
+        export.export_chunks(rows, appliance_id, format),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{name}"'}
+    )
+
+@app.get("/events")
+async def get_events(
+    appliance_id: int = Query(None),
+    kind: str = Query(None),
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    limit: int = Query(EVENTS_PAGE_SIZE, ge=1, le=EVENTS_PAGE_MAX),
+    after: int = Query(None)
+):
+    """Detected on/off, step, over_limit and stall events, newest first
+
+    kind takes a comma-separated list. Pass the "next" value of a response
+    as after= to get the following page.
+    """
+    where = []
+    params = []
+    if appliance_id is not None:
+        where.append("appliance_id = ?")
+        params.append(appliance_id)
+    if kind:
+        kinds = list(dict.fromkeys(kind.split(",")))
+        unknown = [k for k in kinds if k not in events.KINDS]
+        if unknown:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"kind must be among: {', '.join(events.KINDS)}"
+            )
+        where.append(f"kind IN ({', '.join('?' * len(kinds))})")
+        params.extend(kinds)
+    if from_:
+        where.append("ts >= ?")
+        params.append(parse_time_param(from_, "from"))
+    if to:
+        where.append("ts < ?")
+        params.append(parse_time_param(to, "to"))
+    if after is not None:
+        where.append("id < ?")
+        params.append(after)
+
+    sql = "SELECT id, ts, appliance_id, kind, watts, baseline, message FROM events"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    try:
+        rows = await db.fetchall(sql + " ORDER BY id DESC LIMIT ?", (*params, limit + 1))
         return {
-            "data": [{"timestamp": row[0], "watts": row[1]} for row in data]
+            "events": [events.row_to_dict(row) for row in rows[:limit]],
+            "next": rows[limit - 1][0] if len(rows) > limit else None
         }
     except Exception as e:
         return {"error": f"Database error: {str(e)}"}
 
+async def read_body(request, max_bytes):
+    """Request body, or 413 as soon as it grows past max_bytes"""
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Batches are limited to {max_bytes} bytes"
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+@app.post("/ingest")
+async def ingest_readings(request: Request):
+    """Write a batch of NDJSON or packed binary readings in one transaction
+
+    Readings already stored for the same (appliance_id, ts) are skipped, so
+    a sensor can safely resend a batch it got no answer for.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    body = await read_body(request, ingest.MAX_BATCH_BYTES)
+    try:
+        readings = ingest.parse(body, content_type)
+    except IngestError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.errors)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=str(e))
+
+    try:
+        return await asyncio.to_thread(ingestor.write, readings)
+    except Exception as e:
+        # 503 so the sensor keeps the batch and retries
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            content={"error": f"Database error: {str(e)}"})
+
+@app.get("/sync/readings")
+async def get_sync_readings(
+    since: int = Query(0, ge=0),
+    limit: int = Query(aggregator_module.DEFAULT_PAGE_SIZE, ge=1, le=aggregator_module.MAX_PAGE_SIZE)
+):
+    """Readings with a rowid above since, oldest first, for an aggregator to pull
+
+    rows are [rowid, ts, watts, appliance_id, appliance_name, source], source
+    being the appliance's registry source (None if unset); pass next as since
+    for the following page while more is true.
+    """
+    try:
+        rows = await db.fetchall(aggregator_module.SYNC_SQL, (since, limit))
+        max_rowid = (await db.fetchone(aggregator_module.MAX_ROWID_SQL))[0] or 0
+        return aggregator_module.sync_page(NODE_ID, since, rows, max_rowid)
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
+def node_of(appliance_id, name):
+    """(node id, appliance id on that node, name) of a local appliance id"""
+    if aggregator is not None:
+        node = aggregator.node_of(appliance_id)
+        if node is not None:
+            return node
+    return (NODE_ID, appliance_id, name)
+
+@app.get("/nodes")
+async def get_nodes():
+    """This node's role, plus each collector's pull cursor and status on an aggregator"""
+    if aggregator is None:
+        return {"mode": "collector", "node": NODE_ID, "nodes": []}
+    return {"mode": "aggregator", "node": NODE_ID, "nodes": aggregator.status()}
+
+@app.get("/nodes/energy")
+async def get_nodes_energy():
+    """Latest reading of every appliance grouped by node, with node and site totals"""
+    nodes = {}
+    for entry in latest.entries():
+        if appliance_registry.source(entry.appliance_id) == disaggregate.VIRTUAL_SOURCE:
+            continue
+        node_id, remote_id, name = node_of(entry.appliance_id, entry.appliance_name)
+        node = nodes.setdefault(node_id, {"node": node_id, "watts": 0.0, "appliances": []})
+        node["watts"] += entry.watts
+        node["appliances"].append({
+            "appliance_id": entry.appliance_id,
+            "remote_appliance_id": remote_id,
+            "name": name,
+            "watts": entry.watts,
+            "timestamp": entry.timestamp,
+        })
+    return {
+        "total_watts": sum(node["watts"] for node in nodes.values()),
+        "nodes": [nodes[node_id] for node_id in sorted(nodes)],
+    }
+
+@app.get("/nodes/consumption")
+async def get_nodes_consumption(period: str = "day", date: str = Query(None)):
+    """Site kWh and cost for a period, as /energy/consumption, with a per-node breakdown"""
+    if period not in consumption.PERIODS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"period must be one of: {', '.join(consumption.PERIODS)}"
+        )
+
+    now = int(datetime.now().timestamp())
+    start = consumption.period_start(parse_time_param(date, "date") if date else now, period)
+    end = consumption.next_period_start(start, period)
+
+    try:
+        rows = await db.fetchall(consumption.QUERY_SQL + disaggregate.MEASURED_FILTER, (period, start))
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
+    site = consumption.summarize(rows, tariff, period, start, end, now)
+    nodes = {}
+    for appliance_id, band, wh, _ in rows:
+        node_id = node_of(appliance_id, None)[0]
+        node = nodes.setdefault(node_id, {"node": node_id, "kwh": 0.0, "energy_cost": 0.0})
+        node["kwh"] += wh / 1000
+        price = tariff.price(band)
+        if price is not None:
+            node["energy_cost"] += wh / 1000 * price
+    for node in nodes.values():
+        node["energy_cost"] = round(node["energy_cost"], 4)
+    site["nodes"] = [nodes[node_id] for node_id in sorted(nodes)]
+    return site
+
+# Fields of the log endpoints' format=columns responses
+ENERGY_LOG_COLUMNS = ("timestamp", "watts")
+API_LOG_COLUMNS = ("timestamp", "message")
+
+def energy_log_record(match):
+    return {
+        "timestamp": match.group(1).decode(),
+        "watts": float(match.group(2)),
+        "source": "energy_monitor"
+    }
+
+def api_log_record(match):
+    return {
+        "timestamp": match.group(1).decode(),
+        "message": match.string.decode(errors="replace").strip(),
+        "source": "api"
+    }
+
+def parse_log_cursor(after):
+    """None -> oldest retained record, "123" -> live file offset, "<segment>:123" -> rotated segment"""
+    if after is None:
+        return "", 0
+    segment, _, offset = after.rpartition(":")
+    try:
+        offset = int(offset)
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid log cursor: {after}"
+        )
+    return segment or None, offset
+
+def format_log_cursor(position):
+    segment, offset = position
+    return offset if segment is None else f"{segment}:{offset}"
+
+def read_log_page(log, to_record, position, limit):
+    """Up to limit records starting at position, plus the next page's cursor"""
+    log.update()
+    data = []
+    for record_position, match in log.iter_records(position):
+        if len(data) == limit:
+            return data, format_log_cursor(record_position)
+        data.append(to_record(match))
+    return data, None
+
+def stream_log_records(log, to_record, position, limit):
+    log.update()
+    records = (to_record(match) for _, match in log.iter_records(position))
+    if limit is not None:
+        records = itertools.islice(records, limit)
+    return StreamingResponse(ndjson_lines(records), media_type="application/x-ndjson")
+
+async def log_records_response(log, log_path, to_record, columns, after, limit, format):
+    position = parse_log_cursor(after)
+    if format == "ndjson":
+        return await asyncio.to_thread(stream_log_records, log, to_record, position, limit)
+
+    data, next_cursor = await asyncio.to_thread(
+        read_log_page, log, to_record, position, limit or LOG_PAGE_SIZE
+    )
+    body = {
+        "total_records": log.records,
+        "file_size": log_path.stat().st_size if log_path.exists() else 0,
+        "rotated_segments": len(log.segment_paths()),
+        "next": next_cursor
+    }
+    if format == "columns":
+        body.update(columnar(data, columns))
+    else:
+        body["data"] = data
+    return FastJSONResponse(body)
+
 @app.get("/logs/energy-monitor")
-async def get_energy_monitor_logs():
-    """Get energy monitor log data for historical analysis"""
+async def get_energy_monitor_logs(
+    after: str = Query(None),
+    limit: int = Query(None, ge=1, le=LOG_PAGE_MAX),
+    format: str = Query("json", pattern="^(json|ndjson|columns)$")
+):
+    """Get energy monitor log data for historical analysis
+
+    Starts at the oldest rotated segment and returns LOG_PAGE_SIZE records
+    per page; pass "next" back as after= to continue. format=ndjson streams
+    every record from after onwards, format=columns returns parallel
+    timestamp and watts lists instead of data.
+    """
     try:
-        if not ENERGY_MONITOR_LOG_PATH.exists():
+        if not ENERGY_MONITOR_LOG_PATH.exists() and not energy_log.segment_paths():
             return {"error": "Energy monitor log file not found"}
-        
-        log_data = []
-        with open(ENERGY_MONITOR_LOG_PATH, 'r') as f:
-            for line in f:
-                # Parse log line for energy data
-                # Expected format: "Time: 2024-01-15 14:30:25, Power: 43.50 W"
-                match = re.search(r'Time: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}), Power: ([\d.]+) W', line)
-                if match:
-                    timestamp = match.group(1)
-                    watts = float(match.group(2))
-                    log_data.append({
-                        "timestamp": timestamp,
-                        "watts": watts,
-                        "source": "energy_monitor"
-                    })
-        
-        return {
-            "data": log_data,
-            "total_records": len(log_data),
-            "file_size": ENERGY_MONITOR_LOG_PATH.stat().st_size
-        }
+
+        return await log_records_response(
+            energy_log, ENERGY_MONITOR_LOG_PATH, energy_log_record, ENERGY_LOG_COLUMNS, after, limit, format
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": f"Error reading energy monitor log: {str(e)}"}
 
 @app.get("/logs/api")
-async def get_api_logs():
-    """Get API log data for system monitoring"""
+async def get_api_logs(
+    after: str = Query(None),
+    limit: int = Query(None, ge=1, le=LOG_PAGE_MAX),
+    format: str = Query("json", pattern="^(json|ndjson|columns)$")
+):
+    """Get API log data for system monitoring, paginated like /logs/energy-monitor"""
     try:
-        if not API_LOG_PATH.exists():
+        if not API_LOG_PATH.exists() and not api_log.segment_paths():
             return {"error": "API log file not found"}
-        
-        log_data = []
-        with open(API_LOG_PATH, 'r') as f:
-            for line in f:
-                # Parse API log lines for request data
-                # Look for timestamp patterns
-                timestamp_match = re.search(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', line)
-                if timestamp_match:
-                    timestamp = timestamp_match.group(1)
-                    log_data.append({
-                        "timestamp": timestamp,
-                        "message": line.strip(),
-                        "source": "api"
-                    })
-        
-        return {
-            "data": log_data,
-            "total_records": len(log_data),
-            "file_size": API_LOG_PATH.stat().st_size
-        }
+
+        return await log_records_response(
+            api_log, API_LOG_PATH, api_log_record, API_LOG_COLUMNS, after, limit, format
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": f"Error reading API log: {str(e)}"}
 
@@ -249,102 +1082,99 @@ async def download_api_log():
 async def get_logs_summary():
     """Get summary statistics from both log files"""
     try:
+        # Only bytes appended since the last call (and new segments) are parsed
+        await asyncio.to_thread(energy_log.update)
+        await asyncio.to_thread(api_log.update)
+
         summary = {
             "energy_monitor": {
                 "exists": ENERGY_MONITOR_LOG_PATH.exists(),
                 "size": ENERGY_MONITOR_LOG_PATH.stat().st_size if ENERGY_MONITOR_LOG_PATH.exists() else 0,
-                "records": 0
+                "records": energy_log.records,
+                "rotated": energy_log.stats()
             },
             "api": {
                 "exists": API_LOG_PATH.exists(),
                 "size": API_LOG_PATH.stat().st_size if API_LOG_PATH.exists() else 0,
-                "records": 0
+                "records": api_log.records,
+                "rotated": api_log.stats()
             }
         }
-        
-        # Count energy monitor records
-        if ENERGY_MONITOR_LOG_PATH.exists():
-            with open(ENERGY_MONITOR_LOG_PATH, 'r') as f:
-                summary["energy_monitor"]["records"] = sum(
-                    1 for line in f 
-                    if re.search(r'Time: \d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}, Power: [\d.]+ W', line)
-                )
-        
-        # Count API records
-        if API_LOG_PATH.exists():
-            with open(API_LOG_PATH, 'r') as f:
-                summary["api"]["records"] = sum(
-                    1 for line in f 
-                    if re.search(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}', line)
-                )
-        
+
         return summary
     except Exception as e:
         return {"error": f"Error generating log summary: {str(e)}"}
 
-@app.get("/logs/historical-data")
-async def get_historical_data(days: int = 7):
-    """Get historical energy data from logs for specified number of days"""
+def read_historical_records(cutoff):
+    """Energy log records at or after cutoff ('YYYY-MM-DD HH:MM:SS'), grouped by day"""
+    energy_log.update()
+    log_data = []
+    daily_stats = {}
+
+    for _, match in energy_log.iter_records(energy_log.position_for(cutoff)):
+        timestamp_str = match.group(1).decode()
+        if timestamp_str < cutoff:
+            continue
+        watts = float(match.group(2))
+        date = timestamp_str[:10]
+        log_data.append({
+            "timestamp": timestamp_str,
+            "watts": watts,
+            "date": date,
+            "hour": int(timestamp_str[11:13])
+        })
+
+        stats = daily_stats.get(date)
+        if stats is None:
+            stats = daily_stats[date] = {
+                "date": date,
+                "avg_watts": 0,
+                "max_watts": watts,
+                "min_watts": watts,
+                "total_readings": 0,
+                "_sum": 0.0
+            }
+        stats["max_watts"] = max(stats["max_watts"], watts)
+        stats["min_watts"] = min(stats["min_watts"], watts)
+        stats["total_readings"] += 1
+        stats["_sum"] += watts
+
+    for stats in daily_stats.values():
+        stats["avg_watts"] = stats.pop("_sum") / stats["total_readings"]
+
+    return log_data, list(daily_stats.values())
+
+def energy_log_version():
+    energy_log.update()
+    return energy_log.version()
+
+async def historical_data(days):
     try:
-        if not ENERGY_MONITOR_LOG_PATH.exists():
-            return {"error": "Energy monitor log file not found"}
-        
         cutoff_date = datetime.now() - timedelta(days=days)
-        log_data = []
-        
-        with open(ENERGY_MONITOR_LOG_PATH, 'r') as f:
-            for line in f:
-                match = re.search(r'Time: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}), Power: ([\d.]+) W', line)
-                if match:
-                    timestamp_str = match.group(1)
-                    watts = float(match.group(2))
-                    
-                    try:
-                        timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                        if timestamp >= cutoff_date:
-                            log_data.append({
-                                "timestamp": timestamp_str,
-                                "watts": watts,
-                                "date": timestamp.strftime('%Y-%m-%d'),
-                                "hour": timestamp.hour
-                            })
-                    except ValueError:
-                        continue
-        
-        # Group by date for daily statistics
-        daily_stats = {}
-        for record in log_data:
-            date = record["date"]
-            if date not in daily_stats:
-                daily_stats[date] = {
-                    "date": date,
-                    "readings": [],
-                    "avg_watts": 0,
-                    "max_watts": 0,
-                    "min_watts": float('inf'),
-                    "total_readings": 0
-                }
-            
-            daily_stats[date]["readings"].append(record["watts"])
-            daily_stats[date]["max_watts"] = max(daily_stats[date]["max_watts"], record["watts"])
-            daily_stats[date]["min_watts"] = min(daily_stats[date]["min_watts"], record["watts"])
-            daily_stats[date]["total_readings"] += 1
-        
-        # Calculate averages
-        for date in daily_stats:
-            readings = daily_stats[date]["readings"]
-            daily_stats[date]["avg_watts"] = sum(readings) / len(readings) if readings else 0
-            daily_stats[date]["min_watts"] = daily_stats[date]["min_watts"] if daily_stats[date]["min_watts"] != float('inf') else 0
-        
-        return {
+        log_data, daily_stats = await asyncio.to_thread(
+            read_historical_records, cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
+        )
+
+        return FastJSONResponse({
             "data": log_data,
-            "daily_stats": list(daily_stats.values()),
+            "daily_stats": daily_stats,
             "total_records": len(log_data),
             "date_range": {
                 "from": cutoff_date.strftime('%Y-%m-%d'),
                 "to": datetime.now().strftime('%Y-%m-%d'),
                 "days": days
             }
-        }
+        })
+    except Exception as e:
+        return {"error": f"Error reading historical data: {str(e)}"}
+
+@app.get("/logs/historical-data")
+async def get_historical_data(request: Request, days: int = 7):
+    """Get historical energy data from logs for specified number of days"""
+    if not ENERGY_MONITOR_LOG_PATH.exists() and not energy_log.segment_paths():
+        return {"error": "Energy monitor log file not found"}
+    try:
+        token = await asyncio.to_thread(energy_log_version)
     except Exception as e:
         return {"error": f"Error reading historical data: {str(e)}"}
+    return await cached_response(request, token, lambda: historical_data(days), RESPONSE_CACHE_NOW_TTL)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Appliance registry: one row per appliance instead of a name in every reading
+
+The appliances table holds each appliance's name and, for the sampler's CT
+clamps, its ADC channel, calibration and nominal voltage. Writers register
+an appliance when they first see it or its name changes (energy_monitor.py
+at startup with its APPLIANCES config, the BufferedWriter, /ingest and the
+aggregator). Readings are then stored with appliance_name NULL, so a usage
+row is just the id, times and watts.
+
+Migration 10 fills the registry from the names already stored in usage, and
+migration 11 clears them in resumable chunks. Readers take names from the
+registry, falling back to usage.appliance_name for rows written by older
+scripts.
+
+Ids from RESERVED_ID_START up are never chosen by a writer: reserve() hands
+them out in blocks to components that create appliances of their own (the
+aggregator's node appliances), so their ids cannot collide with a sampled
+or ingested appliance or with each other.
+
+The API keeps an ApplianceRegistry in memory, reloaded by the latest-reading
+cache whenever the database changes, so /appliances never queries SQLite.
+
+    python3 appliances.py list
+    python3 appliances.py rename 5 "Desk Plug"
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from latest_cache import APPLIANCE_IDS_SQL
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+DB_PATH = SCRIPT_DIR / "energy_data.db"
+
+SELECT_SQL = '''
+    SELECT id, name, channel, calibration, nominal_voltage, source, updated_ts
+    FROM appliances ORDER BY id
+'''
+
+NAME_SQL = "SELECT name FROM appliances WHERE id = ?"
+
+RESERVED_ID_START = 100000  # reserve() hands out ids from here up; writers choose ids below it
+
+# Metadata left out (None) keeps what is already registered
+REGISTER_SQL = '''
+    INSERT INTO appliances (id, name, channel, calibration, nominal_voltage, source, updated_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        name = excluded.name,
+        channel = COALESCE(excluded.channel, channel),
+        calibration = COALESCE(excluded.calibration, calibration),
+        nominal_voltage = COALESCE(excluded.nominal_voltage, nominal_voltage),
+        source = COALESCE(excluded.source, source),
+        updated_ts = excluded.updated_ts
+'''
+
+ENSURE_SQL = '''
+    INSERT OR IGNORE INTO appliances (id, name, source, updated_ts) VALUES (?, ?, ?, ?)
+'''
+
+NEWEST_NAME_SQL = '''
+    SELECT appliance_name FROM usage
+    WHERE appliance_id = ? AND appliance_name IS NOT NULL ORDER BY ts DESC LIMIT 1
+'''
+
+
+def create_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS appliances (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        channel INTEGER,
+        calibration REAL,
+        nominal_voltage REAL,
+        source TEXT,
+        updated_ts INTEGER
+    )''')
+
+
+def create_block_table(conn):
+    """Appliance id blocks handed out by reserve()"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS appliance_id_blocks (
+        owner TEXT PRIMARY KEY,
+        first_id INTEGER NOT NULL UNIQUE,
+        size INTEGER NOT NULL
+    )''')
+
+
+def reserve(conn, owner, size=1):
+    """First of size consecutive appliance ids kept for owner, e.g. "node:garage:1"
+
+    Blocks are handed out from RESERVED_ID_START up and never reused, so an
+    owner gets the same ids back every time. Call it in the transaction that
+    first stores readings under the ids, so a rollback releases them too.
+    """
+    create_block_table(conn)
+    row = reserved(conn, owner)
+    if row is not None:
+        if row[1] < size:
+            raise ValueError(f"{owner} has {row[1]} appliance ids reserved, {size} requested")
+        return row[0]
+    # Past every block and any appliance registered in the range before it was reserved
+    first = max(
+        RESERVED_ID_START,
+        conn.execute("SELECT MAX(first_id + size) FROM appliance_id_blocks").fetchone()[0] or 0,
+        (conn.execute("SELECT MAX(id) FROM appliances WHERE id >= ?", (RESERVED_ID_START,)).fetchone()[0] or 0) + 1,
+    )
+    conn.execute("INSERT INTO appliance_id_blocks (owner, first_id, size) VALUES (?, ?, ?)", (owner, first, size))
+    return first
+
+
+def reserved(conn, owner):
+    """(first_id, size) of owner's block, or None, without reserving one"""
+    try:
+        return conn.execute(
+            "SELECT first_id, size FROM appliance_id_blocks WHERE owner = ?", (owner,)
+        ).fetchone()
+    except sqlite3.OperationalError:  # No block handed out yet
+        return None
+
+
+def default_name(appliance_id):
+    return f"Appliance {appliance_id}"
+
+
+def register(conn, appliance_id, name, channel=None, calibration=None, nominal_voltage=None,
+             source=None):
+    """Add an appliance, or rename it and update the metadata given"""
+    conn.execute(REGISTER_SQL, (
+        appliance_id, name, channel, calibration, nominal_voltage, source, int(time.time())
+    ))
+
+
+def ensure(conn, appliance_id, source=None, name=None):
+    """Register appliance_id under name, or its default name, unless it already is"""
+    conn.execute(ENSURE_SQL, (appliance_id, name or default_name(appliance_id), source, int(time.time())))
+
+
+def backfill(conn):
+    """Register every appliance in usage under its newest stored name, returns how many"""
+    ids = [row[0] for row in conn.execute(APPLIANCE_IDS_SQL).fetchall()]
+    for appliance_id in ids:
+        row = conn.execute(NEWEST_NAME_SQL, (appliance_id,)).fetchone()
+        conn.execute(ENSURE_SQL, (
+            appliance_id, row[0] if row else default_name(appliance_id), "usage", int(time.time())
+        ))
+    return len(ids)
+
+
+def row_to_dict(row):
+    appliance_id, name, channel, calibration, nominal_voltage, source, updated_ts = row
+    return {
+        "id": appliance_id,
+        "name": name,
+        "channel": channel,
+        "calibration": calibration,
+        "nominal_voltage": nominal_voltage,
+        "source": source,
+        "updated_ts": updated_ts,
+    }
+
+
+class ApplianceRegistry:
+    """In-memory copy of the appliances table with a pre-serialised /appliances body"""
+
+    def __init__(self):
+        self._rows = None
+        self._names = {}
+        self._sources = {}
+        self.appliances = []
+        self.body = b'{"appliances":[]}'
+
+    @property
+    def loaded(self):
+        return self._rows is not None
+
+    def load(self, conn):
+        """Re-read the table, returns the ids whose name changed"""
+        rows = conn.execute(SELECT_SQL).fetchall()
+        if rows == self._rows:
+            return set()
+        names = {row[0]: row[1] for row in rows}
+        changed = {
+            appliance_id for appliance_id in names.keys() | self._names.keys()
+            if names.get(appliance_id) != self._names.get(appliance_id)
+        }
+        self.appliances = [row_to_dict(row) for row in rows]
+        self.body = json.dumps({"appliances": self.appliances}, separators=(",", ":")).encode()
+        self._names = names
+        self._sources = {row[0]: row[5] for row in rows}
+        self._rows = rows
+        return changed
+
+    def name(self, appliance_id, default=None):
+        return self._names.get(appliance_id, default)
+
+    def source(self, appliance_id):
+        return self._sources.get(appliance_id)
+
+
+def print_appliances(db_path):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        for row in conn.execute(SELECT_SQL):
+            appliance = row_to_dict(row)
+            details = ", ".join(
+                f"{key} {appliance[key]}" for key in ("channel", "calibration", "nominal_voltage", "source")
+                if appliance[key] is not None
+            )
+            print(f"{appliance['id']:>4}  {appliance['name']}" + (f"  ({details})" if details else ""))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Appliance registry")
+    parser.add_argument("command", choices=["list", "rename"],
+                        help="list: show registered appliances, rename ID NAME: change a name")
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    args = parser.parse_args()
+
+    if args.command == "rename":
+        if len(args.args) != 2 or not args.args[0].isdigit():
+            parser.error("rename takes an appliance id and a name")
+        conn = sqlite3.connect(str(args.db))
+        with conn:
+            register(conn, int(args.args[0]), args.args[1])
+        conn.close()
+    print_appliances(args.db)
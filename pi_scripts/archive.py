@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+Columnar archive of old readings
+
+Readings older than ARCHIVE_AFTER_DAYS are moved out of the usage table into
+one chunk file per appliance per local day:
+
+    archive/<appliance_id>/<YYYY-MM-DD>.ema
+
+A chunk is a 32-byte header followed by two little-endian arrays: the
+delta-encoded timestamps (uint16, or uint32 when a gap exceeds 18 hours;
+the first delta is from local midnight) and float32 watts. That is 6 bytes
+per reading instead of a SQLite row with a text timestamp and the appliance
+name. Chunks are memory-mapped for reads and decoded chunks are cached.
+
+Run periodically, e.g. nightly from cron:
+
+    python3 archive.py                  # Archive days older than ARCHIVE_AFTER_DAYS
+    python3 archive.py --days 7
+    python3 archive.py --status
+
+The rollup tables keep covering archived days; rollups.py rebuild replays
+the archive before the usage table.
+"""
+
+import argparse
+import functools
+import heapq
+import logging
+import os
+import sqlite3
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+
+import rollups
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+DB_PATH = SCRIPT_DIR / "energy_data.db"
+ARCHIVE_DIR = SCRIPT_DIR / "archive"
+
+ARCHIVE_AFTER_DAYS = 30
+DEFAULT_PAUSE = 0.05  # Seconds between appliance-days, lets the sampler get the write lock
+DECODED_CACHE_SIZE = 64  # Decoded chunks kept in memory
+
+MAGIC = b"EMA1"
+# magic, delta width in bytes, appliance_id, day start (epoch), reading count
+HEADER = struct.Struct("<4sB3xqqI4x")
+CHUNK_SUFFIX = ".ema"
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+logger = logging.getLogger(__name__)
+
+
+def _align4(n):
+    return (n + 3) & ~3
+
+
+def write_chunk(path, appliance_id, day_start, ts, watts):
+    """Write sorted, de-duplicated readings of one appliance-day atomically"""
+    ts = np.asarray(ts, dtype=np.int64)
+    watts = np.asarray(watts, dtype=np.float32)
+    ts, first = np.unique(ts, return_index=True)  # Sorted, first copy of each ts wins
+    watts = watts[first]
+
+    deltas = np.diff(ts, prepend=day_start)
+    width = 2 if len(deltas) == 0 or deltas.max() <= np.iinfo(np.uint16).max else 4
+    delta_bytes = deltas.astype(f"<u{width}").tobytes()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, width, appliance_id, day_start, len(ts)))
+        f.write(delta_bytes.ljust(_align4(len(delta_bytes)), b"\0"))
+        f.write(watts.astype("<f4").tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(ts)
+
+
+@functools.lru_cache(maxsize=DECODED_CACHE_SIZE)
+def _decode(path, mtime_ns):
+    with open(path, "rb") as f:
+        magic, width, _, day_start, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not an archive chunk")
+    if count == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    deltas = np.frombuffer(mm, dtype=f"<u{width}", count=count, offset=HEADER.size)
+    ts = day_start + np.cumsum(deltas, dtype=np.int64)
+    # The watts stay a read-only view of the mapped file
+    watts = np.frombuffer(mm, dtype="<f4", count=count,
+                          offset=HEADER.size + _align4(count * width))
+    return ts, watts
+
+
+def read_chunk(path):
+    """(ts int64, watts float32) arrays of one chunk file"""
+    return _decode(str(path), os.stat(path).st_mtime_ns)
+
+
+def _day_from_name(name):
+    return int(time.mktime(time.strptime(name[:-len(CHUNK_SUFFIX)], "%Y-%m-%d")))
+
+
+class Archive:
+    """Read and write access to the chunk files under one directory"""
+
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = Path(root)
+        self._days = {}  # appliance_id -> (directory mtime, sorted day starts)
+
+    def chunk_path(self, appliance_id, day_start):
+        name = time.strftime("%Y-%m-%d", time.localtime(day_start)) + CHUNK_SUFFIX
+        return self.root / str(appliance_id) / name
+
+    def days(self, appliance_id):
+        """Sorted start times of every archived day of appliance_id"""
+        directory = self.root / str(appliance_id)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        cached = self._days.get(appliance_id)
+        if cached is None or cached[0] != mtime:
+            days = sorted(
+                _day_from_name(name) for name in os.listdir(directory)
+                if name.endswith(CHUNK_SUFFIX)
+            )
+            cached = self._days[appliance_id] = (mtime, days)
+        return cached[1]
+
+    def appliances(self):
+        try:
+            return sorted(int(name) for name in os.listdir(self.root) if name.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def read_day(self, appliance_id, day_start):
+        return read_chunk(self.chunk_path(appliance_id, day_start))
+
+    def read_range(self, appliance_id, start, end):
+        """Archived readings with start <= ts < end, oldest first"""
+        ts_parts, watts_parts = [], []
+        for day in self.days(appliance_id):
+            # A chunk only holds its own local day, which is at most 25 hours long
+            if day >= end or day + 25 * 3600 <= start:
+                continue
+            ts, watts = self.read_day(appliance_id, day)
+            lo, hi = np.searchsorted(ts, [start, end])
+            ts_parts.append(ts[lo:hi])
+            watts_parts.append(watts[lo:hi])
+        if not ts_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(ts_parts), np.concatenate(watts_parts)
+
+    def iter_newest_first(self, appliance_id, before=None):
+        """Yield (timestamp, watts, ts) rows with ts < before, newest first, a day at a time"""
+        for day in reversed(self.days(appliance_id)):
+            if before is not None and day >= before:
+                continue
+            ts, watts = self.read_day(appliance_id, day)
+            hi = len(ts) if before is None else np.searchsorted(ts, before)
+            for t, w in zip(ts[:hi][::-1].tolist(), watts[:hi][::-1].tolist()):
+                yield time.strftime(TIMESTAMP_FORMAT, time.localtime(t)), w, t
+
+    def iter_range(self, appliance_id, start, end):
+        """Yield (timestamp, watts, ts) rows with start <= ts < end, oldest first, a day at a time"""
+        for day in self.days(appliance_id):
+            if day >= end or day + 25 * 3600 <= start:
+                continue
+            ts, watts = self.read_day(appliance_id, day)
+            lo, hi = np.searchsorted(ts, [start, end])
+            for t, w in zip(ts[lo:hi].tolist(), watts[lo:hi].tolist()):
+                yield time.strftime(TIMESTAMP_FORMAT, time.localtime(t)), w, t
+
+    def stats(self):
+        chunks = 0
+        size = 0
+        for appliance_id in self.appliances():
+            for day in self.days(appliance_id):
+                chunks += 1
+                size += os.path.getsize(self.chunk_path(appliance_id, day))
+        return {"chunks": chunks, "bytes": size, "appliances": len(self.appliances())}
+
+
+def merge_newest_first(*sources):
+    """Merge (timestamp, watts, ts) row iterables that are each sorted newest first"""
+    return heapq.merge(*sources, key=lambda row: row[2], reverse=True)
+
+
+def merge_oldest_first(*sources):
+    """Merge (timestamp, watts, ts) row iterables that are each sorted oldest first"""
+    return heapq.merge(*sources, key=lambda row: row[2])
+
+
+def archive_day(conn, archive, appliance_id, day_start, day_end):
+    """Move one appliance-day from usage into its chunk, returns rows moved
+
+    The SELECT, the chunk write and the DELETE share one write transaction,
+    so a reading written for that day in between (a backfill through
+    /ingest or the aggregator) cannot be deleted without being archived.
+    The chunk is written (merged with any existing one) before the rows are
+    deleted, so an interruption at worst leaves rows in both places, which
+    the next run de-duplicates.
+
+    conn must be in autocommit mode (isolation_level=None).
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = np.fromiter(
+            conn.execute(
+                "SELECT ts, watts FROM usage WHERE appliance_id = ? AND ts >= ? AND ts < ?",
+                (appliance_id, day_start, day_end)
+            ),
+            dtype=[("ts", "i8"), ("watts", "f8")]
+        )
+        if len(rows) == 0:
+            conn.execute("ROLLBACK")
+            return 0
+
+        ts, watts = rows["ts"], rows["watts"]
+        path = archive.chunk_path(appliance_id, day_start)
+        if path.exists():
+            old_ts, old_watts = read_chunk(path)
+            ts = np.concatenate((ts, old_ts))
+            watts = np.concatenate((watts, old_watts))
+        write_chunk(path, appliance_id, day_start, ts, watts)
+
+        conn.execute(
+            "DELETE FROM usage WHERE appliance_id = ? AND ts >= ? AND ts < ?",
+            (appliance_id, day_start, day_end)
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+def replay_rollups(conn, archive, maintainer):
+    """Feed every archived reading through a RollupMaintainer, one day per transaction
+
+    conn must be in autocommit mode (isolation_level=None).
+    """
+    total = 0
+    for appliance_id in archive.appliances():
+        for day in archive.days(appliance_id):
+            ts, watts = archive.read_day(appliance_id, day)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                maintainer(conn, zip([appliance_id] * len(ts), ts.tolist(), watts.tolist()))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            total += len(ts)
+    return total
+
+
+def archive_old_readings(db_path=DB_PATH, root=ARCHIVE_DIR, days=ARCHIVE_AFTER_DAYS,
+                         pause=DEFAULT_PAUSE):
+    """Archive every whole local day that ended more than days ago"""
+    archive = Archive(root)
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
+    try:
+        conn.execute("PRAGMA busy_timeout = 5000")
+        cutoff = rollups.local_day_start(int(time.time()) - days * 86400)
+        appliances = conn.execute(
+            "SELECT appliance_id, MIN(ts) FROM usage WHERE ts < ? GROUP BY appliance_id",
+            (cutoff,)
+        ).fetchall()
+
+        total = 0
+        for appliance_id, oldest in appliances:
+            day = rollups.local_day_start(oldest)
+            while day < cutoff:
+                next_day = rollups.local_day_start(day + 26 * 3600)
+                moved = archive_day(conn, archive, appliance_id, day, next_day)
+                if moved:
+                    total += moved
+                    logger.info(f"Archived {moved} readings of appliance {appliance_id} "
+                                f"for {time.strftime('%Y-%m-%d', time.localtime(day))}")
+                    if pause:
+                        time.sleep(pause)
+                day = next_day
+        logger.info(f"Archive complete: {total} readings moved")
+        return total
+    finally:
+        conn.close()
+
+
+def print_status(root=ARCHIVE_DIR):
+    archive = Archive(root)
+    for appliance_id in archive.appliances():
+        days = archive.days(appliance_id)
+        first = time.strftime("%Y-%m-%d", time.localtime(days[0])) if days else "-"
+        last = time.strftime("%Y-%m-%d", time.localtime(days[-1])) if days else "-"
+        print(f"Appliance {appliance_id}: {len(days)} days ({first} .. {last})")
+    stats = archive.stats()
+    print(f"{stats['chunks']} chunks, {stats['bytes'] / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old readings into the columnar archive")
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    parser.add_argument("--root", default=str(ARCHIVE_DIR), help="Archive directory")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                        help="Keep this many days of readings in the database")
+    parser.add_argument("--pause", type=float, default=DEFAULT_PAUSE)
+    parser.add_argument("--status", action="store_true", help="Show archived days and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.status:
+        print_status(args.root)
+    else:
+        archive_old_readings(args.db, args.root, days=args.days, pause=args.pause)
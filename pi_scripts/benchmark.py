@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the API and storage layer
+
+Generates a synthetic dataset (usage table, rollups, kWh totals, optionally
+archived days, and both log files) at a chosen size, then calls every endpoint of
+api.py in-process through an ASGI client at a fixed concurrency and records
+p50/p99 latency, throughput and peak RSS to a JSON file. No server, Pi or
+sensor is needed, and runs on the same dataset are comparable.
+
+    python3 benchmark.py                          # 1M rows, writes benchmark_baseline.json
+    python3 benchmark.py --rows 10000000 --concurrency 8
+    python3 benchmark.py --compare benchmark_baseline.json
+
+The dataset is kept in benchmark_data/ and only regenerated when its
+parameters change (or with --regenerate). With --compare the run is checked
+against an earlier result file and the exit status is 1 if any endpoint got
+slower than the tolerance allows.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+import archive
+import consumption
+import disaggregate
+import events
+import forecast
+import ingest
+import rollups
+from appliances import register as register_appliance
+from db_writer import INSERT_SQL, BufferedWriter, configure_connection
+from migrate_database import LATEST_VERSION, run_migrations
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+WORK_DIR = SCRIPT_DIR / "benchmark_data"
+BASELINE_PATH = SCRIPT_DIR / "benchmark_baseline.json"
+
+DEFAULT_ROWS = 1_000_000
+DEFAULT_APPLIANCES = 2
+DEFAULT_INTERVAL = 5  # Seconds between synthetic readings of one appliance
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS = 50  # Timed requests per endpoint
+DEFAULT_WARMUP = 3  # Untimed requests per endpoint, fill caches and indexes
+DEFAULT_BUDGET = 60.0  # Seconds per endpoint after which no new requests are started
+DEFAULT_TOLERANCE = 0.25  # --compare fails when p50/p99 grow (or throughput drops) by more
+WRITE_ROWS = 100_000  # Rows inserted through BufferedWriter for the storage write figure
+INSERT_CHUNK = 100_000  # Rows per transaction while generating
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+MANIFEST_NAME = "dataset.json"
+
+# Endpoints that never finish a response; the ASGI client buffers whole bodies
+SKIPPED_ROUTES = {
+    "/energy/stream": "unbounded SSE stream",
+    "/energy/stream/ws": "WebSocket stream",
+    "/ingest": "POST, measured by benchmark_ingest",
+}
+
+
+def synthetic_watts(ts, appliance_id, rng):
+    """Daily load curve plus noise and the odd spike, rounded like the sampler"""
+    hour_angle = 2 * np.pi * (ts % 86400) / 86400
+    watts = (40 + 15 * appliance_id) * (1.2 - np.cos(hour_angle)) + rng.normal(0, 5, len(ts))
+    spikes = rng.random(len(ts)) < 0.001
+    watts[spikes] += rng.uniform(500, 2000, spikes.sum())
+    return np.round(np.clip(watts, 0, None), 2)
+
+
+def generate_usage(db_path, rows, appliances, interval, end, seed=0):
+    """Fill a fresh database with rows readings split over appliances, ending at end"""
+    rng = np.random.default_rng(seed)
+    per_appliance = rows // appliances
+    start = end - per_appliance * interval
+
+    conn = sqlite3.connect(str(db_path))
+    try:
+        configure_connection(conn)
+        run_migrations(conn, pause=0)
+        for appliance_id in range(1, appliances + 1):
+            with conn:
+                register_appliance(conn, appliance_id, f"Appliance {appliance_id}", source="benchmark")
+            for offset in range(0, per_appliance, INSERT_CHUNK):
+                n = min(INSERT_CHUNK, per_appliance - offset)
+                ts = start + (offset + np.arange(n, dtype=np.int64)) * interval
+                watts = synthetic_watts(ts, appliance_id, rng)
+                with conn:
+                    conn.executemany(INSERT_SQL, (
+                        (time.strftime(TIMESTAMP_FORMAT, time.localtime(t)), t, w, appliance_id)
+                        for t, w in zip(ts.tolist(), watts.tolist())
+                    ))
+    finally:
+        conn.close()
+    return start
+
+
+def generate_events(db_path):
+    """Run the event detector over every reading, as the sampler's sink would have"""
+    detector = events.EventDetector()
+    conn = sqlite3.connect(str(db_path))
+    try:
+        found = []
+        names = dict(conn.execute("SELECT id, name FROM appliances"))
+        rows = conn.execute("SELECT ts, appliance_id, watts FROM usage ORDER BY ts")
+        for ts, appliance_id, watts in rows:
+            found.extend(detector.update(ts, appliance_id, watts, names.get(appliance_id)))
+        with conn:
+            conn.executemany(events.INSERT_SQL, found)
+    finally:
+        conn.close()
+    return len(found)
+
+
+def generate_logs(data_dir, lines, start, end, seed=0):
+    """energy_monitor.log and api.log with lines records each, spread over start..end"""
+    rng = np.random.default_rng(seed)
+    step = max((end - start) / max(lines, 1), 0.001)
+    paths = ["/energy", "/energy/history", "/appliances", "/logs/summary", "/energy/rollup"]
+
+    with open(data_dir / "energy_monitor.log", "w") as energy, open(data_dir / "api.log", "w") as api:
+        for offset in range(0, lines, INSERT_CHUNK):
+            n = min(INSERT_CHUNK, lines - offset)
+            ts = (start + (offset + np.arange(n)) * step).astype(np.int64)
+            watts = synthetic_watts(ts, 1, rng)
+            path_index = rng.integers(0, len(paths), n)
+            energy_lines = []
+            api_lines = []
+            for t, w, p in zip(ts.tolist(), watts.tolist(), path_index.tolist()):
+                stamp = time.strftime(TIMESTAMP_FORMAT, time.localtime(t))
+                energy_lines.append(
+                    f"{stamp},000 - INFO - Time: {stamp}, Power: {w:.2f} W, Appliance: 1\n"
+                )
+                api_lines.append(
+                    f"{stamp},000 - 192.168.1.20:51234 - GET {paths[p]} HTTP/1.1 - 200\n"
+                )
+            energy.write("".join(energy_lines))
+            api.write("".join(api_lines))
+
+
+def prepare_dataset(data_dir, rows, appliances, interval, log_lines, archive_days,
+                    regenerate=False):
+    """Generate the dataset unless data_dir already holds one with these parameters"""
+    params = {
+        "rows": rows,
+        "appliances": appliances,
+        "interval": interval,
+        "log_lines": log_lines,
+        "archive_days": archive_days,
+        "schema": LATEST_VERSION,  # Regenerate after a migration changes the layout
+    }
+    manifest_path = data_dir / MANIFEST_NAME
+    if not regenerate and manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["params"] == params:
+            print(f"Reusing dataset in {data_dir}")
+            return manifest
+
+    if data_dir.exists():
+        shutil.rmtree(data_dir)
+    data_dir.mkdir(parents=True)
+    db_path = data_dir / "energy_data.db"
+    end = int(time.time())
+    timings = {}
+
+    print(f"Generating {rows} readings for {appliances} appliances...")
+    t0 = time.perf_counter()
+    start = generate_usage(db_path, rows, appliances, interval, end)
+    timings["usage_s"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    rollups.rebuild(db_path, pause=0, archive_root=data_dir / "archive")
+    timings["rollups_s"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    consumption.rebuild(db_path, archive_root=data_dir / "archive", pause=0)
+    timings["consumption_s"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    generate_events(db_path)
+    timings["events_s"] = time.perf_counter() - t0
+
+    # Saved models are loaded when the API starts, so /energy/forecast is ready at once
+    t0 = time.perf_counter()
+    forecaster = forecast.Forecaster(db_path, clock=lambda: end)
+    forecaster.update()
+    forecaster.close()
+    timings["forecast_s"] = time.perf_counter() - t0
+
+    # Disaggregated estimates, which the whole-house consumption cases have to leave out
+    t0 = time.perf_counter()
+    disaggregate.backfill(db_path)
+    timings["disaggregate_s"] = time.perf_counter() - t0
+
+    if archive_days is not None:
+        print(f"Archiving readings older than {archive_days} days...")
+        t0 = time.perf_counter()
+        archive.archive_old_readings(db_path, data_dir / "archive", days=archive_days, pause=0)
+        timings["archive_s"] = time.perf_counter() - t0
+
+    print(f"Generating {log_lines} log lines per log file...")
+    t0 = time.perf_counter()
+    generate_logs(data_dir, log_lines, start, end)
+    timings["logs_s"] = time.perf_counter() - t0
+
+    manifest = {
+        "params": params,
+        "start": start,
+        "end": end,
+        "db_bytes": db_path.stat().st_size,
+        "generate": {k: round(v, 2) for k, v in timings.items()},
+    }
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def benchmark_writes(data_dir, rows=WRITE_ROWS):
+    """Rows per second through BufferedWriter with rollup maintenance, on a scratch database"""
+    db_path = data_dir / "write_bench.db"
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+
+    conn = sqlite3.connect(str(db_path))
+    try:
+        configure_connection(conn)
+        run_migrations(conn, pause=0)
+        writer = BufferedWriter(conn, hooks=[rollups.RollupMaintainer()])
+        base = int(time.time()) - rows
+        t0 = time.perf_counter()
+        for i in range(rows):
+            ts = base + i
+            writer.add(time.strftime(TIMESTAMP_FORMAT, time.localtime(ts)), float(i % 1000), ts=ts)
+        writer.close()
+        elapsed = time.perf_counter() - t0
+    finally:
+        conn.close()
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+    return {"rows": rows, "seconds": round(elapsed, 3), "rows_per_s": round(rows / elapsed)}
+
+
+def benchmark_ingest(data_dir, rows=WRITE_ROWS, batch=10000):
+    """Rows per second through ingest.parse and Ingestor.write, NDJSON and binary, on a scratch database"""
+    db_path = data_dir / "ingest_bench.db"
+    base = int(time.time()) - rows
+    records = np.zeros(rows, dtype=ingest.BINARY_RECORD)
+    records["appliance_id"] = 1 + np.arange(rows) % 4
+    records["ts"] = base + np.arange(rows) // 4 * 4
+    records["watts"] = np.arange(rows) % 1000
+    bodies = {
+        "binary": (ingest.BINARY_TYPES[0], [
+            records[i:i + batch].tobytes() for i in range(0, rows, batch)
+        ]),
+        "ndjson": (ingest.NDJSON_TYPES[0], [
+            "\n".join(
+                json.dumps({"appliance_id": int(r["appliance_id"]), "ts": int(r["ts"]), "watts": float(r["watts"])})
+                for r in records[i:i + batch]
+            ).encode() for i in range(0, rows, batch)
+        ]),
+    }
+
+    results = {}
+    for name, (content_type, batches) in bodies.items():
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+        conn = sqlite3.connect(str(db_path))
+        configure_connection(conn)
+        run_migrations(conn, pause=0)
+        conn.close()
+        ingestor = ingest.Ingestor(db_path, hooks=[rollups.RollupMaintainer()])
+        try:
+            t0 = time.perf_counter()
+            for body in batches:
+                ingestor.write(ingest.parse(body, content_type, now=base + rows))
+            elapsed = time.perf_counter() - t0
+        finally:
+            ingestor.close()
+        results[name] = {"rows": rows, "seconds": round(elapsed, 3), "rows_per_s": round(rows / elapsed)}
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+    return results
+
+
+def endpoint_cases(manifest):
+    """(name, url) of every benchmarked request, built around the dataset's time span"""
+    start, end = manifest["start"], manifest["end"]
+    day = end - 86400
+    week = end - 7 * 86400
+    middle = (start + end) // 2
+    return [
+        ("root", "/"),
+        ("health", "/health"),
+        ("stats_db", "/stats/db"),
+        ("metrics", "/metrics"),
+        ("appliances", "/appliances"),
+        ("energy", "/energy"),
+        ("energy_appliance", "/energy/1"),
+        ("history", "/energy/history"),
+        ("history_page", "/energy/history/1?limit=100"),
+        ("history_deep_page", f"/energy/history/1?limit=100&after={middle}"),
+        ("history_ndjson", "/energy/history/1?format=ndjson&limit=5000"),
+        ("history_page_columns", "/energy/history/1?limit=1000&format=columns"),
+        ("history_page_binary", "/energy/history/1?limit=1000&format=binary"),
+        ("history_range_day", f"/energy/history/1?from={day}&to={end}&points=500"),
+        ("history_range_day_columns", f"/energy/history/1?from={day}&to={end}&points=500&format=columns"),
+        ("history_range_day_binary", f"/energy/history/1?from={day}&to={end}&points=500&format=binary"),
+        ("history_range_week_lttb", f"/energy/history/1?from={week}&to={end}&points=500&method=lttb"),
+        ("history_range_all", f"/energy/history?from={start}&to={end}&points=1000"),
+        ("rollup_minute", f"/energy/rollup?resolution=minute&from={day}&to={end}"),
+        ("rollup_hour", f"/energy/rollup?resolution=hour&from={week}&to={end}"),
+        ("rollup_hour_columns", f"/energy/rollup?resolution=hour&from={week}&to={end}&format=columns"),
+        ("rollup_day", f"/energy/rollup?resolution=day&from={start}&to={end}"),
+        ("consumption_day", "/energy/consumption"),
+        ("consumption_year_appliance", "/energy/consumption?period=year&appliance_id=1"),
+        ("forecast_day", "/energy/forecast"),
+        ("forecast_week", "/energy/forecast?hours=168"),
+        ("export_csv_day", f"/export?from={day}&to={end}"),
+        ("export_ndjson_day", f"/export?from={day}&to={end}&format=ndjson"),
+        ("events", "/events"),
+        ("events_appliance_kind", "/events?appliance_id=1&kind=on,off"),
+        ("sync_readings", "/sync/readings"),
+        ("nodes", "/nodes"),
+        ("nodes_energy", "/nodes/energy"),
+        ("nodes_consumption", "/nodes/consumption?period=month"),
+        ("logs_energy", "/logs/energy-monitor"),
+        ("logs_energy_ndjson", "/logs/energy-monitor?format=ndjson&limit=10000"),
+        ("logs_energy_columns", "/logs/energy-monitor?format=columns"),
+        ("logs_api", "/logs/api"),
+        ("logs_summary", "/logs/summary"),
+        ("logs_historical", "/logs/historical-data"),
+        ("logs_historical_day", "/logs/historical-data?days=1"),
+        ("logs_download_energy", "/logs/download/energy-monitor"),
+        ("logs_download_api", "/logs/download/api"),
+    ]
+
+
+def uncovered_routes(app, cases, module="api"):
+    """Paths of the API's own routes that no case requests (and are not skipped)"""
+    paths = [url.split("?")[0] for _, url in cases]
+    missing = []
+    for route in app.routes:
+        endpoint = getattr(route, "endpoint", None)
+        if endpoint is None or endpoint.__module__ != module or route.path in SKIPPED_ROUTES:
+            continue
+        if not any(route.path_regex.match(path) for path in paths):
+            missing.append(route.path)
+    return missing
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # Bytes on macOS, KiB elsewhere
+
+
+def is_error(response):
+    # Several endpoints report failures as a 200 {"error": ...} body
+    return response.status_code >= 400 or response.content.startswith(b'{"error"')
+
+
+async def run_case(client, url, requests, concurrency, warmup, budget=DEFAULT_BUDGET):
+    for _ in range(warmup):
+        await client.get(url)
+
+    latencies = []
+    errors = 0
+    body_bytes = 0
+    wire_bytes = 0
+    remaining = iter(range(requests))  # Shared by the workers, each takes the next request
+
+    async def worker():
+        nonlocal errors, body_bytes, wire_bytes
+        for _ in remaining:
+            if time.perf_counter() > deadline:
+                break
+            t0 = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - t0)
+            errors += is_error(response)
+            body_bytes += len(response.content)
+            wire_bytes += response.num_bytes_downloaded  # Before Content-Encoding is undone
+
+    t0 = time.perf_counter()
+    deadline = t0 + budget
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+
+    requests = len(latencies)
+    ms = np.array(latencies) * 1000
+    return {
+        "url": url,
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "max_ms": round(float(ms.max()), 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "bytes_per_response": body_bytes // requests,
+        "wire_bytes_per_response": wire_bytes // requests,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def load_api(data_dir):
+    """Import api.py serving data_dir"""
+    if "api" in sys.modules:
+        api = sys.modules["api"]
+        if api.DATA_DIR != Path(data_dir):
+            raise RuntimeError(f"api is already loaded for {api.DATA_DIR}")
+        return api
+
+    previous = os.environ.get("ENERGY_DATA_DIR")
+    os.environ["ENERGY_DATA_DIR"] = str(data_dir)
+    try:
+        return importlib.import_module("api")
+    finally:
+        if previous is None:
+            del os.environ["ENERGY_DATA_DIR"]
+        else:
+            os.environ["ENERGY_DATA_DIR"] = previous
+
+
+async def benchmark_endpoints(api, cases, requests, concurrency, warmup, budget, only=None):
+    import httpx
+
+    results = {}
+    await api.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for name, url in cases:
+                if only and name not in only:
+                    continue
+                results[name] = result = await run_case(
+                    client, url, requests, concurrency, warmup, budget
+                )
+                print(f"{name:<26} p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  "
+                      f"{result['throughput_rps']:>8.1f} req/s  {result['wire_bytes_per_response']:>9} B"
+                      + (f"  {result['errors']} errors" if result['errors'] else ""))
+    finally:
+        await api.app.router.shutdown()
+    return results
+
+
+def run(data_dir=WORK_DIR, rows=DEFAULT_ROWS, appliances=DEFAULT_APPLIANCES,
+        interval=DEFAULT_INTERVAL, log_lines=None, archive_days=None,
+        requests=DEFAULT_REQUESTS, concurrency=DEFAULT_CONCURRENCY, warmup=DEFAULT_WARMUP,
+        budget=DEFAULT_BUDGET, write_rows=WRITE_ROWS, only=None, regenerate=False):
+    """Prepare the dataset, run every benchmark and return the report"""
+    data_dir = Path(data_dir)
+    manifest = prepare_dataset(
+        data_dir, rows, appliances, interval, rows if log_lines is None else log_lines,
+        archive_days, regenerate
+    )
+
+    api = load_api(data_dir)
+    cases = endpoint_cases(manifest)
+    missing = uncovered_routes(api.app, cases)
+    if missing:
+        raise RuntimeError(f"No benchmark case for: {', '.join(missing)}")
+
+    storage = {"buffered_writes": benchmark_writes(data_dir, write_rows)} if write_rows else {}
+    if write_rows:
+        for name, result in benchmark_ingest(data_dir, write_rows).items():
+            storage[f"ingest_{name}"] = result
+    for name, result in storage.items():
+        print(f"{name:<26} {result['rows_per_s']} rows/s")
+    endpoints = asyncio.run(
+        benchmark_endpoints(api, cases, requests, concurrency, warmup, budget, only)
+    )
+
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "dataset": manifest,
+        "settings": {
+            "requests": requests, "concurrency": concurrency, "warmup": warmup, "budget": budget
+        },
+        "storage": storage,
+        "endpoints": endpoints,
+        "skipped": SKIPPED_ROUTES,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def compare(baseline, report, tolerance=DEFAULT_TOLERANCE):
+    """Regressions of report against baseline as (endpoint, metric, old, new) tuples"""
+    regressions = []
+    for name, new in report["endpoints"].items():
+        old = baseline.get("endpoints", {}).get(name)
+        if old is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if new[metric] > old[metric] * (1 + tolerance):
+                regressions.append((name, metric, old[metric], new[metric]))
+        if new["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append((name, "throughput_rps", old["throughput_rps"], new["throughput_rps"]))
+        if new["errors"] > old["errors"]:
+            regressions.append((name, "errors", old["errors"], new["errors"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API and storage layer")
+    parser.add_argument("--data-dir", default=str(WORK_DIR), help="Where the synthetic dataset is kept")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="Readings in the usage table")
+    parser.add_argument("--appliances", type=int, default=DEFAULT_APPLIANCES)
+    parser.add_argument("--interval", type=int, default=DEFAULT_INTERVAL,
+                        help="Seconds between readings of one appliance")
+    parser.add_argument("--log-lines", type=int, default=None,
+                        help="Lines per log file (default: same as --rows)")
+    parser.add_argument("--archive-days", type=int, default=None,
+                        help="Move readings older than this many days to the archive")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="Timed requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP)
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="Seconds per endpoint before it stops starting new requests")
+    parser.add_argument("--write-rows", type=int, default=WRITE_ROWS,
+                        help="Rows for the buffered write benchmark (0 to skip)")
+    parser.add_argument("--only", nargs="+", help="Only run these endpoint cases")
+    parser.add_argument("--regenerate", action="store_true", help="Rebuild the dataset")
+    parser.add_argument("--output", help=f"Result file (default: {BASELINE_PATH.name} unless --compare)")
+    parser.add_argument("--compare", help="Fail if slower than this earlier result file")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    report = run(
+        args.data_dir, rows=args.rows, appliances=args.appliances, interval=args.interval,
+        log_lines=args.log_lines, archive_days=args.archive_days, requests=args.requests,
+        concurrency=args.concurrency, warmup=args.warmup, budget=args.budget, write_rows=args.write_rows,
+        only=args.only, regenerate=args.regenerate,
+    )
+    print(f"Peak RSS: {report['peak_rss_kb'] / 1024:.1f} MiB")
+
+    output = args.output or (None if args.compare else BASELINE_PATH)
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Results written to {output}")
+
+    if args.compare:
+        regressions = compare(json.loads(Path(args.compare).read_text()), report, args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
@@ -0,0 +1,104 @@
+"""
+Fan-out of new readings to /energy/stream subscribers
+
+A single Broadcaster is fed by the latest-reading cache, which already
+reads every new row once per poll. Each reading's SSE frame is built once
+and the same bytes are queued for every subscriber, so the cost of a new
+client is one small queue rather than a database query. A subscriber that
+stops reading loses its oldest queued readings instead of holding memory or
+slowing the others.
+"""
+
+import asyncio
+
+DEFAULT_QUEUE_SIZE = 100  # Readings queued per subscriber before the oldest is dropped
+
+
+def sse_frame(entry):
+    """Server-Sent Events frame for one LatestEntry"""
+    return (
+        b"event: reading\nid: " + str(entry.ts).encode()
+        + b"\ndata: " + entry.appliance_body + b"\n\n"
+    )
+
+
+class Message:
+    """One reading as queued for subscribers"""
+
+    __slots__ = ("appliance_id", "body", "frame")
+
+    def __init__(self, entry):
+        self.appliance_id = entry.appliance_id
+        self.body = entry.appliance_body
+        self.frame = sse_frame(entry)
+
+
+class Subscription:
+    """Queue of messages for one client, optionally for a single appliance"""
+
+    def __init__(self, appliance_id=None, queue_size=DEFAULT_QUEUE_SIZE):
+        self.appliance_id = appliance_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def offer(self, message):
+        """Queue message without waiting, returns False if an old one was dropped"""
+        dropped = False
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            dropped = True
+        self.queue.put_nowait(message)
+        return not dropped
+
+    async def get(self, timeout=None):
+        """Next message, or None if nothing arrived within timeout seconds"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broadcaster:
+    """Delivers every published reading to every subscriber; event loop thread only"""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.peak_subscribers = 0
+
+    def subscribe(self, appliance_id=None):
+        subscription = Subscription(appliance_id, self.queue_size)
+        self._subscribers.add(subscription)
+        self.peak_subscribers = max(self.peak_subscribers, len(self._subscribers))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    def publish(self, entries):
+        """Fan a list of LatestEntry readings out to the subscribers"""
+        for entry in entries:
+            self.published += 1
+            if not self._subscribers:
+                continue
+            message = Message(entry)
+            for subscription in self._subscribers:
+                if subscription.appliance_id not in (None, message.appliance_id):
+                    continue
+                if not subscription.offer(message):
+                    self.dropped += 1
+                self.delivered += 1
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "peak_subscribers": self.peak_subscribers,
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Energy (kWh) accumulators and tariff costs
+
+The energy_totals table holds the running Wh of every appliance per local
+day, week (from Monday), month and year, split by tariff band. It is kept
+current by ConsumptionMaintainer, a BufferedWriter hook running in the
+sampler's flush transaction, so /energy/consumption reads a handful of
+rows whatever the period length.
+
+Energy is the trapezoidal integral of power between consecutive readings of
+an appliance, whatever their spacing. An interval that crosses a band or
+midnight boundary is split there, with the power interpolated at the
+boundary. Gaps longer than rollups.MAX_GAP are not integrated; the seconds
+that were integrated are stored alongside, so responses report coverage.
+
+Prices come from tariff.json and are applied when the API answers, so a
+price change takes effect immediately. Band times are applied as readings
+are written; after changing them run:
+
+    python3 consumption.py rebuild
+"""
+
+import argparse
+import bisect
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+import rollups
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+DB_PATH = SCRIPT_DIR / "energy_data.db"
+TARIFF_PATH = SCRIPT_DIR / "tariff.json"  # Not shipped, see tariff.example.json
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ("day", "week", "month", "year")
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+MINUTES_PER_DAY = 24 * 60
+
+UPSERT_SQL = '''
+    INSERT INTO energy_totals (appliance_id, period, period_start, band, wh, covered_s)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(appliance_id, period, period_start, band) DO UPDATE SET
+        wh = wh + excluded.wh,
+        covered_s = covered_s + excluded.covered_s
+'''
+
+QUERY_SQL = '''
+    SELECT appliance_id, band, wh, covered_s FROM energy_totals
+    WHERE period = ? AND period_start = ?
+'''
+
+
+def create_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS energy_totals (
+        appliance_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        period_start INTEGER NOT NULL,
+        band TEXT NOT NULL,
+        wh REAL NOT NULL,
+        covered_s INTEGER NOT NULL,
+        PRIMARY KEY (appliance_id, period, period_start, band)
+    ) WITHOUT ROWID''')
+
+
+def _local(year, month, day, hour=0, minute=0):
+    # mktime normalises out-of-range days and months, and resolves DST itself
+    return int(time.mktime((year, month, day, hour, minute, 0, 0, 0, -1)))
+
+
+def period_start(ts, period):
+    """Local start of the day/week/month/year containing ts"""
+    lt = time.localtime(ts)
+    if period == "day":
+        return _local(lt.tm_year, lt.tm_mon, lt.tm_mday)
+    if period == "week":
+        return _local(lt.tm_year, lt.tm_mon, lt.tm_mday - lt.tm_wday)
+    if period == "month":
+        return _local(lt.tm_year, lt.tm_mon, 1)
+    if period == "year":
+        return _local(lt.tm_year, 1, 1)
+    raise ValueError(f"period must be one of: {', '.join(PERIODS)}")
+
+
+def next_period_start(start, period):
+    lt = time.localtime(start)
+    if period == "day":
+        return _local(lt.tm_year, lt.tm_mon, lt.tm_mday + 1)
+    if period == "week":
+        return _local(lt.tm_year, lt.tm_mon, lt.tm_mday + 7)
+    if period == "month":
+        return _local(lt.tm_year, lt.tm_mon + 1, 1)
+    if period == "year":
+        return _local(lt.tm_year + 1, 1, 1)
+    raise ValueError(f"period must be one of: {', '.join(PERIODS)}")
+
+
+def _minute_of_day(text):
+    hours, minutes = text.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class Tariff:
+    """Prices per band and the local times each band applies
+
+    bands maps a band name to {"price_per_kwh": float, "times": [...]},
+    where each time is {"start": "HH:MM", "end": "HH:MM", "days": [...]}
+    (days optional, "mon".."sun"; an end at or before the start wraps past
+    midnight). Exactly one band has no times: it covers every other minute.
+    Where times overlap, the band listed first wins.
+    """
+
+    def __init__(self, bands, standing_charge_per_day=0.0, currency=""):
+        defaults = [name for name, band in bands.items() if not band.get("times")]
+        if len(defaults) != 1:
+            raise ValueError("Exactly one tariff band must have no times (the default band)")
+        self.bands = bands
+        self.standing_charge_per_day = standing_charge_per_day
+        self.currency = currency
+        self.default_band = defaults[0]
+
+        # Per weekday: minutes where the band changes, and the band from there on
+        self._schedules = []
+        for weekday in range(7):
+            minutes = [None] * MINUTES_PER_DAY
+            for name, band in bands.items():
+                for window in band.get("times", ()):
+                    days = window.get("days")
+                    if days is not None and WEEKDAYS[weekday] not in days:
+                        continue
+                    start = _minute_of_day(window["start"])
+                    end = _minute_of_day(window["end"])
+                    span = range(start, end) if end > start else \
+                        list(range(start, MINUTES_PER_DAY)) + list(range(0, end))
+                    for minute in span:
+                        if minutes[minute] is None:
+                            minutes[minute] = name
+            minutes = [band or self.default_band for band in minutes]
+            changes = [m for m in range(MINUTES_PER_DAY) if m == 0 or minutes[m] != minutes[m - 1]]
+            self._schedules.append((changes, [minutes[m] for m in changes]))
+
+        self._day = None  # Cached (day start, next day start, boundary times, bands)
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(
+            config["bands"],
+            standing_charge_per_day=config.get("standing_charge_per_day", 0.0),
+            currency=config.get("currency", ""),
+        )
+
+    def price(self, band):
+        """Price per kWh of band, None for a band no longer in the tariff"""
+        return self.bands.get(band, {}).get("price_per_kwh")
+
+    def _day_schedule(self, ts):
+        day = self._day
+        if day is None or not day[0] <= ts < day[1]:
+            lt = time.localtime(ts)
+            start = _local(lt.tm_year, lt.tm_mon, lt.tm_mday)
+            end = _local(lt.tm_year, lt.tm_mon, lt.tm_mday + 1)
+            changes, bands = self._schedules[lt.tm_wday]
+            boundaries = [_local(lt.tm_year, lt.tm_mon, lt.tm_mday, m // 60, m % 60) for m in changes]
+            day = self._day = (start, end, boundaries, bands)
+        return day
+
+    def split(self, t0, w0, t1, w1):
+        """Yield (day start, band, seconds, Wh) pieces of the trapezoid from (t0, w0) to (t1, w1)"""
+        slope = (w1 - w0) / (t1 - t0)
+        cursor, watts = t0, w0
+        while cursor < t1:
+            day_start, day_end, boundaries, bands = self._day_schedule(cursor)
+            i = bisect.bisect_right(boundaries, cursor) - 1
+            boundary = boundaries[i + 1] if i + 1 < len(boundaries) else day_end
+            end = min(boundary, t1)
+            end_watts = w0 + slope * (end - t0)
+            yield day_start, bands[i], end - cursor, (watts + end_watts) / 2 * (end - cursor) / 3600
+            cursor, watts = end, end_watts
+
+
+def load_tariff(path=TARIFF_PATH):
+    """Tariff from tariff.json, or a single free band if there is none"""
+    path = Path(path)
+    if not path.exists():
+        return Tariff({"standard": {"price_per_kwh": 0.0}})
+    return Tariff.from_dict(json.loads(path.read_text()))
+
+
+class ConsumptionMaintainer:
+    """Folds batches of readings into energy_totals, like rollups.RollupMaintainer"""
+
+    def __init__(self, tariff, max_gap=rollups.MAX_GAP):
+        self.tariff = tariff
+        self.max_gap = max_gap
+        self._periods = {}  # Day start -> [(period, period start)]
+
+    def _period_starts(self, day_start):
+        starts = self._periods.get(day_start)
+        if starts is None:
+            if len(self._periods) > 64:
+                self._periods.clear()
+            starts = self._periods[day_start] = [
+                (period, period_start(day_start, period)) for period in PERIODS
+            ]
+        return starts
+
+    def __call__(self, conn, readings, credited_below=None):
+        """readings: iterable of (appliance_id, ts, watts), see rollups.interval_changes()"""
+        totals = {}
+
+        for appliance_id, batch in rollups.by_appliance(readings).items():
+            changes = rollups.interval_changes(conn, appliance_id, batch, self.max_gap, credited_below)
+            for sign, prev_ts, prev_watts, ts, watts in changes:
+                if not 0 < ts - prev_ts <= self.max_gap:
+                    continue
+                for day_start, band, seconds, wh in self.tariff.split(prev_ts, prev_watts, ts, watts):
+                    for period, start in self._period_starts(day_start):
+                        agg = totals.get((appliance_id, period, start, band))
+                        if agg is None:
+                            totals[(appliance_id, period, start, band)] = [sign * wh, sign * seconds]
+                        else:
+                            agg[0] += sign * wh
+                            agg[1] += sign * seconds
+
+        if totals:
+            conn.executemany(UPSERT_SQL, [(*key, wh, seconds) for key, (wh, seconds) in totals.items()])
+
+
+def elapsed_days(start, end, now):
+    """Local days of [start, end) that have begun by now"""
+    last = min(end, now)
+    if last <= start:
+        return 0
+    return round((rollups.local_day_start(last - 1) - start) / 86400) + 1
+
+
+def summarize(rows, tariff, period, start, end, now, appliance_id=None):
+    """/energy/consumption response from energy_totals rows (appliance_id, band, wh, covered_s)
+
+    The standing charge is only added for the whole house (no appliance_id).
+    """
+    bands = {}
+    appliances = {}
+    for row_appliance, band, wh, covered_s in rows:
+        if appliance_id is not None and row_appliance != appliance_id:
+            continue
+        bands[band] = bands.get(band, 0.0) + wh
+        figures = appliances.setdefault(row_appliance, [0.0, 0])
+        figures[0] += wh
+        figures[1] += covered_s
+
+    band_list = []
+    energy_cost = 0.0
+    for band, wh in sorted(bands.items()):
+        price = tariff.price(band)
+        cost = wh / 1000 * price if price is not None else None
+        if cost is not None:
+            energy_cost += cost
+        band_list.append({
+            "band": band,
+            "kwh": wh / 1000,
+            "price_per_kwh": price,
+            "cost": round(cost, 4) if cost is not None else None,
+        })
+
+    days = elapsed_days(start, end, now)
+    standing_charge = tariff.standing_charge_per_day * days if appliance_id is None else 0.0
+    elapsed = max(min(end, now) - start, 0)
+
+    return {
+        "period": period,
+        "from": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)),
+        "to": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end)),
+        "appliance_id": appliance_id,
+        "kwh": sum(bands.values()) / 1000,
+        "bands": band_list,
+        "currency": tariff.currency,
+        "energy_cost": round(energy_cost, 4),
+        "standing_charge": round(standing_charge, 4),
+        "total_cost": round(energy_cost + standing_charge, 4),
+        "appliances": [
+            {
+                "appliance_id": appliance,
+                "kwh": wh / 1000,
+                # Share of the elapsed period covered by integrated readings
+                "coverage": min(covered_s / elapsed, 1.0) if elapsed else 0.0,
+            }
+            for appliance, (wh, covered_s) in sorted(appliances.items())
+        ],
+    }
+
+
+def rebuild(db_path=DB_PATH, tariff_path=TARIFF_PATH, archive_root=None,
+            chunk_size=rollups.DEFAULT_CHUNK_SIZE, pause=rollups.DEFAULT_CHUNK_PAUSE):
+    """Recompute energy_totals from the archive and every usage row with the current band times"""
+    from archive import ARCHIVE_DIR, Archive, replay_rollups
+
+    maintainer = ConsumptionMaintainer(load_tariff(tariff_path))
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
+    try:
+        conn.execute("PRAGMA busy_timeout = 5000")
+        create_tables(conn)
+
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM energy_totals")
+        end_rowid = conn.execute("SELECT MAX(rowid) FROM usage").fetchone()[0] or 0
+        conn.execute("COMMIT")
+
+        total = replay_rollups(conn, Archive(archive_root or ARCHIVE_DIR), maintainer)
+        total += rollups.backfill(conn, 1, end_rowid, chunk_size=chunk_size, pause=pause,
+                                  maintainer=maintainer)
+        logger.info(f"Consumption rebuild complete: {total} readings")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="kWh accumulators per appliance and tariff band")
+    parser.add_argument("command", choices=["rebuild"],
+                        help="rebuild: recompute the totals, e.g. after changing band times")
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    parser.add_argument("--tariff", default=str(TARIFF_PATH), help="Path to tariff.json")
+    parser.add_argument("--chunk-size", type=int, default=rollups.DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--pause", type=float, default=rollups.DEFAULT_CHUNK_PAUSE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    rebuild(args.db, args.tariff, chunk_size=args.chunk_size, pause=args.pause)
@@ -0,0 +1,225 @@
+"""
+Pooled, non-blocking SQLite read access for the API
+
+Every endpoint goes through a shared ReadPool instead of opening its own
+connection. The pool keeps a bounded set of read-only connections (each
+with its own prepared statement cache) and runs queries on a dedicated
+thread pool so blocking SQLite calls never stall the event loop.
+"""
+
+import asyncio
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CACHED_STATEMENTS = 64
+DEFAULT_ACQUIRE_TIMEOUT = 5.0  # Seconds to wait for a free connection
+DEFAULT_BUSY_TIMEOUT = 2000    # Milliseconds SQLite retries a locked database
+DEFAULT_FETCH_SIZE = 500       # Rows per fetchmany() when streaming
+MAX_QUERY_STATS = 200          # Distinct statements timed, the rest share OTHER_QUERIES
+OTHER_QUERIES = "(other)"
+
+# "IN (?, ?, ?)" lists of any length are the same statement for the stats
+PLACEHOLDER_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+QUERY_SECONDS = metrics.Histogram(
+    "db_query_seconds", "Time a pooled read query ran, or a streamed one held its connection"
+)
+POOL_WAIT_SECONDS = metrics.Histogram(
+    "db_pool_wait_seconds", "Time a query waited for a worker thread and a connection"
+)
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the acquire timeout"""
+
+
+class TimingStats:
+    """Running count/total/max of durations in milliseconds"""
+
+    __slots__ = ("count", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, elapsed_ms):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": self.total_ms / self.count if self.count else 0,
+            "max_ms": self.max_ms,
+        }
+
+
+class ReadPool:
+    """Bounded pool of read-only SQLite connections"""
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE,
+                 cached_statements=DEFAULT_CACHED_STATEMENTS,
+                 acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+
+        self.db_path = db_path
+        self.size = size
+        self.cached_statements = cached_statements
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db-read")
+
+        self._wait_stats = TimingStats()
+        self._query_stats = {}
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            f"file:{self.db_path}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute(f"PRAGMA busy_timeout = {DEFAULT_BUSY_TIMEOUT}")
+        return conn
+
+    def _acquire(self, queued_at):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.acquire_timeout)
+                except queue.Empty:
+                    raise PoolTimeout(
+                        f"No database connection free after {self.acquire_timeout}s"
+                    ) from None
+
+        waited = time.perf_counter() - queued_at
+        POOL_WAIT_SECONDS.observe(waited)
+        with self._lock:
+            self._in_use += 1
+            self._wait_stats.add(waited * 1000)
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def _run(self, sql, params, fetch, queued_at):
+        """fetch(cursor) produces the result, e.g. sqlite3.Cursor.fetchall"""
+        # Wait time covers both the executor queue and getting a connection
+        conn = self._acquire(queued_at)
+        start = time.perf_counter()
+        try:
+            result = fetch(conn.execute(sql, params))
+        finally:
+            self._release(conn)
+        self._record_query(sql, (time.perf_counter() - start) * 1000)
+        return result
+
+    def _record_query(self, sql, elapsed_ms):
+        QUERY_SECONDS.observe(elapsed_ms / 1000)
+        key = PLACEHOLDER_LIST_RE.sub("(?, ...)", " ".join(sql.split()))
+        with self._lock:
+            stats = self._query_stats.get(key)
+            if stats is None:
+                if len(self._query_stats) >= MAX_QUERY_STATS:
+                    key = OTHER_QUERIES
+                stats = self._query_stats.get(key)
+                if stats is None:
+                    stats = self._query_stats[key] = TimingStats()
+            stats.add(elapsed_ms)
+
+    async def _submit(self, sql, params, fetch):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run, sql, params, fetch, time.perf_counter())
+
+    async def fetchone(self, sql, params=()):
+        return await self._submit(sql, params, sqlite3.Cursor.fetchone)
+
+    async def fetchall(self, sql, params=()):
+        return await self._submit(sql, params, sqlite3.Cursor.fetchall)
+
+    async def fetcharray(self, sql, params, dtype):
+        """Rows straight into a NumPy structured array, no list of tuples in between"""
+        return await self._submit(sql, params, lambda cursor: np.fromiter(cursor, dtype=dtype))
+
+    def fetchall_blocking(self, sql, params=()):
+        """fetchall() on the calling thread, for generators StreamingResponse runs on a worker thread"""
+        return self._run(sql, params, sqlite3.Cursor.fetchall, time.perf_counter())
+
+    def iterate(self, sql, params=(), fetch_size=DEFAULT_FETCH_SIZE):
+        """Stream rows from a server-side cursor, fetch_size at a time
+
+        A plain (blocking) generator for StreamingResponse, which iterates it
+        on a worker thread. The connection is held until the generator is
+        exhausted or closed.
+        """
+        conn = self._acquire(time.perf_counter())
+        start = time.perf_counter()
+        cursor = None
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # Closing the cursor ends its read snapshot before the connection is reused
+            if cursor is not None:
+                cursor.close()
+            self._release(conn)
+            self._record_query(sql, (time.perf_counter() - start) * 1000)
+
+    def stats(self):
+        """Pool occupancy, connection wait times and per-query timings"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "wait": self._wait_stats.as_dict(),
+                "queries": {key: stats.as_dict() for key, stats in self._query_stats.items()},
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        with self._lock:
+            self._created = 0
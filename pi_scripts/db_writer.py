@@ -0,0 +1,185 @@
+"""
+Buffered SQLite writer for the energy monitor sampler loop
+
+Readings are queued in memory and written with a single executemany()
+per transaction once the batch size or flush interval is reached, so the
+SD card sees one fsync per batch instead of one per sample. Appliance
+names go to the appliances registry, in the same transaction, the first
+time the writer sees them; the rows themselves only carry the id.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+import appliances
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 60         # Rows per commit
+DEFAULT_FLUSH_INTERVAL = 30.0   # Seconds before a partial batch is flushed anyway
+DEFAULT_SYNCHRONOUS = "NORMAL"  # OFF, NORMAL, FULL or EXTRA
+
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# (timestamp, ts, watts, appliance_id) rows; names live in the appliances table
+INSERT_SQL = (
+    "INSERT INTO usage (timestamp, ts, watts, appliance_id, appliance_name) "
+    "VALUES (?, ?, ?, ?, NULL)"
+)
+
+COMMIT_SECONDS = metrics.Histogram(
+    "energy_db_commit_seconds", "Duration of one batched insert transaction, hooks included"
+)
+ROWS_WRITTEN = metrics.Counter("energy_db_rows_written", "Readings committed to the usage table")
+FAILED_FLUSHES = metrics.Counter("energy_db_failed_flushes", "Insert transactions that failed")
+
+
+def configure_connection(conn, synchronous=DEFAULT_SYNCHRONOUS):
+    """Switch the database to WAL so API readers never block on the sampler"""
+    synchronous = synchronous.upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid synchronous mode: {synchronous}")
+
+    journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    logger.info(f"SQLite journal_mode={journal_mode}, synchronous={synchronous}")
+    return journal_mode
+
+
+class BufferedWriter:
+    """Queue readings and flush them to the usage table in batches"""
+
+    def __init__(self, conn, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, hooks=()):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        self.conn = conn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Callables run as hook(conn, readings) inside the flush transaction,
+        # readings being a list of (appliance_id, ts, watts)
+        self.hooks = list(hooks)
+
+        self._buffer = []
+        self._names = {}      # appliance_id -> name registered by this writer
+        self._new_names = {}  # Names to register with the next flush
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        # Flush statistics
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def add(self, timestamp, watts, appliance_id=1, appliance_name='Main Appliance', ts=None):
+        """Queue a reading, flushing if a size or time threshold is reached
+
+        ts is the reading time as Unix epoch seconds; it is derived from the
+        local-time timestamp string when not given.
+        """
+        self.add_many([(timestamp, watts, appliance_id, appliance_name, ts)])
+
+    def add_many(self, readings):
+        """Queue (timestamp, watts, appliance_id, appliance_name, ts) readings, then flush if due
+
+        The whole batch is queued before any flush, so a flush that fails
+        (e.g. the database is locked) leaves every reading pending for the
+        next one instead of dropping the rest of the batch.
+        """
+        with self._lock:
+            for timestamp, watts, appliance_id, appliance_name, ts in readings:
+                if ts is None:
+                    ts = int(time.mktime(time.strptime(timestamp, TIMESTAMP_FORMAT)))
+                self._buffer.append((timestamp, ts, watts, appliance_id))
+                if appliance_name is not None and self._names.get(appliance_id) != appliance_name:
+                    self._new_names[appliance_id] = appliance_name
+            due = (
+                len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write every queued reading in a single transaction"""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            names, self._new_names = self._new_names, {}
+            self._last_flush = time.monotonic()
+            if not rows:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                with self.conn:
+                    for appliance_id, name in names.items():
+                        appliances.register(self.conn, appliance_id, name)
+                    self.conn.executemany(INSERT_SQL, rows)
+                    if self.hooks:
+                        readings = [(row[3], row[1], row[2]) for row in rows]
+                        for hook in self.hooks:
+                            hook(self.conn, readings)
+            except Exception:
+                # Keep the readings so the next flush can retry them
+                self._buffer = rows + self._buffer
+                self._new_names = {**names, **self._new_names}
+                self.failed_flushes += 1
+                FAILED_FLUSHES.inc()
+                raise
+            self._names.update(names)
+            elapsed = time.perf_counter() - start
+            COMMIT_SECONDS.observe(elapsed)
+            ROWS_WRITTEN.inc(len(rows))
+            elapsed_ms = elapsed * 1000
+
+            self.flushes += 1
+            self.rows_written += len(rows)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+        logger.info(f"Flushed {len(rows)} rows in {elapsed_ms:.2f} ms")
+        return len(rows)
+
+    def flush_if_due(self):
+        """Flush a partial batch once flush_interval has passed, for idle periods"""
+        if self._buffer and time.monotonic() - self._last_flush >= self.flush_interval:
+            return self.flush()
+        return 0
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    def stats(self):
+        """Flush latency and rows-per-commit figures"""
+        with self._lock:
+            return {
+                "flushes": self.flushes,
+                "failed_flushes": self.failed_flushes,
+                "rows_written": self.rows_written,
+                "pending": len(self._buffer),
+                "rows_per_commit": self.rows_written / self.flushes if self.flushes else 0,
+                "last_flush_ms": self.last_flush_ms,
+                "avg_flush_ms": self._total_flush_ms / self.flushes if self.flushes else 0,
+                "max_flush_ms": self.max_flush_ms,
+            }
+
+    def close(self):
+        """Flush whatever is still queued"""
+        flushed = self.flush()
+        stats = self.stats()
+        logger.info(
+            f"Writer closed: {stats['rows_written']} rows in {stats['flushes']} commits "
+            f"({stats['rows_per_commit']:.1f} rows/commit, avg {stats['avg_flush_ms']:.2f} ms)"
+        )
+        return flushed
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""
+Non-intrusive load disaggregation of the main channel
+
+One CT clamp on the mains sees the whole house as appliance 1. The
+Disaggregator splits that reading into virtual appliances by watching for
+step edges, the jumps in power when a device switches on or off:
+
+- Samples closer than steady_watts to the previous one belong to the same
+  run. A run counts once it has lasted min_steady samples; its level is the
+  mean of those samples, so a one-sample transient while a motor spins up
+  never counts. An edge is a change of at least min_step between the levels
+  of consecutive runs.
+- Rising edges are clustered by size. An edge within tolerance (relative,
+  at least min_tolerance watts) of a device that is off turns it on and
+  refines its power, any other starts a new device. Falling edges turn off
+  the closest device that is on. If the level drops below what the devices
+  that are on add up to, the device that best explains the difference is
+  switched off.
+- A device is reported once it has completed min_cycles on/off cycles.
+  Until then its power stays with "Other".
+
+Finding runs, levels and edges is vectorised over each batch of samples
+with NumPy. Only the edges themselves, a handful per hour, go through
+Python. The estimates are written to usage under a block of ID_BLOCK
+appliance ids reserved for the source appliance in the registry
+(appliances.reserve()), so they never collide with measured appliances or
+another source's estimates: id_base for "Other" (the remainder, every
+sample) and id_base + n for device n, every sample while it is on plus a
+0 W reading when it goes off.
+The devices are registered in the appliances table with source "nilm",
+so they can be renamed with appliances.py. The whole-house consumption
+figures leave them out.
+
+Two ways to run it:
+
+- Live: DisaggregationSink in energy_monitor.py (DISAGGREGATE_APPLIANCE).
+  Device clusters and the last timestamp processed are saved in the
+  nilm_state table in the same transaction as the estimates.
+- Batch, for history already in usage (stop the sampler or leave the
+  sink disabled while it runs):
+
+    python3 disaggregate.py backfill           # Resume from the last timestamp processed
+    python3 disaggregate.py backfill --rebuild # Delete the estimates and devices, start over
+    python3 disaggregate.py status
+"""
+
+import argparse
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+import appliances
+import consumption
+import rollups
+from db_writer import INSERT_SQL, TIMESTAMP_FORMAT, configure_connection
+from pipeline import SQLiteSink
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+DB_PATH = SCRIPT_DIR / "energy_data.db"
+
+logger = logging.getLogger(__name__)
+
+SOURCE_APPLIANCE = 1      # The mains channel
+ID_BLOCK = 100            # Reserved ids per source: "Other", then one per device
+VIRTUAL_SOURCE = "nilm"   # appliances.source of every virtual appliance
+BACKFILL_CHUNK = 50000    # Source readings per backfill transaction
+
+DEFAULT_SETTINGS = {
+    "steady_watts": 15.0,   # Largest sample-to-sample change within a run
+    "min_steady": 2,        # Samples before a run's level counts
+    "min_step": 40.0,       # Smallest edge treated as a device switching
+    "tolerance": 0.15,      # Relative size difference still matching a device
+    "min_tolerance": 20.0,  # ... in watts, for small devices
+    "min_cycles": 2,        # On/off cycles before a device is reported
+    "max_devices": 24,      # Below ID_BLOCK
+    "max_weight": 20,       # Edges averaged into a device's power, newer ones count more after
+}
+
+# Every virtual appliance of every source, and a condition leaving them out of whole-house totals
+VIRTUAL_IDS_SQL = f"SELECT id FROM appliances WHERE source = '{VIRTUAL_SOURCE}'"
+MEASURED_FILTER = f" AND appliance_id NOT IN ({VIRTUAL_IDS_SQL})"
+
+SOURCE_CHUNK_SQL = '''
+    SELECT ts, watts FROM usage WHERE appliance_id = ? AND ts > ? ORDER BY ts LIMIT ?
+'''
+
+SAVE_STATE_SQL = '''
+    INSERT OR REPLACE INTO nilm_state (source_id, last_ts, state, updated_ts) VALUES (?, ?, ?, ?)
+'''
+
+
+def create_tables(conn):
+    """Saved Disaggregator state per source appliance"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS nilm_state (
+        source_id INTEGER PRIMARY KEY,
+        last_ts INTEGER,
+        state TEXT NOT NULL,
+        updated_ts INTEGER NOT NULL
+    )''')
+
+
+class Device:
+    """A cluster of step edges of about the same size, i.e. one virtual appliance"""
+
+    __slots__ = ("appliance_id", "watts", "edges", "cycles", "on")
+
+    def __init__(self, appliance_id, watts, edges=1, cycles=0, on=False):
+        self.appliance_id = appliance_id
+        self.watts = watts
+        self.edges = edges
+        self.cycles = cycles
+        self.on = on
+
+    def matches(self, step, settings):
+        return abs(step - self.watts) <= max(settings["min_tolerance"], settings["tolerance"] * self.watts)
+
+    def learn(self, step, settings):
+        self.edges += 1
+        self.watts += (step - self.watts) / min(self.edges, settings["max_weight"])
+
+
+class Disaggregator:
+    """Incremental step-edge disaggregation of one source appliance"""
+
+    def __init__(self, source_id=SOURCE_APPLIANCE, settings=None, id_base=None):
+        self.source_id = source_id
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        if self.settings["max_devices"] >= ID_BLOCK:
+            raise ValueError(f"max_devices must be below {ID_BLOCK}")
+        # First id of the block, reserved by load() unless given
+        self.id_base = id_base
+        self.devices = []
+        self.last_ts = None
+        self.edges = 0
+
+        self._prev = None        # Last sample
+        self._level = None       # Level of the last run that counted
+        self._run_count = 0      # Samples in the open run
+        self._run_sum = 0.0      # Sum of its first min_steady samples
+
+    @property
+    def other_id(self):
+        return self.id_base
+
+    def device_name(self, device):
+        return f"Device {device.appliance_id - self.id_base} (~{device.watts:.0f} W)"
+
+    def _reported(self):
+        """(appliance_id, watts) of the devices reported on right now"""
+        min_cycles = self.settings["min_cycles"]
+        return [(d.appliance_id, round(d.watts, 2)) for d in self.devices if d.on and d.cycles >= min_cycles]
+
+    def _new_device(self, step):
+        settings = self.settings
+        if len(self.devices) < settings["max_devices"]:
+            device = Device(self.id_base + len(self.devices) + 1, step, on=True)
+            self.devices.append(device)
+            return device
+        # Full: reuse the least seen device that is off and was never reported (it has no rows)
+        spare = [d for d in self.devices if not d.on and d.cycles < settings["min_cycles"]]
+        if not spare:
+            return None
+        device = min(spare, key=lambda d: d.edges)
+        device.watts, device.edges, device.cycles, device.on = step, 1, 0, True
+        return device
+
+    def _switch_off(self, device):
+        device.on = False
+        device.cycles += 1
+
+    def _apply_edge(self, step, level):
+        """Update the devices for an edge of step watts ending at level"""
+        settings = self.settings
+        self.edges += 1
+        if step > 0:
+            candidates = [d for d in self.devices if not d.on and d.matches(step, settings)]
+            if candidates:
+                device = min(candidates, key=lambda d: abs(d.watts - step))
+                device.learn(step, settings)
+                device.on = True
+            else:
+                self._new_device(step)
+        else:
+            candidates = [d for d in self.devices if d.on and d.matches(-step, settings)]
+            if candidates:
+                device = min(candidates, key=lambda d: abs(d.watts + step))
+                device.learn(-step, settings)
+                self._switch_off(device)
+        # Devices that are on cannot draw more than the level: an off edge was missed
+        while True:
+            on = [d for d in self.devices if d.on]
+            excess = sum(d.watts for d in on) - level
+            if not on or excess <= settings["min_tolerance"]:
+                break
+            self._switch_off(min(on, key=lambda d: abs(d.watts - excess)))
+
+    def _find_edges(self, w):
+        """(sample index, step, level) of each edge in w, updating the run state"""
+        settings = self.settings
+        min_steady = settings["min_steady"]
+        n = len(w)
+        breaks = np.abs(np.diff(w, prepend=w[0] if self._prev is None else self._prev)) >= settings["steady_watts"]
+        if self._prev is None:
+            breaks[0] = True
+        starts = np.flatnonzero(breaks)
+        continuing = not breaks[0]
+        if continuing:
+            starts = np.concatenate(([0], starts))
+        ends = np.append(starts[1:], n)
+        carried_count = np.zeros(len(starts), dtype=np.int64)
+        carried_sum = np.zeros(len(starts))
+        if continuing:
+            carried_count[0] = self._run_count
+            carried_sum[0] = self._run_sum
+
+        # Sample at which each run reaches min_steady, if it does in this batch
+        need = min_steady - carried_count
+        confirm = starts + need - 1
+        counted = (need >= 1) & (confirm < ends)
+        cumulative = np.concatenate(([0.0], np.cumsum(w)))
+        at = np.clip(confirm, 0, n - 1)
+        levels = ((cumulative[at + 1] - cumulative[starts] + carried_sum) / min_steady)[counted]
+        index = confirm[counted]
+
+        previous = np.concatenate(([np.nan if self._level is None else self._level], levels[:-1]))
+        steps = levels - previous
+        edge = np.abs(np.nan_to_num(steps)) >= settings["min_step"]
+
+        if len(levels):
+            self._level = float(levels[-1])
+        last = len(starts) - 1
+        self._run_count = int(carried_count[last] + n - starts[last])
+        if self._run_count <= min_steady:
+            self._run_sum = float(carried_sum[last] + cumulative[n] - cumulative[starts[last]])
+        self._prev = float(w[-1])
+        return index[edge], steps[edge], levels[edge]
+
+    def process(self, ts, watts):
+        """Estimates (ts, appliance_ids, watts arrays) for readings of the source appliance
+
+        Readings at or before the last one processed are skipped, so a
+        restarted backfill does not duplicate estimates.
+        """
+        if self.id_base is None:
+            raise RuntimeError("No appliance ids reserved, call load() first or pass id_base")
+        ts = np.asarray(ts, dtype=np.int64)
+        w = np.asarray(watts, dtype=np.float64)
+        if self.last_ts is not None:
+            keep = ts > self.last_ts
+            ts, w = ts[keep], w[keep]
+        n = len(w)
+        if not n:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+        # Devices reported on from each change onwards
+        changes = [0]
+        reported = [self._reported()]
+        offs = []
+        index, steps, levels = self._find_edges(w)
+        for i, step, level in zip(index.tolist(), steps.tolist(), levels.tolist()):
+            before = {appliance_id for appliance_id, _ in reported[-1]}
+            self._apply_edge(step, level)
+            now_on = self._reported()
+            offs.extend((i, appliance_id) for appliance_id in before - {appliance_id for appliance_id, _ in now_on})
+            if i == changes[-1]:
+                reported[-1] = now_on
+            else:
+                changes.append(i)
+                reported.append(now_on)
+
+        lengths = np.diff(np.append(changes, n))
+        explained = np.repeat([sum(watts for _, watts in on) for on in reported], lengths)
+        out_ts = [ts]
+        out_ids = [np.full(n, self.other_id, dtype=np.int64)]
+        out_watts = [np.round(np.maximum(w - explained, 0.0), 2)]
+        for start, length, on in zip(changes, lengths.tolist(), reported):
+            for appliance_id, watts in on:
+                out_ts.append(ts[start:start + length])
+                out_ids.append(np.full(length, appliance_id, dtype=np.int64))
+                out_watts.append(np.full(length, watts))
+        if offs:
+            out_ts.append(ts[[i for i, _ in offs]])
+            out_ids.append(np.array([appliance_id for _, appliance_id in offs], dtype=np.int64))
+            out_watts.append(np.zeros(len(offs)))
+
+        out_ts = np.concatenate(out_ts)
+        order = np.argsort(out_ts, kind="stable")
+        self.last_ts = int(ts[-1])
+        return out_ts[order], np.concatenate(out_ids)[order], np.concatenate(out_watts)[order]
+
+    def state(self):
+        return {
+            "level": self._level,
+            "prev": self._prev,
+            "run": [self._run_count, self._run_sum],
+            "edges": self.edges,
+            "devices": [[d.appliance_id, d.watts, d.edges, d.cycles, d.on] for d in self.devices],
+        }
+
+    def load(self, conn):
+        """Reserve the id block unless given and restore the state saved by save()
+
+        Returns False if there is no saved state. Call it in a write
+        transaction: the first call for a source reserves its block.
+        """
+        if self.id_base is None:
+            self.id_base = id_block(conn, self.source_id)
+        row = conn.execute(
+            "SELECT last_ts, state FROM nilm_state WHERE source_id = ?", (self.source_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        self.last_ts = row[0]
+        state = json.loads(row[1])
+        self._level = state["level"]
+        self._prev = state["prev"]
+        self._run_count, self._run_sum = state["run"]
+        self.edges = state["edges"]
+        self.devices = [Device(*device) for device in state["devices"]]
+        return True
+
+    def save(self, conn, readings=()):
+        """Register the reported devices unless they are, and store the state
+
+        Has the BufferedWriter hook signature, so the live sink saves inside
+        the transaction that writes the estimates.
+        """
+        appliances.ensure(conn, self.other_id, source=VIRTUAL_SOURCE, name="Other (disaggregated)")
+        for device in self.devices:
+            if device.cycles >= self.settings["min_cycles"]:
+                appliances.ensure(conn, device.appliance_id, source=VIRTUAL_SOURCE, name=self.device_name(device))
+        conn.execute(SAVE_STATE_SQL, (self.source_id, self.last_ts, json.dumps(self.state()), int(time.time())))
+
+
+def id_block(conn, source_id):
+    """First of the ID_BLOCK appliance ids reserved for source_id's estimates"""
+    return appliances.reserve(conn, block_owner(source_id), ID_BLOCK)
+
+
+def block_owner(source_id):
+    return f"{VIRTUAL_SOURCE}:{source_id}"
+
+
+def estimate_rows(ts, ids, watts):
+    """INSERT_SQL rows for process() output"""
+    return [
+        (time.strftime(TIMESTAMP_FORMAT, time.localtime(t)), t, w, appliance_id)
+        for t, appliance_id, w in zip(ts.tolist(), ids.tolist(), watts.tolist())
+    ]
+
+
+class DisaggregationSink(SQLiteSink):
+    """Disaggregates the source appliance's readings as they arrive and stores the estimates
+
+    Rollups and energy totals are maintained for the virtual appliances
+    through the same hooks as the sampler's own sink.
+    """
+
+    name = "nilm"
+    capacity = 2048
+
+    def __init__(self, db_path, disaggregator=None, batch_size=12, flush_interval=60.0, hooks=()):
+        self.disaggregator = disaggregator or Disaggregator()
+        super().__init__(db_path, batch_size, flush_interval, hooks=[*hooks, self.disaggregator.save])
+
+    def open(self):
+        super().open()
+        with self.conn:
+            create_tables(self.conn)
+            self.disaggregator.load(self.conn)
+
+    def handle(self, readings):
+        source = [r for r in readings if r.appliance_id == self.disaggregator.source_id]
+        if not source:
+            return
+        ts, ids, watts = self.disaggregator.process([r.ts for r in source], [r.watts for r in source])
+        self.writer.add_many(
+            (timestamp, w, appliance_id, None, t) for timestamp, t, w, appliance_id in estimate_rows(ts, ids, watts)
+        )
+
+
+def backfill(db_path=DB_PATH, source_id=SOURCE_APPLIANCE, settings=None, rebuild=False,
+             chunk_size=BACKFILL_CHUNK):
+    """Disaggregate the source's stored readings after the last processed one, returns rows written
+
+    Each chunk is written with its rollups, energy totals and the saved
+    state in one transaction, so an interrupted backfill resumes cleanly.
+    """
+    conn = sqlite3.connect(str(db_path))
+    try:
+        configure_connection(conn)
+        with conn:
+            create_tables(conn)
+        if rebuild:
+            clear(conn, source_id)
+        disaggregator = Disaggregator(source_id, settings)
+        with conn:
+            disaggregator.load(conn)
+        hooks = [rollups.RollupMaintainer(), consumption.ConsumptionMaintainer(consumption.load_tariff())]
+
+        written = 0
+        while True:
+            after = disaggregator.last_ts if disaggregator.last_ts is not None else -1
+            chunk = conn.execute(SOURCE_CHUNK_SQL, (source_id, after, chunk_size)).fetchall()
+            if not chunk:
+                break
+            data = np.array(chunk, dtype=np.float64)
+            ts, ids, watts = disaggregator.process(data[:, 0].astype(np.int64), data[:, 1])
+            rows = estimate_rows(ts, ids, watts)
+            with conn:
+                conn.executemany(INSERT_SQL, rows)
+                readings = [(appliance_id, t, w) for _, t, w, appliance_id in rows]
+                for hook in hooks:
+                    hook(conn, readings)
+                disaggregator.save(conn)
+            written += len(rows)
+            logger.info(f"Disaggregated up to {time.strftime(TIMESTAMP_FORMAT, time.localtime(disaggregator.last_ts))}"
+                        f", {written} estimates, {len(disaggregator.devices)} devices")
+        return written
+    finally:
+        conn.close()
+
+
+def clear(conn, source_id=SOURCE_APPLIANCE):
+    """Delete source_id's virtual appliances' readings, rollups, totals and registry rows and its saved state
+
+    The id block stays reserved, so a rebuild reuses it.
+    """
+    with conn:
+        first = id_block(conn, source_id)
+        block = (first, first + ID_BLOCK)
+        for table in ["usage", *(f"rollup_{r}" for r in rollups.RESOLUTIONS), "energy_totals"]:
+            conn.execute(f"DELETE FROM {table} WHERE appliance_id >= ? AND appliance_id < ?", block)
+        conn.execute("DELETE FROM appliances WHERE id >= ? AND id < ?", block)
+        conn.execute("DELETE FROM nilm_state WHERE source_id = ?", (source_id,))
+
+
+def print_status(db_path=DB_PATH, source_id=SOURCE_APPLIANCE):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        # Read only: the block, and the state saved with it, exist once anything was disaggregated
+        block = appliances.reserved(conn, block_owner(source_id))
+        disaggregator = Disaggregator(source_id, id_base=block[0] if block else None)
+        if block is None or not disaggregator.load(conn):
+            print("Nothing disaggregated yet")
+            return
+        print(f"Processed up to {time.strftime(TIMESTAMP_FORMAT, time.localtime(disaggregator.last_ts))}, "
+              f"{disaggregator.edges} edges")
+        min_cycles = disaggregator.settings["min_cycles"]
+        for d in sorted(disaggregator.devices, key=lambda d: -d.watts):
+            status = "reported" if d.cycles >= min_cycles else "learning"
+            print(f"{d.appliance_id:>6}  {d.watts:8.1f} W  {d.cycles:>6} cycles  {status}"
+                  + ("  on" if d.on else ""))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Disaggregate the main channel into virtual appliances")
+    parser.add_argument("command", choices=["backfill", "status"])
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    parser.add_argument("--source", type=int, default=SOURCE_APPLIANCE, help="Appliance id to disaggregate")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Delete existing estimates and devices first")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == "backfill":
+        started = time.perf_counter()
+        rows = backfill(args.db, args.source, rebuild=args.rebuild)
+        print(f"Wrote {rows} estimates in {time.perf_counter() - started:.1f} s")
+    print_status(args.db, args.source)
@@ -0,0 +1,85 @@
+"""
+Fixed-size downsampling of time series for charts
+
+Both methods take parallel NumPy arrays sorted by time and return at most
+the requested number of points, whatever the input length:
+
+- minmax: the range is split into equal time buckets and each bucket keeps
+  its lowest and highest point, in time order. Cheap and never hides a
+  spike, so it suits power traces.
+- lttb: Largest-Triangle-Three-Buckets picks the one point per bucket that
+  best preserves the visual shape of the line.
+"""
+
+import numpy as np
+
+METHODS = ("minmax", "lttb")
+
+
+def minmax(ts, low, high, start, end, points):
+    """Lowest and highest point of each of points // 2 time buckets
+
+    low and high are the same array for raw readings; for pre-aggregated
+    rows they are the per-row min and max. Returns (ts, values).
+    """
+    ts = np.asarray(ts)
+    low = np.asarray(low, dtype=float)
+    high = np.asarray(high, dtype=float)
+    buckets = max(points // 2, 1)
+    if len(ts) <= points:
+        # Nothing to drop: every row, min/max collapsed to their midpoint
+        return ts, (low + high) / 2
+
+    span = max(end - start, 1)
+    bucket = np.clip((ts - start) * buckets // span, 0, buckets - 1)
+    # Start of every run of equal buckets; ts is sorted so each bucket is one run
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+
+    # Sorting by (bucket, value) puts each bucket's extreme first in its run
+    min_i = np.lexsort((low, bucket))[starts]
+    max_i = np.lexsort((-high, bucket))[starts]
+
+    first = np.minimum(min_i, max_i)
+    second = np.maximum(min_i, max_i)
+    first_values = np.where(first == min_i, low[first], high[first])
+    second_values = np.where(second == max_i, high[second], low[second])
+
+    out_ts = np.column_stack((ts[first], ts[second])).ravel()
+    out_values = np.column_stack((first_values, second_values)).ravel()
+    keep = np.column_stack((np.ones(len(first), dtype=bool), first != second)).ravel()
+    return out_ts[keep], out_values[keep]
+
+
+def lttb(ts, values, points):
+    """Largest-Triangle-Three-Buckets down to points samples, returns (ts, values)"""
+    ts = np.asarray(ts)
+    values = np.asarray(values, dtype=float)
+    n = len(ts)
+    if points < 3:
+        raise ValueError("lttb needs at least 3 points")
+    if points >= n:
+        return ts, values
+
+    x = ts.astype(float)
+    # Buckets between the fixed first and last points
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    selected = np.empty(points, dtype=np.intp)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket is the third corner of the triangle
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = values[next_lo:next_hi].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (values[lo:hi] - values[a])
+            - (x[a] - x[lo:hi]) * (avg_y - values[a])
+        )
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return ts[selected], values[selected]
@@ -0,0 +1,182 @@
+"""
+Response encoding for the API: fast JSON, compact history formats and compression
+
+- dumps() and FastJSONResponse serialise with orjson when it is installed
+  (several times faster than the json module) and fall back to json.
+  Endpoints with large bodies return FastJSONResponse themselves, which
+  also skips FastAPI's per-value jsonable_encoder pass.
+- Compact history formats: "columns" is JSON with parallel ts and watts
+  arrays instead of one object per reading. "binary" is
+  application/octet-stream holding n little-endian uint32 timestamps
+  followed by n float32 watts, 8 bytes per reading. It can be read
+  zero-copy in Dart with Uint32List.view / Float32List.view, or in numpy
+  with packed_arrays().
+- CompressionMiddleware compresses responses for clients that send
+  Accept-Encoding: brotli (if the brotli package is installed) or gzip.
+  Streamed responses are compressed as they go. Server-sent events and
+  small bodies are left alone.
+"""
+
+import json
+import zlib
+
+import numpy as np
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Optional, pip install orjson
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional, pip install brotli
+    brotli = None
+
+HISTORY_FORMATS = ("json", "ndjson", "columns", "binary")
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+MINIMUM_SIZE = 1024    # Smaller bodies are sent uncompressed
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4     # Fast enough for a Pi, still well ahead of gzip on JSON
+UNCOMPRESSED_TYPES = ("text/event-stream", "image/", "application/gzip", "application/zip",
+                      "application/vnd.apache.parquet")
+
+
+def dumps(obj):
+    """Compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+
+def packed_history(ts, watts):
+    """'binary' body: uint32 timestamps then float32 watts, little-endian"""
+    return np.asarray(ts, dtype="<u4").tobytes() + np.asarray(watts, dtype="<f4").tobytes()
+
+
+def packed_arrays(body):
+    """(ts, watts) arrays back from a packed_history() body"""
+    n = len(body) // 8
+    return np.frombuffer(body, dtype="<u4", count=n), np.frombuffer(body, dtype="<f4", offset=4 * n)
+
+
+def accepted_encoding(header):
+    """"br", "gzip" or None for an Accept-Encoding header value"""
+    weights = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    star = weights.get("*", 0.0)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = max(candidates, key=lambda name: weights.get(name, star))
+    return best if weights.get(best, star) > 0 else None
+
+
+class _Compressor:
+    def __init__(self, encoding):
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data, final=False):
+        if self._brotli is not None:
+            out = self._brotli.process(data) if data else b""
+            return out + self._brotli.finish() if final else out
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush() if final else out
+
+
+class CompressionMiddleware:
+    """ASGI middleware applying the client's preferred Content-Encoding"""
+
+    def __init__(self, app, minimum_size=MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = accepted_encoding(accept) if accept else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.minimum_size))
+
+
+class _CompressingSend:
+    def __init__(self, send, encoding, minimum_size):
+        self.send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    def _compressible(self):
+        if self.start["status"] < 200 or self.start["status"] in (204, 304):
+            return False
+        for name, value in self.start["headers"]:
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type" and value.decode("latin-1").startswith(UNCOMPRESSED_TYPES):
+                return False
+        return True
+
+    def _start_headers(self, length=None):
+        headers = [(n, v) for n, v in self.start["headers"] if n not in (b"content-length", b"vary")]
+        vary = [v for n, v in self.start["headers"] if n == b"vary"]
+        headers.append((b"content-encoding", self.encoding.encode()))
+        headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+        if length is not None:
+            headers.append((b"content-length", str(length).encode()))
+        return {**self.start, "headers": headers}
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more = message.get("more_body", False)
+        if self.compressor is None:
+            if not self._compressible() or (not more and len(body) < self.minimum_size):
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+            self.compressor = _Compressor(self.encoding)
+            if not more:
+                data = self.compressor.compress(body, final=True)
+                await self.send(self._start_headers(len(data)))
+                await self.send({"type": "http.response.body", "body": data})
+                return
+            await self.send(self._start_headers())
+
+        data = self.compressor.compress(body, final=not more)
+        if data or not more:
+            await self.send({"type": "http.response.body", "body": data, "more_body": more})
@@ -1,10 +1,22 @@
+import sys
 import time
+import signal
 import smbus2 as smbus
 import sqlite3
-import math
 from pathlib import Path
 import logging
 from datetime import datetime
+from appliances import register as register_appliance
+from db_writer import configure_connection
+import managed_logging
+import metrics
+from migrate_database import pending_slow_migrations, run_migrations
+from rollups import RollupMaintainer
+from consumption import ConsumptionMaintainer, load_tariff
+from pipeline import Pipeline, SQLiteSink, LogSink, NotifierSink, webhook_notifier
+from events import EventDetector, EventSink
+from disaggregate import Disaggregator, DisaggregationSink
+from sampling import Channel, SamplingEngine
 
 bus = smbus.SMBus(1)
 address = 0x48
@@ -13,77 +25,169 @@ address = 0x48
 SCRIPT_DIR = Path(__file__).parent.absolute()
 DB_PATH = SCRIPT_DIR / "energy_data.db"
 
-# Setup logging
+# Setup logging: writes happen on a background thread, the file rotates at
+# LOG_MAX_BYTES and at midnight, and rotated segments are gzipped and kept
+# for LOG_RETENTION_DAYS
 LOG_FILE = SCRIPT_DIR / "energy_monitor.log"
-logging.basicConfig(
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_RETENTION_DAYS = 30
+managed_logging.setup(
+    LOG_FILE,
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()  # Also print to console
-    ]
+    fmt='%(asctime)s - %(levelname)s - %(message)s',
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_RETENTION_DAYS,
+    max_age_days=LOG_RETENTION_DAYS,
 )
 logger = logging.getLogger(__name__)
 
+# Write batching: one commit per WRITE_BATCH_SIZE readings or WRITE_FLUSH_INTERVAL
+# seconds, whichever comes first. synchronous=NORMAL in WAL mode only fsyncs at
+# checkpoints; use FULL if losing the last commit on power loss is not acceptable.
+WRITE_BATCH_SIZE = 12
+WRITE_FLUSH_INTERVAL = 60.0
+DB_SYNCHRONOUS = "NORMAL"
+
+# Readings are taken every SAMPLE_INTERVAL seconds on the sampler thread and
+# handed to the sinks (database, log, notifier) through per-sink buffers
+SAMPLE_INTERVAL = 5.0
+STATS_INTERVAL = 600  # Seconds between pipeline stats log lines
+
+# Notify when an appliance goes above NOTIFY_WATTS (None disables). Without a
+# webhook URL the notification is a warning in the log.
+NOTIFY_WATTS = None
+NOTIFY_WEBHOOK_URL = None
+
+# Event detection (see events.py): EVENT_RULES override the defaults for every
+# appliance, APPLIANCE_EVENT_RULES for single ones, e.g. {1: {"max_watts": 3000}}.
+# Events are also sent to NOTIFY_WEBHOOK_URL when it is set.
+EVENTS_ENABLED = True
+EVENT_RULES = {}
+APPLIANCE_EVENT_RULES = {}
+
+# Split this appliance's readings into virtual appliances by their on/off steps
+# (see disaggregate.py), e.g. 1 for the mains channel; None disables. Only
+# useful when this appliance is the whole-house CT clamp. DISAGGREGATE_SETTINGS
+# override disaggregate.DEFAULT_SETTINGS, e.g. {"min_step": 60}.
+DISAGGREGATE_APPLIANCE = None
+DISAGGREGATE_SETTINGS = {}
+
+# Prometheus exporter for sample, commit and queue metrics (None disables)
+METRICS_PORT = 9101
+
 conn = sqlite3.connect(str(DB_PATH))
-c = conn.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS usage (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    timestamp TEXT NOT NULL,
-    watts REAL NOT NULL,
-    appliance_id INTEGER DEFAULT 1,
-    appliance_name TEXT DEFAULT 'Main Appliance'
-)''')
-conn.commit()
+configure_connection(conn, DB_SYNCHRONOUS)
+# Backfills over a large database would hold up the first sample for minutes
+# or hours; migrate_database.py runs them in chunks alongside the API instead
+slow = pending_slow_migrations(conn)
+if slow:
+    conn.close()
+    logger.error(f"Migrations {', '.join(map(str, slow))} go through every stored reading: "
+                 f"run python3 migrate_database.py first, then start the monitor again")
+    sys.exit(1)
+run_migrations(conn)
+conn.close()  # The SQLite sink opens its own connection on its worker thread
 
+# One entry per CT clamp: ADC input channel and amps-per-volt calibration.
+# Names and channel settings are registered in the appliances table at startup.
+# Set VOLTAGE_CHANNEL to the input of a mains voltage sensor to measure real
+# power; without it power is VOLTAGE x true-RMS current.
+APPLIANCES = [
+    {"id": 1, "name": "Main Appliance", "channel": 0, "calibration": 19.02},
+]
 VOLTAGE = 230.0
-CALIBRATION_FACTOR = 19.02
-
-def read_voltage():
-    samples = 10
-    max_value = 0
-    max_adc = 0
-    bus.write_byte(address, 0x00)
-    time.sleep(0.01)
-    bus.read_byte(address)  # Discard stale reading
-    for _ in range(samples):
-        time.sleep(0.001)
-        data = bus.read_byte(address)
-        voltage = (data / 255) * 3.3
-        if voltage > max_value:
-            max_adc = data
-            max_value = voltage
-    rms_voltage = max_value / math.sqrt(2) if max_value > 0 else 0
-    logger.info(f"Max ADC Value: {max_adc}, Max Voltage: {max_value:.4f}V, RMS Voltage: {rms_voltage:.4f}V")
-    return rms_voltage
-
-def calculate_power():
-    raw_voltage = read_voltage() 
-    logger.info(f"Calculated Current: {raw_voltage * CALIBRATION_FACTOR:.4f}A")
-    current = raw_voltage * CALIBRATION_FACTOR  
-    power = abs(current) * VOLTAGE / 1000
-    return power
+VOLTAGE_CHANNEL = None
+VOLTAGE_CALIBRATION = 1.0
+MAINS_HZ = 50.0
+CAPTURE_CYCLES = 10
+
+channels = [Channel.from_config(appliance) for appliance in APPLIANCES]
+
+conn = sqlite3.connect(str(DB_PATH))
+with conn:
+    for ch in channels:
+        register_appliance(conn, ch.appliance_id, ch.name, channel=ch.channel,
+                           calibration=ch.calibration, nominal_voltage=VOLTAGE, source="sampler")
+conn.close()
 
+engine = SamplingEngine(
+    bus,
+    channels,
+    address=address,
+    mains_hz=MAINS_HZ,
+    cycles=CAPTURE_CYCLES,
+    nominal_voltage=VOLTAGE,
+    voltage_channel=VOLTAGE_CHANNEL,
+    voltage_calibration=VOLTAGE_CALIBRATION,
+)
+
+def read_measurements():
+    measurements = engine.read()
+    for m in measurements:
+        logger.debug(
+            f"Appliance {m.appliance_id}: Irms {m.irms:.4f}A, PF {m.power_factor:.2f}, "
+            f"crest {m.crest_factor:.2f}, {m.samples} samples at {m.sample_rate:.0f} Hz"
+        )
+    return measurements
+
+sinks = [
+    SQLiteSink(
+        DB_PATH,
+        batch_size=WRITE_BATCH_SIZE,
+        flush_interval=WRITE_FLUSH_INTERVAL,
+        synchronous=DB_SYNCHRONOUS,
+        hooks=[RollupMaintainer(), ConsumptionMaintainer(load_tariff())],
+    ),
+    LogSink(logger, echo=False),  # The log handler already echoes to the console
+]
+if NOTIFY_WATTS is not None:
+    notify = webhook_notifier(NOTIFY_WEBHOOK_URL) if NOTIFY_WEBHOOK_URL else None
+    sinks.append(NotifierSink(NOTIFY_WATTS, notify=notify))
+if EVENTS_ENABLED:
+    sinks.append(EventSink(
+        DB_PATH,
+        EventDetector(EVENT_RULES, APPLIANCE_EVENT_RULES),
+        notify=webhook_notifier(NOTIFY_WEBHOOK_URL) if NOTIFY_WEBHOOK_URL else None,
+    ))
+if DISAGGREGATE_APPLIANCE is not None:
+    sinks.append(DisaggregationSink(
+        DB_PATH,
+        Disaggregator(DISAGGREGATE_APPLIANCE, DISAGGREGATE_SETTINGS),
+        batch_size=WRITE_BATCH_SIZE,
+        flush_interval=WRITE_FLUSH_INTERVAL,
+        hooks=[RollupMaintainer(), ConsumptionMaintainer(load_tariff())],
+    ))
+
+pipeline = Pipeline(read_measurements, sinks, interval=SAMPLE_INTERVAL)
+pipeline.register_metrics()
+managed_logging.register_metrics()
+metrics.register_process_metrics()
+
+def handle_sigterm(signum, frame):
+    """Stop on SIGTERM (systemctl stop) so queued readings get flushed"""
+    raise KeyboardInterrupt
+
+signal.signal(signal.SIGTERM, handle_sigterm)
+
+exit_code = 0
 try:
     logger.info("Energy Monitor started")
+    if METRICS_PORT is not None:
+        metrics.start_http_server(METRICS_PORT)
+        logger.info(f"Metrics on http://0.0.0.0:{METRICS_PORT}/metrics")
+    pipeline.start()
     while True:
-        power = calculate_power()
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-        appliance_id = 1
-        appliance_name = 'Main Appliance'
-        c.execute('INSERT INTO usage (timestamp, watts, appliance_id, appliance_name) VALUES (?, ?, ?, ?)', (timestamp, power, appliance_id, appliance_name))
-        conn.commit()
-        log_message = f"Time: {timestamp}, Power: {power:.2f} W"
-        logger.info(log_message)
-        print(log_message)  # Keep console output for real-time monitoring
-        time.sleep(5)
+        time.sleep(STATS_INTERVAL)
+        logger.info(f"Pipeline stats: {pipeline.stats()}")
 except KeyboardInterrupt:
-    logger.info("Energy Monitor stopped by user")
-    print("Stopped by user")
-    conn.close()
-    exit(0)
+    logger.info("Energy Monitor stopped")
+    print("Stopped")
 except Exception as e:
     logger.error(f"Energy Monitor error: {e}")
     print(f"Error: {e}")
-    conn.close()
-    exit(1)
+    exit_code = 1
+finally:
+    if not pipeline.stop():
+        exit_code = 1
+    logger.info(f"Pipeline stats: {pipeline.stats()}")
+exit(exit_code)
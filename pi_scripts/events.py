@@ -0,0 +1,267 @@
+"""
+Streaming event detection on the sampler's readings
+
+EventSink runs as another pipeline sink in energy_monitor.py and feeds
+every reading through an EventDetector. The detector keeps a fixed handful
+of numbers per appliance and does O(1) work per reading; history is never
+queried. It emits:
+
+- on / off: power went above on_watts, or below off_watts, for confirm
+  readings in a row. The gap between the two thresholds and the
+  confirmation stop an appliance idling near a threshold from flapping.
+- step_up / step_down: while on, the power moved away from its running
+  baseline by at least step_watts and step_sigma standard deviations, and
+  stayed there for confirm readings. The baseline is an exponentially
+  weighted mean and variance, updated in Welford form (after a plain
+  Welford warm-up). A single-reading spike resets the confirmation and is
+  not folded into the baseline.
+- over_limit: power went above max_watts, once per crossing.
+- stalled / resumed: no reading for stall_seconds, then readings again.
+
+Events go to the events table and are served by the API at /events.
+"""
+
+import logging
+import math
+import sqlite3
+import time
+from collections import namedtuple
+
+from db_writer import TIMESTAMP_FORMAT
+from pipeline import Sink
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = {
+    "on_watts": 10.0,       # Off -> on above this
+    "off_watts": 5.0,       # On -> off below this
+    "step_watts": 50.0,     # Smallest change reported as a step
+    "step_sigma": 4.0,      # ... and at least this many standard deviations
+    "confirm": 2,           # Readings a new level or state must hold before it is reported
+    "alpha": 0.1,           # Weight of each new reading in the running baseline
+    "warmup": 5,            # Readings averaged before steps are looked for
+    "max_watts": None,      # over_limit threshold, None disables
+    "stall_seconds": 60.0,  # Silence before an appliance counts as stalled
+}
+
+KINDS = ("on", "off", "step_up", "step_down", "over_limit", "stalled", "resumed")
+
+INSERT_SQL = (
+    "INSERT INTO events (ts, appliance_id, kind, watts, baseline, message) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+Event = namedtuple("Event", ["ts", "appliance_id", "kind", "watts", "baseline", "message"])
+
+
+def create_tables(conn):
+    """Detected events, read newest first by /events"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        appliance_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        watts REAL,
+        baseline REAL,
+        message TEXT
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_appliance ON events(appliance_id, id)")
+
+
+class _State:
+    """Everything remembered about one appliance"""
+
+    __slots__ = ("name", "n", "mean", "var", "on", "switching", "over", "pending", "pending_sum",
+                 "last_ts", "stalled")
+
+    def __init__(self, name):
+        self.name = name
+        self.n = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.on = None
+        self.switching = 0
+        self.over = False
+        self.pending = 0
+        self.pending_sum = 0.0
+        self.last_ts = None
+        self.stalled = False
+
+
+class EventDetector:
+    """Per-appliance on/off, step, limit and stall detection in constant memory
+
+    rules overrides DEFAULT_RULES for every appliance, appliance_rules
+    ({appliance_id: {...}}) for single ones.
+    """
+
+    def __init__(self, rules=None, appliance_rules=None):
+        self.rules = {**DEFAULT_RULES, **(rules or {})}
+        self.appliance_rules = {
+            appliance_id: {**self.rules, **overrides}
+            for appliance_id, overrides in (appliance_rules or {}).items()
+        }
+        self._states = {}
+
+    def _baseline(self, state, watts, rules):
+        if state.n < rules["warmup"]:
+            # Plain Welford until the warm-up readings are in
+            state.n += 1
+            delta = watts - state.mean
+            state.mean += delta / state.n
+            state.var += (delta * (watts - state.mean) - state.var) / state.n
+        else:
+            # Exponentially weighted Welford: recent readings count most
+            delta = watts - state.mean
+            increment = rules["alpha"] * delta
+            state.mean += increment
+            state.var = (1 - rules["alpha"]) * (state.var + delta * increment)
+
+    def _rebase(self, state, level):
+        state.n = 1
+        state.mean = level
+        state.var = 0.0
+        state.pending = 0
+        state.pending_sum = 0.0
+
+    def update(self, ts, appliance_id, watts, name=None):
+        """Fold in one reading, returns the events it triggers"""
+        rules = self.appliance_rules.get(appliance_id, self.rules)
+        state = self._states.get(appliance_id)
+        if state is None:
+            state = self._states[appliance_id] = _State(name or f"Appliance {appliance_id}")
+        elif name:
+            state.name = name
+        events = []
+
+        def event(kind, message, baseline=None):
+            events.append(Event(ts, appliance_id, kind, watts, baseline, f"{state.name} {message}"))
+
+        if state.stalled:
+            state.stalled = False
+            event("resumed", f"readings resumed after {ts - state.last_ts} s")
+        state.last_ts = ts
+
+        if rules["max_watts"] is not None:
+            over = watts > rules["max_watts"]
+            if over and not state.over:
+                event("over_limit", f"drawing {watts:.0f} W, above {rules['max_watts']:.0f} W")
+            state.over = over
+
+        if state.on is None:
+            state.on = watts >= rules["on_watts"]  # First reading sets the state silently
+        else:
+            crossing = watts < rules["off_watts"] if state.on else watts >= rules["on_watts"]
+            if crossing:
+                state.switching += 1
+                if state.switching >= rules["confirm"]:
+                    state.on = not state.on
+                    state.switching = 0
+                    if state.on:
+                        event("on", f"turned on ({watts:.0f} W)", state.mean)
+                    else:
+                        event("off", f"turned off (was {state.mean:.0f} W)", state.mean)
+                    self._rebase(state, watts)
+                return events
+            state.switching = 0
+
+        if state.n >= rules["warmup"]:
+            delta = watts - state.mean
+            threshold = max(rules["step_watts"], rules["step_sigma"] * math.sqrt(state.var))
+            if abs(delta) >= threshold:
+                # Hold the reading back from the baseline until the new level is confirmed
+                state.pending += 1
+                state.pending_sum += watts
+                if state.pending >= rules["confirm"]:
+                    level = state.pending_sum / state.pending
+                    if state.on:
+                        kind = "step_up" if level > state.mean else "step_down"
+                        event(kind, f"stepped from {state.mean:.0f} W to {level:.0f} W", state.mean)
+                    self._rebase(state, level)
+                return events
+            state.pending = 0
+            state.pending_sum = 0.0
+
+        self._baseline(state, watts, rules)
+        return events
+
+    def check_stalled(self, now):
+        """stalled events for appliances silent for longer than their stall_seconds"""
+        events = []
+        for appliance_id, state in self._states.items():
+            if state.stalled or state.last_ts is None:
+                continue
+            rules = self.appliance_rules.get(appliance_id, self.rules)
+            silent = now - state.last_ts
+            if silent > rules["stall_seconds"]:
+                state.stalled = True
+                events.append(Event(
+                    int(now), appliance_id, "stalled", None, None,
+                    f"{state.name} sent no reading for {silent:.0f} s"
+                ))
+        return events
+
+
+class EventSink(Sink):
+    """Runs an EventDetector over the readings and stores what it finds
+
+    notify(message), if given, is called for every event, e.g. with
+    pipeline.webhook_notifier().
+    """
+
+    name = "events"
+    capacity = 1024
+
+    def __init__(self, db_path, detector=None, notify=None):
+        self.db_path = db_path
+        self.detector = detector or EventDetector()
+        self.notify = notify
+        self.conn = None
+        self.detected = 0
+
+    def open(self):
+        self.conn = sqlite3.connect(str(self.db_path))
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+
+    def _store(self, events):
+        if not events:
+            return
+        with self.conn:
+            self.conn.executemany(INSERT_SQL, events)
+        self.detected += len(events)
+        for e in events:
+            logger.info(f"Event {e.kind}: {e.message} at {time.strftime(TIMESTAMP_FORMAT, time.localtime(e.ts))}")
+            if self.notify is not None:
+                try:
+                    self.notify(e.message)
+                except Exception as exc:
+                    logger.warning(f"Event notification failed: {exc}")
+
+    def handle(self, readings):
+        events = []
+        for r in readings:
+            events.extend(self.detector.update(r.ts, r.appliance_id, r.watts, r.appliance_name))
+        events.extend(self.detector.check_stalled(time.time()))
+        self._store(events)
+
+    def tick(self):
+        self._store(self.detector.check_stalled(time.time()))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def row_to_dict(row):
+    """/events item from an (id, ts, appliance_id, kind, watts, baseline, message) row"""
+    event_id, ts, appliance_id, kind, watts, baseline, message = row
+    return {
+        "id": event_id,
+        "timestamp": time.strftime(TIMESTAMP_FORMAT, time.localtime(ts)),
+        "ts": ts,
+        "appliance_id": appliance_id,
+        "kind": kind,
+        "watts": watts,
+        "baseline": baseline,
+        "message": message,
+    }
@@ -0,0 +1,204 @@
+"""
+Bulk export of stored readings as CSV, NDJSON, Parquet or Arrow
+
+/export streams one appliance's readings, oldest first, from the database
+merged with the archived days. The database is read a page at a time,
+each page on a freshly acquired pool connection, so a slow download does
+not hold a connection (or its WAL snapshot, which stops checkpoints from
+recycling the log) for its whole length. Rows are encoded a chunk at a time,
+so memory stays flat however long the range is, and a year of 5-second
+readings can be downloaded from a Pi. iter_newest_readings() pages the
+same way, newest first, for /energy/history?format=ndjson.
+
+- csv: timestamp,ts,watts with a header line
+- ndjson: one {"timestamp", "ts", "watts"} object per line
+- parquet: ts (timestamp, UTC) and watts columns, zstd compressed, one
+  row group per COLUMNAR_BATCH_ROWS readings
+- arrow: the same columns as an Arrow IPC stream
+
+parquet and arrow need pyarrow, which is optional.
+"""
+
+import io
+import itertools
+
+import numpy as np
+
+import encoding
+from archive import merge_newest_first, merge_oldest_first
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional, pip install pyarrow
+    pa = pq = None
+
+EXPORT_FORMATS = ("csv", "ndjson", "parquet", "arrow")
+COLUMNAR_FORMATS = ("parquet", "arrow")
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+EXPORT_PAGE_ROWS = 5000        # Rows per database query
+TEXT_CHUNK_ROWS = 5000         # Rows per streamed CSV/NDJSON chunk
+COLUMNAR_BATCH_ROWS = 65536    # Rows per Parquet row group / Arrow record batch
+PARQUET_COMPRESSION = "zstd"
+
+CSV_HEADER = b"timestamp,ts,watts\n"
+
+# Keyset paging on (ts, rowid), readings sharing a ts are not split or repeated across pages
+EXPORT_SQL = (
+    "SELECT timestamp, watts, ts, rowid FROM usage "
+    "WHERE appliance_id = ? AND (ts, rowid) > (?, ?) AND ts < ? ORDER BY ts, rowid LIMIT ?"
+)
+NEWEST_SQL = (
+    "SELECT timestamp, watts, ts, rowid FROM usage "
+    "WHERE appliance_id = ? AND (ts, rowid) < (?, ?) ORDER BY ts DESC, rowid DESC LIMIT ?"
+)
+MAX_TS = 2 ** 63 - 1
+
+
+def columnar_available():
+    return pa is not None
+
+
+def filename(appliance_id, start, end, format):
+    return f"energy-{appliance_id}-{start}-{end}.{format}"
+
+
+def iter_readings(db, archive, appliance_id, start, end):
+    """(timestamp, watts, ts) rows with start <= ts < end, oldest first, archived days included
+
+    db is a db_reader.ReadPool; a connection is only held while a page is
+    fetched.
+    """
+    return merge_oldest_first(
+        archive.iter_range(appliance_id, start, end),
+        _iter_database(db, appliance_id, start, end)
+    )
+
+
+def _iter_database(db, appliance_id, start, end):
+    cursor = (start, -1)  # Every rowid is > -1, so this is ts >= start
+    while True:
+        page = db.fetchall_blocking(EXPORT_SQL, (appliance_id, *cursor, end, EXPORT_PAGE_ROWS))
+        for timestamp, watts, ts, _ in page:
+            yield timestamp, watts, ts
+        if len(page) < EXPORT_PAGE_ROWS:
+            return
+        cursor = (page[-1][2], page[-1][3])
+
+
+def iter_newest_readings(db, archive, appliance_id, before=None, limit=None):
+    """(timestamp, watts, ts) rows with ts < before, newest first, archived days included
+
+    Paged like iter_readings(), pages no larger than limit.
+    """
+    page_rows = min(limit, EXPORT_PAGE_ROWS) if limit else EXPORT_PAGE_ROWS
+    rows = merge_newest_first(
+        _iter_database_newest(db, appliance_id, MAX_TS if before is None else before, page_rows),
+        archive.iter_newest_first(appliance_id, before=before)
+    )
+    return itertools.islice(rows, limit) if limit else rows
+
+
+def _iter_database_newest(db, appliance_id, before, page_rows):
+    cursor = (before, -1)  # Every rowid is > -1, so this is ts < before
+    while True:
+        page = db.fetchall_blocking(NEWEST_SQL, (appliance_id, *cursor, page_rows))
+        for timestamp, watts, ts, _ in page:
+            yield timestamp, watts, ts
+        if len(page) < page_rows:
+            return
+        cursor = (page[-1][2], page[-1][3])
+
+
+def _batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def csv_chunks(rows):
+    yield CSV_HEADER
+    for batch in _batches(rows, TEXT_CHUNK_ROWS):
+        yield "".join(f"{timestamp},{ts},{watts}\n" for timestamp, watts, ts in batch).encode()
+
+
+def ndjson_chunks(rows):
+    for batch in _batches(rows, TEXT_CHUNK_ROWS):
+        yield b"".join(
+            encoding.dumps({"timestamp": timestamp, "ts": ts, "watts": watts}) + b"\n"
+            for timestamp, watts, ts in batch
+        )
+
+
+def arrow_schema(appliance_id):
+    return pa.schema(
+        [("ts", pa.timestamp("s", tz="UTC")), ("watts", pa.float64())],
+        metadata={"appliance_id": str(appliance_id)}
+    )
+
+
+def record_batch(rows, schema):
+    ts = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+    watts = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(ts, type=schema.field("ts").type), pa.array(watts)], schema=schema
+    )
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain()"""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def columnar_chunks(rows, appliance_id, format):
+    """Parquet file or Arrow IPC stream, yielded as each batch is written"""
+    schema = arrow_schema(appliance_id)
+    sink = _ChunkSink()
+    if format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression=PARQUET_COMPRESSION)
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+    for batch in _batches(rows, COLUMNAR_BATCH_ROWS):
+        write(record_batch(batch, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_chunks(rows, appliance_id, format):
+    """Body chunks of an export in the given format"""
+    if format == "csv":
+        return csv_chunks(rows)
+    if format == "ndjson":
+        return ndjson_chunks(rows)
+    return columnar_chunks(rows, appliance_id, format)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Per-appliance consumption forecasts from the hourly rollups
+
+Each appliance gets a damped additive Holt-Winters model of its average
+power per hour, with a daily (24-hour) season indexed by local hour. A
+full fit runs the recursion over the last FIT_DAYS of rollup_hour once for
+every (alpha, beta, gamma) in a small grid, all at the same time as NumPy
+vectors, and keeps the parameters with the lowest one-step mean absolute
+error. Seasonal-naive ("same hour yesterday") is the grid point alpha=0,
+beta=0, gamma=1, so it wins whenever the smoother does not beat it.
+Hours with no readings are filled with the model's own forecast.
+
+Fitted parameters and state (level, trend, 24 seasonal terms) are saved in
+the forecast_models table. Afterwards only the hours completed since the
+last update are fed through the saved model; a full refit runs every
+REFIT_INTERVAL. The API runs update() every UPDATE_INTERVAL in the
+background and answers /energy/forecast from the models in memory, so a
+request never fits anything.
+
+    python3 forecast.py                # Update every appliance's model, print the next day
+    python3 forecast.py --refit
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+DB_PATH = SCRIPT_DIR / "energy_data.db"
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+SEASON = 24               # Hours per seasonal cycle
+FIT_DAYS = 28             # History read for a full fit
+MAX_HORIZON = 7 * 24      # Longest forecast served, in hours
+DAMPING = 0.9             # Trend damping, keeps week-ahead forecasts from running away
+UPDATE_INTERVAL = 600     # Seconds between background updates in the API
+REFIT_INTERVAL = 24 * 3600
+
+ALPHAS = (0.05, 0.1, 0.2, 0.4, 0.6)
+BETAS = (0.0, 0.02, 0.1)
+GAMMAS = (0.05, 0.1, 0.2, 0.4)
+SEASONAL_NAIVE = (0.0, 0.0, 1.0)
+
+HOURLY_SQL = '''
+    SELECT bucket, sum_watts / count FROM rollup_hour
+    WHERE appliance_id = ? AND bucket >= ? AND bucket < ? ORDER BY bucket
+'''
+
+FIRST_BUCKET_SQL = "SELECT MIN(bucket) FROM rollup_hour WHERE appliance_id = ?"
+
+SAVE_SQL = '''
+    INSERT OR REPLACE INTO forecast_models
+        (appliance_id, model, params, state, last_bucket, mae, fitted_ts, updated_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+LOAD_SQL = '''
+    SELECT appliance_id, model, params, state, last_bucket, mae, fitted_ts FROM forecast_models
+'''
+
+
+def create_tables(conn):
+    """Fitted model per appliance, see Model.to_row()"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS forecast_models (
+        appliance_id INTEGER PRIMARY KEY,
+        model TEXT NOT NULL,
+        params TEXT NOT NULL,
+        state TEXT NOT NULL,
+        last_bucket INTEGER NOT NULL,
+        mae REAL,
+        fitted_ts INTEGER NOT NULL,
+        updated_ts INTEGER NOT NULL
+    )''')
+
+
+def season_slots(buckets):
+    """Local hour of day of each hourly bucket"""
+    return np.array([time.localtime(b).tm_hour for b in np.asarray(buckets).tolist()], dtype=np.intp)
+
+
+def hourly_series(rows, start, end):
+    """(buckets, average watts) for every hour in [start, end), NaN where there were no readings"""
+    buckets = np.arange(start, end, HOUR, dtype=np.int64)
+    watts = np.full(len(buckets), np.nan)
+    if rows:
+        data = np.array(rows, dtype=np.float64)
+        watts[((data[:, 0] - start) // HOUR).astype(np.intp)] = data[:, 1]
+    return buckets, watts
+
+
+def run_holt_winters(y, slots, alpha, beta, gamma, phi, level, trend, seasonal):
+    """Feed y through one model per element of alpha/beta/gamma, updating the state in place
+
+    level and trend have the shape of the parameters, seasonal has an extra
+    leading SEASON axis. Missing (NaN) values take the one-step forecast.
+    Returns (sum of absolute one-step errors, number of observed hours).
+    """
+    abs_errors = np.zeros_like(level)
+    scored = 0
+    for t in range(len(y)):
+        slot = slots[t]
+        s = seasonal[slot]
+        damped = phi * trend
+        predicted = level + damped + s
+        value = y[t]
+        if value != value:  # NaN: no readings that hour
+            observed = predicted
+        else:
+            observed = value
+            abs_errors += np.abs(value - predicted)
+            scored += 1
+        new_level = alpha * (observed - s) + (1 - alpha) * (level + damped)
+        trend[...] = beta * (new_level - level) + (1 - beta) * damped
+        seasonal[slot] = gamma * (observed - new_level) + (1 - gamma) * s
+        level[...] = new_level
+    return abs_errors, scored
+
+
+class Model:
+    """Fitted parameters and current state of one appliance's forecast"""
+
+    def __init__(self, appliance_id, alpha, beta, gamma, phi, level, trend, seasonal, last_bucket,
+                 mae, fitted_ts):
+        self.appliance_id = appliance_id
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.phi = phi
+        self.level = level
+        self.trend = trend
+        self.seasonal = np.asarray(seasonal, dtype=np.float64)
+        self.last_bucket = last_bucket  # Last complete hour fed to the model
+        self.mae = mae
+        self.fitted_ts = fitted_ts
+
+    @property
+    def kind(self):
+        return "seasonal_naive" if (self.alpha, self.beta, self.gamma) == SEASONAL_NAIVE else "holt_winters"
+
+    @classmethod
+    def fit(cls, appliance_id, buckets, y, now=None):
+        """Best model on the grid for an hourly series, None with under a day of readings"""
+        observed = ~np.isnan(y)
+        if observed.sum() < SEASON:
+            return None
+        first_observed = int(np.argmax(observed))
+        buckets, y = buckets[first_observed:], y[first_observed:]
+        if len(y) <= SEASON:
+            return None
+        # Seasonal-naive first, so it wins ties
+        grid = np.array([SEASONAL_NAIVE] + list(itertools.product(ALPHAS, BETAS, GAMMAS))).T
+        alpha, beta, gamma = grid
+        phi = np.where(beta > 0, DAMPING, 0.0)
+        size = grid.shape[1]
+
+        # Initial state from the first day
+        slots = season_slots(buckets)
+        first = y[:SEASON]
+        start_level = np.nanmean(first)
+        level = np.full(size, start_level)
+        trend = np.zeros(size)
+        seasonal = np.zeros((SEASON, size))
+        seasonal[slots[:SEASON]] = np.nan_to_num(first - start_level)[:, None]
+
+        abs_errors, scored = run_holt_winters(
+            y[SEASON:], slots[SEASON:], alpha, beta, gamma, phi, level, trend, seasonal
+        )
+        best = int(np.argmin(abs_errors)) if scored else 0
+        return cls(
+            appliance_id, float(alpha[best]), float(beta[best]), float(gamma[best]), float(phi[best]),
+            float(level[best]), float(trend[best]), seasonal[:, best].copy(), int(buckets[-1]),
+            float(abs_errors[best] / scored) if scored else None,
+            int(now if now is not None else time.time())
+        )
+
+    def advanced(self, buckets, y):
+        """Copy of the model fed with the hours after last_bucket, same parameters"""
+        level = np.array(self.level)
+        trend = np.array(self.trend)
+        seasonal = self.seasonal.copy()
+        run_holt_winters(y, season_slots(buckets), self.alpha, self.beta, self.gamma, self.phi,
+                         level, trend, seasonal)
+        return Model(self.appliance_id, self.alpha, self.beta, self.gamma, self.phi, float(level),
+                     float(trend), seasonal, int(buckets[-1]), self.mae, self.fitted_ts)
+
+    def predict(self, start, hours):
+        """(buckets, watts) for hours hours from the hour starting at start"""
+        first = self.last_bucket + HOUR
+        skip = max(0, (start - first) // HOUR)
+        steps = np.arange(skip + 1, skip + hours + 1)
+        buckets = first + (steps - 1) * HOUR
+        damped = np.cumsum(self.phi ** np.arange(1, skip + hours + 1))[skip:] if self.phi else 0.0
+        watts = self.level + damped * self.trend + self.seasonal[season_slots(buckets)]
+        return buckets, np.clip(watts, 0.0, None)
+
+    def to_row(self, now):
+        params = {"alpha": self.alpha, "beta": self.beta, "gamma": self.gamma, "phi": self.phi}
+        state = {"level": self.level, "trend": self.trend, "seasonal": self.seasonal.tolist()}
+        return (self.appliance_id, self.kind, json.dumps(params), json.dumps(state), self.last_bucket,
+                self.mae, self.fitted_ts, now)
+
+    @classmethod
+    def from_row(cls, row):
+        appliance_id, _, params, state, last_bucket, mae, fitted_ts = row
+        params = json.loads(params)
+        state = json.loads(state)
+        return cls(appliance_id, params["alpha"], params["beta"], params["gamma"], params["phi"],
+                   state["level"], state["trend"], state["seasonal"], last_bucket, mae, fitted_ts)
+
+
+class Forecaster:
+    """Keeps every appliance's model current and answers forecasts from memory"""
+
+    def __init__(self, db_path=DB_PATH, interval=UPDATE_INTERVAL, refit_interval=REFIT_INTERVAL,
+                 clock=time.time):
+        self.db_path = db_path
+        self.interval = interval
+        self.refit_interval = refit_interval
+        self.clock = clock
+        self.models = {}
+        self._conn = None
+        self._lock = threading.Lock()
+        self._task = None
+
+        self.fits = 0
+        self.updates = 0
+        self.last_run = None
+
+    def open(self):
+        """Connect, create the table if needed and load the saved models"""
+        # mode=rw: never create the database, the sampler's migrations do
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=rw", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        with conn:
+            create_tables(conn)
+        self._conn = conn
+        self.models = {row[0]: Model.from_row(row) for row in conn.execute(LOAD_SQL)}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _update_appliance(self, appliance_id, now, refit):
+        """Refit or advance one appliance's model, returns it (None without enough data)"""
+        end = now - now % HOUR  # Only complete hours
+        model = self.models.get(appliance_id)
+        if (model is None or refit or now - model.fitted_ts >= self.refit_interval
+                or end - model.last_bucket > FIT_DAYS * 86400):
+            first = self._conn.execute(FIRST_BUCKET_SQL, (appliance_id,)).fetchone()[0]
+            if first is None:
+                return None
+            start = max(first, end - FIT_DAYS * 86400)
+            rows = self._conn.execute(HOURLY_SQL, (appliance_id, start, end)).fetchall()
+            fitted = Model.fit(appliance_id, *hourly_series(rows, start, end), now=now)
+            if fitted is None:
+                return model
+            self.fits += 1
+            return fitted
+        start = model.last_bucket + HOUR
+        if start < end:
+            rows = self._conn.execute(HOURLY_SQL, (appliance_id, start, end)).fetchall()
+            model = model.advanced(*hourly_series(rows, start, end))
+            self.updates += 1
+        return model
+
+    def update(self, refit=False):
+        """Bring every registered appliance's model up to the last complete hour"""
+        with self._lock:
+            if self._conn is None:
+                self.open()
+            now = int(self.clock())
+            appliance_ids = [row[0] for row in self._conn.execute("SELECT id FROM appliances ORDER BY id")]
+            changed = []
+            for appliance_id in appliance_ids:
+                # Models are replaced, never modified, so requests can read them meanwhile
+                model = self._update_appliance(appliance_id, now, refit)
+                if model is not None and model is not self.models.get(appliance_id):
+                    changed.append(model)
+                    self.models[appliance_id] = model
+            if changed:
+                with self._conn:
+                    self._conn.executemany(SAVE_SQL, [model.to_row(now) for model in changed])
+            self.last_run = now
+            return len(changed)
+
+    def forecast(self, appliance_id, hours=SEASON, now=None):
+        """Forecast dict for the hours from the current one on, None if there is no model"""
+        model = self.models.get(appliance_id)
+        if model is None:
+            return None
+        now = int(self.clock()) if now is None else now
+        buckets, watts = model.predict(now - now % HOUR, hours)
+        watts = np.round(watts, 2)
+        day = float(watts[:SEASON].sum()) if hours >= SEASON else None
+        return {
+            "appliance_id": appliance_id,
+            "model": model.kind,
+            "mae_watts": round(model.mae, 2) if model.mae is not None else None,
+            "trained_until": model.last_bucket + HOUR,
+            "fitted_ts": model.fitted_ts,
+            # Average watts over an hour is also its Wh
+            "next_hour": {"ts": int(buckets[0]), "wh": float(watts[0])},
+            "next_day": {"wh": round(day, 1), "kwh": round(day / 1000, 3)} if day is not None else None,
+            "hourly": [
+                {"ts": b, "timestamp": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(b)), "watts": w}
+                for b, w in zip(buckets.tolist(), watts.tolist())
+            ],
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.update)
+            except sqlite3.Error as e:
+                logger.warning(f"Forecast update failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        """Load saved models, then update them in the background every interval"""
+        try:
+            await asyncio.to_thread(self.open)
+        except sqlite3.Error as e:
+            logger.warning(f"Forecast models not loaded: {e}")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        with self._lock:
+            self.close()
+
+    def stats(self):
+        return {
+            "models": len(self.models),
+            "fits": self.fits,
+            "updates": self.updates,
+            "last_run": self.last_run,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit or update the consumption forecasts")
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    parser.add_argument("--refit", action="store_true", help="Fit every model from scratch")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    forecaster = Forecaster(args.db)
+    started = time.perf_counter()
+    changed = forecaster.update(refit=args.refit)
+    print(f"Updated {changed} models in {time.perf_counter() - started:.2f} s")
+    for appliance_id in sorted(forecaster.models):
+        result = forecaster.forecast(appliance_id)
+        day = result["next_day"]
+        print(f"{appliance_id:>4}  {result['model']:<15} next hour {result['next_hour']['wh']:8.1f} Wh"
+              f"  next day {day['kwh']:7.3f} kWh  (MAE {result['mae_watts']} W)")
+    forecaster.close()
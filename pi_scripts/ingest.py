@@ -0,0 +1,268 @@
+"""
+Bulk ingestion of readings from remote or buffered sensors
+
+POST /ingest takes a batch of readings from sensors other than the
+sampler, such as ESP32 plugs, or readings buffered while a node was
+offline. A batch is one of:
+
+- NDJSON (application/x-ndjson): one object per line,
+  {"appliance_id": 3, "ts": 1733234567, "watts": 12.5, "appliance_name": "Desk"}.
+  A local "timestamp" string can replace ts, and appliance_name is optional.
+- Binary (application/octet-stream): packed little-endian 10-byte records
+  of uint16 appliance_id, uint32 ts, float32 watts. This is parsed with one
+  numpy call, with no per-row Python work.
+
+A batch is validated as a whole and rejected with every problem listed, or
+written in one transaction. Readings whose (appliance_id, ts) is already
+stored, or repeated within the batch, are skipped. The check is one range
+query per appliance over idx_usage_appliance_ts inside the write
+transaction, so retried uploads are harmless. Rollups and energy totals are
+maintained by the same hooks as the sampler's writer.
+
+Readings older than the appliance's newest stored one are written too and
+counted as late, for information. The hooks take back the energy of the
+interval a late reading lands in and credit its two halves instead.
+
+An appliance_name renames the appliance in the appliances registry; an
+appliance sent without one is registered as "Appliance N".
+"""
+
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import appliances
+import metrics
+from db_writer import INSERT_SQL, TIMESTAMP_FORMAT
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+MAX_BATCH_ROWS = 100000
+MAX_ERRORS = 20         # Problems listed when a batch is rejected
+MIN_TS = 946684800      # 2000-01-01, older readings are a sensor without a clock
+MAX_FUTURE = 300        # Seconds a reading may be ahead of this node's clock
+MAX_ABS_WATTS = 1e6
+
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+BINARY_TYPES = ("application/octet-stream",)
+
+BINARY_RECORD = np.dtype([("appliance_id", "<u2"), ("ts", "<u4"), ("watts", "<f4")])
+
+EXISTING_TS_SQL = "SELECT ts FROM usage WHERE appliance_id = ? AND ts BETWEEN ? AND ?"
+NEWEST_TS_SQL = "SELECT MAX(ts) FROM usage WHERE appliance_id = ?"
+
+BATCH_SECONDS = metrics.Histogram("energy_ingest_batch_seconds", "Duration of one /ingest write transaction")
+ROWS_INGESTED = metrics.Counter("energy_ingest_rows", "Readings written through /ingest")
+DUPLICATES = metrics.Counter("energy_ingest_duplicates", "Ingested readings skipped as already stored")
+LATE = metrics.Counter("energy_ingest_late", "Ingested readings older than the newest stored one")
+REJECTED = metrics.Counter("energy_ingest_rejected_batches", "Batches refused by validation")
+
+
+class IngestError(ValueError):
+    """A batch that failed validation, with one message per problem"""
+
+    def __init__(self, errors):
+        self.errors = errors[:MAX_ERRORS]
+        super().__init__("; ".join(self.errors))
+
+
+def _ts_range(now):
+    return MIN_TS, now + MAX_FUTURE
+
+
+def _parse_line(line, low, high):
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("expected an object")
+
+    appliance_id = record.get("appliance_id")
+    if isinstance(appliance_id, bool) or not isinstance(appliance_id, int) or appliance_id < 1:
+        raise ValueError("appliance_id must be a positive integer")
+    if appliance_id >= appliances.RESERVED_ID_START:
+        raise ValueError(f"appliance_id must be below {appliances.RESERVED_ID_START}")
+
+    if "ts" in record:
+        ts = record["ts"]
+        if isinstance(ts, bool) or not isinstance(ts, (int, float)):
+            raise ValueError("ts must be epoch seconds")
+    elif isinstance(record.get("timestamp"), str):
+        ts = datetime.fromisoformat(record["timestamp"]).timestamp()
+    else:
+        raise ValueError("ts or timestamp is required")
+    ts = int(ts)
+    if not low <= ts <= high:
+        raise ValueError(f"ts {ts} is out of range")
+
+    watts = record.get("watts")
+    if isinstance(watts, bool) or not isinstance(watts, (int, float)) \
+            or not math.isfinite(watts) or abs(watts) > MAX_ABS_WATTS:
+        raise ValueError("watts must be a finite number")
+
+    name = record.get("appliance_name")
+    if name is not None and not isinstance(name, str):
+        raise ValueError("appliance_name must be a string")
+    return appliance_id, ts, float(watts), name
+
+
+def parse_ndjson(body, now=None):
+    """[(appliance_id, ts, watts, name or None)] from an NDJSON batch"""
+    low, high = _ts_range(int(time.time()) if now is None else now)
+    readings = []
+    errors = []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            readings.append(_parse_line(line, low, high))
+        except ValueError as e:  # json.JSONDecodeError included
+            errors.append(f"line {number}: {e}")
+            if len(errors) >= MAX_ERRORS:
+                break
+    if errors:
+        raise IngestError(errors)
+    return readings
+
+
+def parse_binary(body, now=None):
+    """[(appliance_id, ts, watts, None)] from packed BINARY_RECORD bytes"""
+    if len(body) % BINARY_RECORD.itemsize:
+        raise IngestError([f"body length {len(body)} is not a multiple of {BINARY_RECORD.itemsize}"])
+    records = np.frombuffer(body, dtype=BINARY_RECORD)
+    low, high = _ts_range(int(time.time()) if now is None else now)
+
+    problems = {
+        "appliance_id must be a positive integer": records["appliance_id"] == 0,
+        "ts is out of range": (records["ts"] < low) | (records["ts"] > high),
+        "watts must be a finite number":
+            ~np.isfinite(records["watts"]) | (np.abs(records["watts"]) > MAX_ABS_WATTS),
+    }
+    errors = []
+    for message, bad in problems.items():
+        for index in np.flatnonzero(bad)[:MAX_ERRORS]:
+            errors.append(f"record {index + 1}: {message}")
+    if errors:
+        raise IngestError(sorted(errors, key=lambda e: int(e.split()[1].rstrip(":"))))
+
+    return list(zip(
+        records["appliance_id"].tolist(),
+        records["ts"].tolist(),
+        records["watts"].astype(np.float64).round(3).tolist(),
+        [None] * len(records),
+    ))
+
+
+def parse(body, content_type, now=None):
+    """Readings from a request body, by its media type
+
+    Raises IngestError for an invalid batch and plain ValueError for an
+    unsupported content_type.
+    """
+    if content_type not in NDJSON_TYPES + BINARY_TYPES:
+        raise ValueError(f"Unsupported content type: {content_type or 'none'}")
+    try:
+        if content_type in BINARY_TYPES:
+            readings = parse_binary(body, now)
+        else:
+            try:
+                readings = parse_ndjson(body.decode("utf-8"), now)
+            except UnicodeDecodeError:
+                raise IngestError(["body is not UTF-8"])
+        if len(readings) > MAX_BATCH_ROWS:
+            raise IngestError([f"{len(readings)} readings, at most {MAX_BATCH_ROWS} per batch"])
+    except IngestError:
+        REJECTED.inc()
+        raise
+    return readings
+
+
+class Ingestor:
+    """Writes validated batches on its own connection, one transaction each
+
+    hooks are BufferedWriter-style hook(conn, [(appliance_id, ts, watts)]),
+    run inside the transaction for the readings actually inserted.
+    """
+
+    def __init__(self, db_path, hooks=()):
+        self.db_path = db_path
+        self.hooks = list(hooks)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout = 5000")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn = conn
+        return self._conn
+
+    def _register(self, conn, readings):
+        names = {}
+        for appliance_id, _, _, name in readings:
+            if name is not None or appliance_id not in names:
+                names[appliance_id] = name  # The batch's last name wins
+        for appliance_id, name in names.items():
+            if name is None:
+                appliances.ensure(conn, appliance_id, source="ingest")
+            else:
+                appliances.register(conn, appliance_id, name, source="ingest")
+
+    def _new_rows(self, conn, readings):
+        by_appliance = {}
+        for reading in readings:
+            by_appliance.setdefault(reading[0], []).append(reading)
+
+        rows = []
+        late = 0
+        for appliance_id, batch in by_appliance.items():
+            stamps = [reading[1] for reading in batch]
+            seen = {ts for (ts,) in conn.execute(EXISTING_TS_SQL, (appliance_id, min(stamps), max(stamps)))}
+            newest = conn.execute(NEWEST_TS_SQL, (appliance_id,)).fetchone()[0]
+            for _, ts, watts, _ in batch:
+                if ts in seen:
+                    continue
+                seen.add(ts)
+                if newest is not None and ts < newest:
+                    late += 1
+                rows.append((time.strftime(TIMESTAMP_FORMAT, time.localtime(ts)), ts, watts, appliance_id))
+        return rows, late
+
+    def write(self, readings):
+        """Insert the readings not already stored, returns received/inserted/duplicate/late counts
+
+        late readings are inserted too, late is only informational.
+        """
+        with self._lock, BATCH_SECONDS.time():
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")  # Take the write lock before the duplicate check
+            try:
+                self._register(conn, readings)
+                rows, late = self._new_rows(conn, readings)
+                conn.executemany(INSERT_SQL, rows)
+                if rows and self.hooks:
+                    inserted = [(row[3], row[1], row[2]) for row in rows]
+                    for hook in self.hooks:
+                        hook(conn, inserted)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        duplicates = len(readings) - len(rows)
+        ROWS_INGESTED.inc(len(rows))
+        DUPLICATES.inc(duplicates)
+        LATE.inc(late)
+        return {"received": len(readings), "inserted": len(rows), "duplicates": duplicates, "late": late}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
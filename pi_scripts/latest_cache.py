@@ -0,0 +1,300 @@
+"""
+In-memory cache of the latest reading per appliance
+
+The sampler commits a batch every few seconds at most, so there is no point
+in hitting SQLite for every /energy poll. The cache watches PRAGMA
+data_version on its own read-only connection: the value changes whenever
+another connection (the sampler, an ingest) commits to the database. Only
+then are the new rows read, by rowid, and each appliance's entry replaced
+once with its newest row. Requests are answered from memory with bodies
+serialised on first use.
+
+Rows are only ever added at the end (usage.id is AUTOINCREMENT), so new
+rows are enough until something is deleted (retention, archiving, a
+disaggregation rebuild). A trigger counts deleted rows in usage_deletes
+(migration 12); when the count moves, every entry is reloaded. On a
+database without the counter only deletions of the oldest rows are seen,
+through MIN(rowid).
+
+Given an appliances.ApplianceRegistry, the cache reloads it on the same
+data_version change and updates the entries of renamed appliances.
+
+data_version(appliance_id) is a token that changes whenever rows for that
+appliance arrive, or rows are deleted (retention, archiving), and is what
+the API's response cache keys history responses on.
+
+Listeners added with add_listener() are called on the event loop with the
+list of every new reading (not only the latest) after each poll, which is
+how /energy/stream is fed without any per-client query.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 0.5  # Seconds between data_version checks
+
+# Loose index scan over idx_usage_appliance_ts: one seek per appliance
+APPLIANCE_IDS_SQL = '''
+    WITH RECURSIVE ids(id) AS (
+        SELECT MIN(appliance_id) FROM usage
+        UNION ALL
+        SELECT (SELECT MIN(appliance_id) FROM usage WHERE appliance_id > ids.id)
+        FROM ids WHERE ids.id IS NOT NULL
+    )
+    SELECT id FROM ids WHERE id IS NOT NULL
+'''
+
+# Names come from the appliances registry, or the row for older writers
+LATEST_FOR_APPLIANCE_SQL = '''
+    SELECT usage.rowid, appliance_id, timestamp, watts, COALESCE(appliances.name, appliance_name), ts
+    FROM usage LEFT JOIN appliances ON appliances.id = usage.appliance_id
+    WHERE appliance_id = ? ORDER BY ts DESC LIMIT 1
+'''
+
+NEW_ROWS_SQL = '''
+    SELECT usage.rowid, appliance_id, timestamp, watts, COALESCE(appliances.name, appliance_name), ts
+    FROM usage LEFT JOIN appliances ON appliances.id = usage.appliance_id
+    WHERE usage.rowid > ? ORDER BY usage.rowid
+'''
+
+
+class LatestEntry:
+    """Latest reading for one appliance plus its ready-to-send bodies, built on first use"""
+
+    __slots__ = ("rowid", "appliance_id", "timestamp", "watts", "appliance_name", "ts",
+                 "_etag", "_body", "_appliance_body")
+
+    def __init__(self, rowid, appliance_id, timestamp, watts, appliance_name, ts):
+        self.rowid = rowid
+        self.appliance_id = appliance_id
+        self.timestamp = timestamp
+        self.watts = watts
+        self.appliance_name = appliance_name
+        self.ts = ts
+        self._etag = self._body = self._appliance_body = None
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            # The name is part of the body, so a rename has to change the tag too
+            name_crc = zlib.crc32((self.appliance_name or "").encode())
+            self._etag = f'"{self.appliance_id}-{self.ts}-{self.rowid}-{name_crc:x}"'
+        return self._etag
+
+    @property
+    def body(self):
+        """/energy response body"""
+        if self._body is None:
+            self._body = json.dumps(
+                {"timestamp": self.timestamp, "watts": self.watts}, separators=(",", ":")
+            ).encode()
+        return self._body
+
+    @property
+    def appliance_body(self):
+        """/energy/{appliance_id} response body, also streamed"""
+        if self._appliance_body is None:
+            self._appliance_body = json.dumps({
+                "timestamp": self.timestamp,
+                "watts": self.watts,
+                "appliance_id": self.appliance_id,
+                "appliance_name": self.appliance_name
+            }, separators=(",", ":")).encode()
+        return self._appliance_body
+
+
+class LatestReadingCache:
+    """Per-appliance latest reading kept fresh by PRAGMA data_version"""
+
+    def __init__(self, db_path, poll_interval=DEFAULT_POLL_INTERVAL, registry=None):
+        self.db_path = db_path
+        self.poll_interval = poll_interval
+        self.registry = registry
+
+        self._entries = {}
+        self._conn = None
+        self._data_version = None
+        self._last_rowid = 0
+        self._first_rowid = None
+        self._deletes = None
+        self._generation = 0   # Bumped on every full reload
+        self._versions = {}    # appliance_id -> data_version its last new row arrived at
+        self._lock = threading.Lock()
+        self._task = None
+        self._listeners = []
+        self._updates = []
+
+        self.refreshes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 2000")
+        return conn
+
+    def _deleted_rows(self):
+        """usage_deletes count, None before migration 12"""
+        try:
+            return self._conn.execute("SELECT count FROM usage_deletes WHERE id = 1").fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+
+    def _load_all(self, first_rowid, deletes):
+        self._entries = {}
+        self._versions = {}
+        self._generation += 1
+        self._first_rowid = first_rowid
+        self._deletes = deletes
+        self._last_rowid = self._conn.execute("SELECT MAX(rowid) FROM usage").fetchone()[0] or 0
+        for (appliance_id,) in self._conn.execute(APPLIANCE_IDS_SQL).fetchall():
+            row = self._conn.execute(LATEST_FOR_APPLIANCE_SQL, (appliance_id,)).fetchone()
+            if row:
+                self._entries[appliance_id] = LatestEntry(*row)
+
+    def _apply(self, rows, version):
+        """Replace each appliance's entry once with its newest new row"""
+        newest = {}
+        for row in rows:
+            current = newest.get(row[1])
+            if current is None or (row[5] or 0) >= (current[5] or 0):
+                newest[row[1]] = row
+        for appliance_id, row in newest.items():
+            self._versions[appliance_id] = version
+            current = self._entries.get(appliance_id)
+            # Late (backfilled) readings can arrive with a higher rowid but older ts
+            if current is None or (row[5] or 0) >= (current.ts or 0):
+                self._entries[appliance_id] = LatestEntry(*row)
+
+    def refresh(self):
+        """Check data_version and pull in new rows, returns True if anything changed"""
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self._conn = self._connect()
+                version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+                if version == self._data_version:
+                    return False
+
+                # One read transaction, so the delete count and the new rows see the same commits
+                self._conn.execute("BEGIN")
+                try:
+                    renamed = self.registry.load(self._conn) if self.registry is not None else ()
+                    first_rowid = self._conn.execute("SELECT MIN(rowid) FROM usage").fetchone()[0]
+                    deletes = self._deleted_rows()
+                    if self._data_version is None or first_rowid != self._first_rowid \
+                            or deletes != self._deletes:
+                        # First load, or rows were deleted
+                        self._load_all(first_rowid, deletes)
+                    else:
+                        rows = self._conn.execute(NEW_ROWS_SQL, (self._last_rowid,)).fetchall()
+                        self._apply(rows, version)
+                        if self._listeners:
+                            # Bodies are only serialised if a subscriber is there to send them to
+                            self._updates.extend(LatestEntry(*row) for row in rows)
+                        if rows:
+                            self._last_rowid = rows[-1][0]
+                        for appliance_id in renamed:
+                            self._rename(appliance_id)
+                finally:
+                    self._conn.execute("COMMIT")
+                self._data_version = version
+                self.refreshes += 1
+                return True
+            except sqlite3.Error as e:
+                # Missing table/database: start over on the next poll
+                logger.warning(f"Latest reading cache refresh failed: {e}")
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = None
+                self._data_version = None
+                return False
+
+    def _rename(self, appliance_id):
+        entry = self._entries.get(appliance_id)
+        name = self.registry.name(appliance_id)
+        if entry is not None and name is not None and name != entry.appliance_name:
+            self._entries[appliance_id] = LatestEntry(
+                entry.rowid, appliance_id, entry.timestamp, entry.watts, name, entry.ts
+            )
+
+    def data_version(self, appliance_id=None):
+        """Token for the stored readings of one appliance, or of all of them
+
+        None until the cache has loaded. Call refresh() first for an
+        up-to-date value.
+        """
+        if self._data_version is None:
+            return None
+        if appliance_id is None:
+            return self._generation, self._data_version
+        return self._generation, self._versions.get(appliance_id, 0)
+
+    def get(self, appliance_id):
+        entry = self._entries.get(appliance_id)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def entries(self, appliance_id=None):
+        """Current latest entries, all appliances or just one"""
+        if appliance_id is None:
+            return [self._entries[key] for key in sorted(self._entries)]
+        entry = self._entries.get(appliance_id)
+        return [entry] if entry is not None else []
+
+    def add_listener(self, callback):
+        """callback(entries) runs on the event loop with each poll's new readings"""
+        self._listeners.append(callback)
+
+    def drain_updates(self):
+        with self._lock:
+            updates, self._updates = self._updates, []
+        return updates
+
+    async def _poll(self):
+        while True:
+            await asyncio.to_thread(self.refresh)
+            updates = self.drain_updates()
+            if updates:
+                for callback in self._listeners:
+                    try:
+                        callback(updates)
+                    except Exception as e:
+                        logger.error(f"Latest reading listener failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def start(self):
+        if self._task is None:
+            await asyncio.to_thread(self.refresh)
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._data_version = None
+
+    def stats(self):
+        return {
+            "appliances": len(self._entries),
+            "refreshes": self.refreshes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
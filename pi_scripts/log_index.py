@@ -0,0 +1,310 @@
+"""
+Incremental index over the energy monitor and API log files
+
+Each LogIndex remembers how far into its log it has read, how many record
+lines it has seen and the byte offset where every hour of records starts.
+On update() only the bytes appended since the last call are parsed, so
+record counts are O(1) and time-range reads seek straight to the first
+relevant hour instead of scanning from the top. The index is saved next to
+the log (<log>.idx) and is rebuilt when the log is rotated or truncated.
+
+RotatedLog adds the rotated, usually gzipped, segments that
+managed_logging leaves next to the live file (<log>.<YYYYmmdd-HHMMSS>.gz),
+so records can be counted and read across the whole retained history.
+Segments never change once written, so each is summarised only once.
+"""
+
+import bisect
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# "Time: 2024-01-15 14:30:25, Power: 43.50 W"
+ENERGY_RECORD_RE = re.compile(rb'Time: (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}), Power: ([\d.]+) W')
+# Any line carrying a timestamp (API log)
+TIMESTAMP_RE = re.compile(rb'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+
+BUCKET_KEY_LENGTH = 13   # 'YYYY-MM-DD HH'
+HEAD_SIGNATURE_SIZE = 64  # Bytes compared to spot a replaced file with the same inode
+READ_CHUNK_SIZE = 1 << 20
+
+
+class LogIndex:
+    """Byte offsets per hour bucket and a running record count for one log"""
+
+    def __init__(self, log_path, pattern, index_path=None):
+        self.log_path = log_path
+        self.pattern = pattern
+        self.index_path = index_path or f"{log_path}.idx"
+        self._lock = threading.Lock()
+        self._reset()
+        self._load()
+
+    def _reset(self):
+        self.inode = None
+        self.head = ""
+        self.offset = 0      # Bytes parsed so far, always at a line boundary
+        self.records = 0
+        self.bucket_keys = []     # Sorted 'YYYY-MM-DD HH' keys
+        self.bucket_offsets = {}  # key -> offset of the first record line in that hour
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                state = json.load(f)
+            self.inode = state["inode"]
+            self.head = state["head"]
+            self.offset = state["offset"]
+            self.records = state["records"]
+            self.bucket_offsets = state["buckets"]
+            self.bucket_keys = sorted(self.bucket_offsets)
+        except (OSError, ValueError, KeyError):
+            self._reset()
+
+    def _save(self):
+        state = {
+            "inode": self.inode,
+            "head": self.head,
+            "offset": self.offset,
+            "records": self.records,
+            "buckets": self.bucket_offsets,
+        }
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not save log index {self.index_path}: {e}")
+
+    def _read_head(self, f):
+        f.seek(0)
+        return f.read(HEAD_SIGNATURE_SIZE).hex()
+
+    def update(self):
+        """Parse whatever was appended since the last update, returns False if the log is missing"""
+        with self._lock:
+            try:
+                f = open(self.log_path, 'rb')
+            except FileNotFoundError:
+                if self.inode is not None:
+                    self._reset()
+                return False
+
+            with f:
+                st = os.fstat(f.fileno())
+                head = self._read_head(f)
+                rotated = (
+                    st.st_ino != self.inode
+                    or st.st_size < self.offset
+                    or not head.startswith(self.head)
+                )
+                if rotated:
+                    if self.inode is not None:
+                        logger.info(f"{self.log_path} was rotated or truncated, reindexing")
+                    self._reset()
+                    self.inode = st.st_ino
+                if self.offset == st.st_size and not rotated:
+                    return True
+
+                changed = self._scan(f)
+                self.head = head
+                if changed or rotated:
+                    self._save()
+            return True
+
+    def _scan(self, f):
+        f.seek(self.offset)
+        offset = self.offset
+        pending = b""
+        start_offset = offset
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = pending + chunk
+            end = data.rfind(b"\n")
+            if end == -1:
+                pending = data
+                continue
+            pending = data[end + 1:]
+            for line in data[:end + 1].splitlines(keepends=True):
+                match = self.pattern.search(line)
+                if match:
+                    self._add_record(match.group(1), offset)
+                offset += len(line)
+        # A trailing partial line is left for the next update
+        self.offset = offset
+        return offset != start_offset
+
+    def _add_record(self, timestamp, offset):
+        self.records += 1
+        key = timestamp[:BUCKET_KEY_LENGTH].decode()
+        if key not in self.bucket_offsets:
+            self.bucket_offsets[key] = offset
+            bisect.insort(self.bucket_keys, key)
+
+    def offset_for(self, since):
+        """Offset of the first record at or after since ('YYYY-MM-DD HH:MM:SS' or datetime)"""
+        key = str(since)[:BUCKET_KEY_LENGTH]
+        with self._lock:
+            i = bisect.bisect_left(self.bucket_keys, key)
+            if i == len(self.bucket_keys):
+                return self.offset
+            return self.bucket_offsets[self.bucket_keys[i]]
+
+    def iter_records(self, start=0):
+        """Yield (offset, match) for each indexed record line from start onwards"""
+        end = self.offset
+        if start >= end:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if offset >= end:
+                    break
+                match = self.pattern.search(line)
+                if match:
+                    yield offset, match
+                offset += len(line)
+
+    def stats(self):
+        return {
+            "indexed_bytes": self.offset,
+            "records": self.records,
+            "buckets": len(self.bucket_keys),
+        }
+
+
+class RotatedLog:
+    """A LogIndex over the live file plus the rotated segments beside it
+
+    Positions are (segment, offset) pairs: segment is the rotated file's
+    suffix ('20241204-000000') or None for the live file, offset is a byte
+    offset into the segment's uncompressed contents.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._summaries = {}  # segment -> (file size, records, first ts, last ts)
+        self._lock = threading.Lock()  # Requests summarise segments from worker threads
+
+    def segment_paths(self):
+        """{segment: path} of every rotated segment, oldest first"""
+        directory, base = os.path.split(os.path.abspath(self.index.log_path))
+        prefix = base + "."
+        paths = {}
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return paths
+        for name in names:
+            suffix = name[len(prefix):]
+            if not name.startswith(prefix) or not suffix[:1].isdigit() or name.endswith(".tmp"):
+                continue
+            segment = suffix[:-3] if suffix.endswith(".gz") else suffix
+            # Mid-compression both files exist; either holds the same lines
+            paths.setdefault(segment, os.path.join(directory, name))
+        return dict(sorted(paths.items()))
+
+    @staticmethod
+    def _open(path):
+        return gzip.open(path, 'rb') if path.endswith(".gz") else open(path, 'rb')
+
+    def _summary(self, segment, path):
+        size = os.path.getsize(path)
+        with self._lock:
+            cached = self._summaries.get(segment)
+        if cached is not None and cached[0] == size:
+            return cached
+        records = 0
+        first = last = None
+        with self._open(path) as f:
+            for line in f:
+                match = self.index.pattern.search(line)
+                if match:
+                    records += 1
+                    last = match.group(1).decode()
+                    if first is None:
+                        first = last
+        summary = (size, records, first, last)
+        with self._lock:
+            self._summaries[segment] = summary
+        return summary
+
+    def update(self):
+        """Bring the live index up to date and summarise any new segments"""
+        live = self.index.update()
+        paths = self.segment_paths()
+        with self._lock:
+            for segment in list(self._summaries):
+                if segment not in paths:
+                    del self._summaries[segment]
+        for segment, path in paths.items():
+            self._summary(segment, path)
+        return live or bool(paths)
+
+    def version(self):
+        """Hashable state that changes whenever a line is added or a segment rotates or is pruned
+
+        Only meaningful right after update().
+        """
+        with self._lock:
+            segments = tuple((segment, s[0]) for segment, s in self._summaries.items())
+        return (self.index.inode, self.index.offset, segments)
+
+    @property
+    def records(self):
+        with self._lock:
+            segment_records = sum(s[1] for s in self._summaries.values())
+        return self.index.records + segment_records
+
+    def stats(self):
+        paths = self.segment_paths()
+        return {
+            "segments": len(paths),
+            "segment_bytes": sum(os.path.getsize(p) for p in paths.values()),
+            "records": self.records,
+        }
+
+    def _iter_segment(self, segment, path, start):
+        with self._open(path) as f:
+            if start:
+                f.seek(start)
+            offset = start
+            for line in f:
+                match = self.index.pattern.search(line)
+                if match:
+                    yield (segment, offset), match
+                offset += len(line)
+
+    def iter_records(self, position=("", 0)):
+        """Yield ((segment, offset), match) from position to the end of the live file
+
+        The default position ("", 0) is the start of the oldest segment. A
+        segment that has since been pruned resumes at the next one left.
+        """
+        segment, start = position
+        if segment is not None:
+            for name, path in self.segment_paths().items():
+                if name < segment:
+                    continue
+                yield from self._iter_segment(name, path, start if name == segment else 0)
+            start = 0
+        for offset, match in self.index.iter_records(start):
+            yield (None, offset), match
+
+    def position_for(self, since):
+        """Position of the first record at or after since ('YYYY-MM-DD HH:MM:SS')"""
+        since = str(since)
+        for segment, path in self.segment_paths().items():
+            _, records, _, last = self._summary(segment, path)
+            if records and last >= since:
+                return segment, 0
+        return None, self.index.offset_for(since)
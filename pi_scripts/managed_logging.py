@@ -0,0 +1,221 @@
+"""
+Rotating, compressed, non-blocking log files for the sampler and the API
+
+Log calls only format the record and put it on a bounded queue; a
+QueueListener thread does the file I/O. If the queue ever fills up (the SD
+card stalls) records are dropped and counted instead of blocking the
+caller, so logging can never hold up a sample.
+
+Files rotate when they reach max_bytes and at local midnight. A rotated
+segment is renamed to <log>.<YYYYmmdd-HHMMSS> and gzipped to
+<log>.<YYYYmmdd-HHMMSS>.gz; segments beyond backup_count or older than
+max_age_days are deleted. log_index.RotatedLog reads across them.
+"""
+
+import atexit
+import gzip
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from logging.handlers import BaseRotatingHandler, QueueHandler, QueueListener
+
+import metrics
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 30
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_QUEUE_SIZE = 10000  # Records waiting for the writer thread before new ones are dropped
+
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+DEFAULT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+def _next_midnight(now):
+    lt = time.localtime(now + 86400)
+    return time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+class ManagedFileHandler(BaseRotatingHandler):
+    """Size- and midnight-rotating file handler that gzips and prunes old segments"""
+
+    def __init__(self, filename, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS, rotate_daily=True, compress=True,
+                 encoding="utf-8"):
+        super().__init__(os.path.abspath(filename), "a", encoding=encoding, delay=False)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_age_days = max_age_days
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+        self.rollover_at = _next_midnight(time.time()) if rotate_daily else None
+        self.rotations = 0
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        if self.max_bytes and self.stream is not None:
+            self.stream.seek(0, 2)  # Other writers may have appended
+            if self.stream.tell() >= self.max_bytes:
+                return True
+        return False
+
+    def _segment_name(self):
+        stamp = time.strftime(SEGMENT_TIME_FORMAT)
+        name = f"{self.baseFilename}.{stamp}"
+        n = 1
+        while os.path.exists(name) or os.path.exists(name + ".gz"):
+            name = f"{self.baseFilename}.{stamp}-{n}"
+            n += 1
+        return name
+
+    def segments(self):
+        """Rotated segment paths, oldest first"""
+        directory, base = os.path.split(self.baseFilename)
+        prefix = base + "."
+        names = [
+            name for name in os.listdir(directory)
+            if name.startswith(prefix) and name[len(prefix):len(prefix) + 1].isdigit()
+            and not name.endswith(".tmp")
+        ]
+        return [os.path.join(directory, name) for name in sorted(names)]
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            segment = self._segment_name()
+            os.rename(self.baseFilename, segment)
+            if self.compress:
+                self._gzip(segment)
+            self.rotations += 1
+        self._prune()
+
+        if self.rotate_daily:
+            self.rollover_at = _next_midnight(time.time())
+        self.stream = self._open()
+
+    def _gzip(self, path):
+        tmp_path = path + ".gz.tmp"
+        with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, path + ".gz")
+        os.remove(path)
+
+    def _prune(self):
+        segments = self.segments()
+        expired = segments[:max(len(segments) - self.backup_count, 0)]
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 86400
+            expired += [p for p in segments if p not in expired and os.path.getmtime(p) < cutoff]
+        for path in expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _ManagedLog:
+    """Queue, writer thread and rotating file shared by every handler of one log file"""
+
+    def __init__(self, path, **kwargs):
+        self.queue = queue.Queue(maxsize=DEFAULT_QUEUE_SIZE)
+        self.file_handler = ManagedFileHandler(path, **kwargs)
+        # Records arrive already formatted by the queue handlers
+        self.file_handler.setFormatter(logging.Formatter("%(message)s"))
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.handlers = []
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+    def add_output(self, handler):
+        """Also send this file's records to handler (e.g. the console) from the writer thread"""
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.listener.handlers = self.listener.handlers + (handler,)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": sum(handler.dropped for handler in self.handlers),
+            "rotations": self.file_handler.rotations,
+        }
+
+
+_logs = {}  # Absolute log path -> _ManagedLog
+_lock = threading.Lock()
+
+
+def _managed_log(filename, **kwargs):
+    path = os.path.abspath(filename)
+    with _lock:
+        if path not in _logs:
+            _logs[path] = _ManagedLog(path, **kwargs)
+        return _logs[path]
+
+
+def queued_file_handler(filename, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT,
+                        max_age_days=DEFAULT_MAX_AGE_DAYS, rotate_daily=True, compress=True):
+    """Handler that writes to filename through a background thread
+
+    Every handler for the same file shares one queue, writer thread and
+    rotation, so several loggers (e.g. uvicorn and uvicorn.access, each with
+    its own formatter) can log to one file safely. Usable from dictConfig
+    via "()": "managed_logging.queued_file_handler".
+    """
+    log = _managed_log(
+        filename, max_bytes=max_bytes, backup_count=backup_count,
+        max_age_days=max_age_days, rotate_daily=rotate_daily, compress=compress,
+    )
+    handler = NonBlockingQueueHandler(log.queue)
+    log.handlers.append(handler)
+    return handler
+
+
+def setup(filename, level=logging.INFO, fmt=DEFAULT_FORMAT, console=True, **kwargs):
+    """Route the root logger to a managed log file (and the console), returns the handler"""
+    handler = queued_file_handler(filename, **kwargs)
+    handler.setFormatter(logging.Formatter(fmt))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+    if console:
+        _managed_log(filename).add_output(logging.StreamHandler(sys.stdout))
+    return handler
+
+
+def stats():
+    """Queue depth, drops and rotations per managed log file"""
+    return {os.path.basename(path): log.stats() for path, log in _logs.items()}
+
+
+def register_metrics(registry=metrics.REGISTRY):
+    """Export queue depth, drops and rotations of every managed log file"""
+    def per_log(key):
+        return lambda: [((name,), figures[key]) for name, figures in stats().items()]
+
+    for name, help, key, type in [
+        ("log_queue_depth", "Records waiting for the log writer thread", "queued", "gauge"),
+        ("log_records_dropped", "Records dropped because the log queue was full", "dropped", "counter"),
+        ("log_rotations", "Log file rotations", "rotations", "counter"),
+    ]:
+        metrics.CallbackMetric(name, help, per_log(key), type=type, labelnames=["file"],
+                               registry=registry)
@@ -0,0 +1,368 @@
+"""
+Prometheus-style metrics for the sampler and the API
+
+A small, dependency-free subset of the Prometheus client: counters,
+gauges and histograms with fixed buckets, plus callback metrics that read
+existing stats() figures only when scraped. Recording an observation is a
+bisect and two additions under a lock (a few microseconds on a Pi), so
+histograms are safe to use in the sampler's loop and the database writer.
+
+The API serves the registry at /metrics; energy_monitor.py runs
+start_http_server() as a sidecar exporter on METRICS_PORT. Both use the
+text exposition format, scraped with e.g.
+
+    scrape_configs:
+      - job_name: energy
+        static_configs:
+          - targets: ["raspberrypi:8000", "raspberrypi:9101"]
+"""
+
+import bisect
+import math
+import os
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from sub-millisecond cache hits to multi-second SD card stalls
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Registry:
+    """Set of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            # The 0.0.4 text format wants the TYPE line under the sample name
+            name = metric.name + "_total" if metric.type == "counter" else metric.name
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for suffix, label_text, value in metric.samples():
+                lines.append(f"{name}{suffix}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames and not isinstance(self, CallbackMetric):
+            self.labels()  # Unlabelled metrics are exported as 0 before the first update
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """The child metric for one combination of label values"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} needs labels {self.labelnames}")
+        return self.labels()
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type = "counter"
+    _new_child = _CounterChild
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def samples(self):
+        for key, child in self._items():
+            yield "", _label_text(self.labelnames, key), child.value
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down"""
+
+    type = "gauge"
+    _new_child = _GaugeChild
+
+    def set(self, value):
+        self._default().set(value)
+
+    def samples(self):
+        for key, child in self._items():
+            yield "", _label_text(self.labelnames, key), child.value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last slot is the +Inf bucket
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class _Timer:
+    """Context manager observing the seconds spent inside it"""
+
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def samples(self):
+        for key, child in self._items():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), counts):
+                cumulative += count
+                le = (("le", _format_value(bound)),)
+                yield "_bucket", _label_text(self.labelnames, key, le), cumulative
+            yield "_count", _label_text(self.labelnames, key), cumulative
+            yield "_sum", _label_text(self.labelnames, key), total
+
+
+class CallbackMetric(_Metric):
+    """Gauge or counter whose value is read from func() at scrape time
+
+    func returns a number, or for labelled metrics an iterable of
+    (label values, number) pairs. Nothing is recorded between scrapes, so
+    this suits figures that stats() methods already keep.
+    """
+
+    def __init__(self, name, help, func, type="gauge", labelnames=(), registry=REGISTRY):
+        self.type = type
+        self.func = func
+        super().__init__(name, help, labelnames, registry)
+
+    def samples(self):
+        if self.labelnames:
+            for values, value in self.func():
+                yield "", _label_text(self.labelnames, values), value
+        else:
+            yield "", "", self.func()
+
+
+def register_process_metrics(registry=REGISTRY, prefix="process"):
+    """CPU time, peak RSS and start time of this process"""
+    started = time.time()
+
+    def cpu_seconds():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    def max_rss_bytes():
+        # KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def open_fds():
+        try:
+            return len(os.listdir("/proc/self/fd"))
+        except OSError:
+            return 0
+
+    CallbackMetric(f"{prefix}_cpu_seconds", "User and system CPU time", cpu_seconds,
+                   type="counter", registry=registry)
+    CallbackMetric(f"{prefix}_max_resident_memory_bytes", "Peak resident set size", max_rss_bytes,
+                   registry=registry)
+    CallbackMetric(f"{prefix}_open_fds", "Open file descriptors", open_fds, registry=registry)
+    CallbackMetric(f"{prefix}_start_time_seconds", "Start time since the epoch",
+                   lambda: started, registry=registry)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware observing every HTTP request's duration per route template
+
+    Timed until the last body chunk is sent, so streamed responses count
+    their full length. Requests that matched no route are labelled
+    "unmatched" to keep the label set bounded.
+    """
+
+    def __init__(self, app, histogram):
+        self.app = app
+        self.histogram = histogram
+        self._route_paths = None
+
+    def _route_path(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._route_paths is None:
+            router = scope.get("router")
+            self._route_paths = {
+                getattr(route, "endpoint", None): route.path for route in getattr(router, "routes", ())
+            }
+        return self._route_paths.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.histogram.labels(scope["method"], self._route_path(scope), status).observe(
+                time.perf_counter() - start
+            )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the log
+
+
+def start_http_server(port, addr="0.0.0.0", registry=REGISTRY):
+    """Serve registry at http://addr:port/metrics from a daemon thread, returns the server"""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -1,53 +1,389 @@
-""" 
+"""
+
+Versioned database migrations for the energy monitor
+
+The schema version is stored in PRAGMA user_version. Each migration runs
+once, in order, and bumps the version when it completes. Long-running data
+migrations work in small chunks with their position saved in the
+migration_progress table, so they can run against a live database and be
+interrupted and resumed at any time.
 
-Database migration script to add appliance support to existing data
+Usage:
+    python3 migrate_database.py              # Apply pending migrations
+    python3 migrate_database.py --status     # Show current/latest version
 
 """
 
+import argparse
+import logging
 import sqlite3
+import time
 from pathlib import Path
 
+import appliances
+import consumption
+import events
+import rollups
+
 SCRIPT_DIR = Path(__file__).parent.absolute()
 DB_PATH = SCRIPT_DIR / "energy_data.db"
 
-def migrate():
-    print("Starting database migration...")
-    conn = sqlite3.connect(str(DB_PATH))
-    c = conn.cursor()
+DEFAULT_CHUNK_SIZE = 10000   # Rows updated per transaction during backfills
+DEFAULT_CHUNK_PAUSE = 0.05   # Seconds between chunks, lets the sampler get the write lock
+
+# Local-time 'YYYY-MM-DD HH:MM:SS' text -> Unix epoch seconds
+EPOCH_FROM_TEXT = "CAST(strftime('%s', {col}, 'utc') AS INTEGER)"
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_appliance_columns(conn, **kwargs):
+    """Create the usage table and add appliance support to existing data"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        watts REAL NOT NULL,
+        appliance_id INTEGER DEFAULT 1,
+        appliance_name TEXT DEFAULT 'Main Appliance'
+    )''')
+
+    columns = table_columns(conn, "usage")
+    if 'appliance_id' not in columns:
+        logger.info("Adding appliance_id column...")
+        conn.execute("ALTER TABLE usage ADD COLUMN appliance_id INTEGER DEFAULT 1")
+
+    if 'appliance_name' not in columns:
+        logger.info("Adding appliance_name column...")
+        conn.execute("ALTER TABLE usage ADD COLUMN appliance_name TEXT DEFAULT 'Main Appliance'")
+
+    if 'id' not in columns:
+        logger.info("Note: Cannot add primary key to existing table, rowid is used instead.")
+
+
+def migrate_epoch_column(conn, **kwargs):
+    """Add the integer epoch ts column and keep it filled for legacy writers"""
+    if 'ts' not in table_columns(conn, "usage"):
+        logger.info("Adding ts column...")
+        conn.execute("ALTER TABLE usage ADD COLUMN ts INTEGER")
+
+    # Writers that only insert the TEXT timestamp still get a ts value
+    conn.execute(f'''CREATE TRIGGER IF NOT EXISTS usage_fill_ts
+        AFTER INSERT ON usage WHEN NEW.ts IS NULL
+        BEGIN
+            UPDATE usage SET ts = {EPOCH_FROM_TEXT.format(col='NEW.timestamp')}
+            WHERE rowid = NEW.rowid;
+        END''')
+
+
+def backfill_epoch_column(conn, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE):
+    """Fill ts for existing rows, newest first, in resumable chunks
+
+    Rows inserted after this starts are covered by the usage_fill_ts trigger,
+    so only rowids up to the current maximum need to be visited. Newest rows
+    go first so the API sees recent data as soon as possible.
+    """
+    version = 3
+    progress = conn.execute(
+        "SELECT cursor FROM migration_progress WHERE version = ?", (version,)
+    ).fetchone()
+    if progress:
+        cursor = progress[0]
+        logger.info(f"Resuming ts backfill below rowid {cursor}")
+    else:
+        cursor = (conn.execute("SELECT MAX(rowid) FROM usage").fetchone()[0] or 0) + 1
+
+    total = 0
+    while cursor > 1:
+        low = max(cursor - chunk_size, 1)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = conn.execute(
+                f"UPDATE usage SET ts = {EPOCH_FROM_TEXT.format(col='timestamp')} "
+                "WHERE rowid >= ? AND rowid < ? AND ts IS NULL",
+                (low, cursor)
+            ).rowcount
+            conn.execute(
+                "INSERT OR REPLACE INTO migration_progress (version, cursor) VALUES (?, ?)",
+                (version, low)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        cursor = low
+        total += updated
+        logger.info(f"Backfilled {total} rows (down to rowid {cursor})")
+        if pause:
+            time.sleep(pause)
+
+
+def migrate_appliance_ts_index(conn, **kwargs):
+    """Covering index for WHERE appliance_id = ? ORDER BY ts DESC LIMIT n"""
+    logger.info("Creating idx_usage_appliance_ts index...")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_usage_appliance_ts ON usage(appliance_id, ts, watts)"
+    )
+
+
+def migrate_rollup_tables(conn, **kwargs):
+    """Minute/hour/day aggregate tables, see rollups.py"""
+    logger.info("Creating rollup tables...")
+    rollups.create_tables(conn)
+
+
+def resumable_backfill(conn, version, maintainer, chunk_size, pause, what):
+    """Feed every usage row through maintainer, saving progress under version
+
+    Writers that run the maintainer only start once migrations are complete,
+    so every row present when this (re)starts still needs processing.
+    """
+    progress = conn.execute(
+        "SELECT cursor FROM migration_progress WHERE version = ?", (version,)
+    ).fetchone()
+    start = progress[0] if progress else 1
+    end = conn.execute("SELECT MAX(rowid) FROM usage").fetchone()[0] or 0
+    if progress:
+        logger.info(f"Resuming {what} backfill from rowid {start}")
+
+    def save_progress(cursor):
+        conn.execute(
+            "INSERT OR REPLACE INTO migration_progress (version, cursor) VALUES (?, ?)",
+            (version, cursor)
+        )
+
+    rollups.backfill(conn, start, end, chunk_size=chunk_size, pause=pause,
+                     on_chunk=save_progress, maintainer=maintainer)
+
+
+def backfill_rollups(conn, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE):
+    """Roll up the readings that were written before the rollup tables existed"""
+    resumable_backfill(conn, 6, rollups.RollupMaintainer(), chunk_size, pause, "rollup")
+
+
+def migrate_energy_totals(conn, **kwargs):
+    """Per day/week/month/year kWh accumulators, see consumption.py"""
+    logger.info("Creating energy_totals table...")
+    consumption.create_tables(conn)
+
+
+def backfill_energy_totals(conn, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE):
+    """Integrate the readings written before energy_totals existed, with today's tariff bands"""
+    maintainer = consumption.ConsumptionMaintainer(consumption.load_tariff())
+    resumable_backfill(conn, 8, maintainer, chunk_size, pause, "energy totals")
+
+
+def migrate_events_table(conn, **kwargs):
+    """Table for the on/off, step, limit and stall events, see events.py"""
+    logger.info("Creating events table...")
+    events.create_tables(conn)
 
+
+def migrate_appliances_table(conn, **kwargs):
+    """Appliance registry, filled from the names stored in usage, see appliances.py"""
+    logger.info("Creating appliances table...")
+    appliances.create_tables(conn)
+    count = appliances.backfill(conn)
+    logger.info(f"Registered {count} appliances")
+
+
+def clear_usage_names(conn, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE):
+    """Set usage.appliance_name to NULL in resumable chunks, names now live in appliances
+
+    Writers store NULL from migration 10 on, so only rowids up to the current
+    maximum are visited. New rows reuse the freed space; VACUUM returns it to
+    the filesystem.
+    """
+    version = 11
+    progress = conn.execute(
+        "SELECT cursor FROM migration_progress WHERE version = ?", (version,)
+    ).fetchone()
+    cursor = progress[0] if progress else 1
+    end = conn.execute("SELECT MAX(rowid) FROM usage").fetchone()[0] or 0
+    if progress:
+        logger.info(f"Resuming appliance name clean-up from rowid {cursor}")
+
+    total = 0
+    while cursor <= end:
+        high = cursor + chunk_size
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            total += conn.execute(
+                "UPDATE usage SET appliance_name = NULL "
+                "WHERE rowid >= ? AND rowid < ? AND appliance_name IS NOT NULL",
+                (cursor, high)
+            ).rowcount
+            conn.execute(
+                "INSERT OR REPLACE INTO migration_progress (version, cursor) VALUES (?, ?)",
+                (version, high)
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        cursor = high
+        logger.info(f"Cleared {total} appliance names (up to rowid {cursor})")
+        if pause:
+            time.sleep(pause)
+
+
+def migrate_usage_delete_counter(conn, **kwargs):
+    """Count deleted usage rows, so caches notice deletions without scanning the table"""
+    logger.info("Creating usage_deletes counter...")
+    conn.execute('''CREATE TABLE IF NOT EXISTS usage_deletes (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        count INTEGER NOT NULL
+    )''')
+    conn.execute("INSERT OR IGNORE INTO usage_deletes (id, count) VALUES (1, 0)")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS usage_count_deletes
+        AFTER DELETE ON usage
+        BEGIN
+            UPDATE usage_deletes SET count = count + 1 WHERE id = 1;
+        END''')
+
+
+# (version, description, function, runs in its own chunked transactions)
+MIGRATIONS = [
+    (1, "appliance columns", migrate_appliance_columns, False),
+    (2, "integer epoch ts column", migrate_epoch_column, False),
+    (3, "backfill ts for existing rows", backfill_epoch_column, True),
+    (4, "(appliance_id, ts) covering index", migrate_appliance_ts_index, False),
+    (5, "minute/hour/day rollup tables", migrate_rollup_tables, False),
+    (6, "backfill rollups for existing rows", backfill_rollups, True),
+    (7, "energy_totals kWh accumulators", migrate_energy_totals, False),
+    (8, "backfill energy totals for existing rows", backfill_energy_totals, True),
+    (9, "events table", migrate_events_table, False),
+    (10, "appliances registry", migrate_appliances_table, False),
+    (11, "clear per-row appliance names", clear_usage_names, True),
+    (12, "usage delete counter", migrate_usage_delete_counter, False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Not chunked, but a single CREATE INDEX over every row
+FULL_SCAN_MIGRATIONS = {4}
+# Rows below which every migration finishes in moments, e.g. at the sampler's startup
+STARTUP_ROW_LIMIT = DEFAULT_CHUNK_SIZE
+
+
+def table_columns(conn, table):
+    return [col[1] for col in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def pending_slow_migrations(conn, row_limit=STARTUP_ROW_LIMIT):
+    """Pending migrations that go through every stored reading, if there are more than row_limit
+
+    Empty on a new or small database, where applying them in line is fine.
+    """
+    version = get_version(conn)
+    pending = [
+        number for number, _, _, chunked in MIGRATIONS
+        if number > version and (chunked or number in FULL_SCAN_MIGRATIONS)
+    ]
+    if not pending:
+        return []
     try:
-        # Check if columns exist
-        c.execute("PRAGMA table_info(usage)")
-        columns = [col[1] for col in c.fetchall()]
+        rows = conn.execute("SELECT COUNT(*) FROM (SELECT 1 FROM usage LIMIT ?)", (row_limit + 1,)).fetchone()[0]
+    except sqlite3.OperationalError:  # No usage table yet
+        return []
+    return pending if rows > row_limit else []
+
 
-        changes_made = False
+def run_migrations(conn, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE):
+    """Apply every pending migration to an open connection, returns the new version"""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # Explicit BEGIN/COMMIT so DDL is transactional
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS migration_progress (
+            version INTEGER PRIMARY KEY,
+            cursor INTEGER NOT NULL
+        )''')
 
-        if 'appliance_id' not in columns:
-            print("Adding appliance_id column...")
-            c.execute("ALTER TABLE usage ADD COLUMN appliance_id INTEGER DEFAULT 1")
+        current = get_version(conn)
+        for version, description, func, chunked in MIGRATIONS:
+            if version <= current:
+                continue
 
-        if 'appliance_name' not in columns:
-            print("Adding appliance_name column...")
-            c.execute("ALTER TABLE usage ADD COLUMN appliance_name TEXT DEFAULT 'Main Appliance'")
+            logger.info(f"Applying migration {version}: {description}")
+            start = time.monotonic()
+            if chunked:
+                func(conn, chunk_size=chunk_size, pause=pause)
+                conn.execute("BEGIN IMMEDIATE")
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    func(conn)
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
 
-        if 'id' not in columns:
-            print("Note: Cannot add primary key to existing table. Consider recreating.")
+            conn.execute("DELETE FROM migration_progress WHERE version = ?", (version,))
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("COMMIT")
+            current = version
+            logger.info(f"Migration {version} done in {time.monotonic() - start:.1f}s")
+
+        return current
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def migrate(db_path=DB_PATH, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE):
+    logger.info("Starting database migration...")
+    conn = sqlite3.connect(str(db_path))
+
+    try:
+        # WAL lets API readers and the sampler keep going while we migrate
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout = 5000")
 
-        if not changes_made:
-            print("Database already up to date!")
+        before = get_version(conn)
+        if before >= LATEST_VERSION:
+            logger.info("Database already up to date!")
         else:
-            conn.commit()
-            print("Migration completed successfully.")
-        
+            after = run_migrations(conn, chunk_size=chunk_size, pause=pause)
+            logger.info(f"Migration completed successfully (version {before} -> {after}).")
+
+        c = conn.cursor()
         c.execute("SELECT COUNT(*) FROM usage WHERE appliance_id = 1")
         count = c.fetchone()[0]
-        print(f" Total records for Appliance 1: {count}")
+        logger.info(f" Total records for Appliance 1: {count}")
 
+    except KeyboardInterrupt:
+        logger.info("Migration interrupted, run again to resume.")
     except Exception as e:
-        print(f"Migration failed: {e}")
-        conn.rollback()
+        logger.error(f"Migration failed: {e}")
+    finally:
+        conn.close()
+
+
+def print_status(db_path=DB_PATH):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        version = get_version(conn)
+        print(f"Schema version: {version} (latest {LATEST_VERSION})")
+        for number, description, _, _ in MIGRATIONS:
+            state = "applied" if number <= version else "pending"
+            print(f"  {number}: {description} [{state}]")
     finally:
         conn.close()
 
+
 if __name__ == "__main__":
-    migrate()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Energy monitor database migrations")
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    parser.add_argument("--status", action="store_true", help="Show schema version and exit")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Rows per transaction for data migrations")
+    parser.add_argument("--pause", type=float, default=DEFAULT_CHUNK_PAUSE,
+                        help="Seconds to sleep between chunks")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.status:
+        print_status(args.db)
+    else:
+        migrate(args.db, chunk_size=args.chunk_size, pause=args.pause)
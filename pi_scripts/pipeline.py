@@ -0,0 +1,412 @@
+"""
+Sampler -> ring buffer -> sink pipeline for the energy monitor
+
+The sampler thread captures on a fixed cadence driven by the monotonic
+clock (deadlines are start + n * interval, so work time never accumulates
+as drift) and hands every reading to each sink's bounded ring buffer. The
+sampler never waits for a sink: when a buffer is full the oldest reading is
+dropped and counted. Each sink drains its own buffer on its own worker
+thread, so a slow SD-card commit or log write only delays that sink, and an
+exception in one sink is logged and counted instead of killing the process.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import urllib.request
+from collections import deque, namedtuple
+
+import metrics
+from db_writer import BufferedWriter, configure_connection, TIMESTAMP_FORMAT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5.0
+DEFAULT_CAPACITY = 1024      # Readings per sink buffer
+DEFAULT_BATCH_LIMIT = 256    # Readings handed to a sink at once
+IDLE_TICK = 1.0              # Seconds a worker waits before calling sink.tick()
+
+SAMPLE_SECONDS = metrics.Histogram(
+    "energy_sample_seconds", "Time to capture and compute one reading of every channel"
+)
+SAMPLE_LATENESS_SECONDS = metrics.Histogram(
+    "energy_sample_lateness_seconds", "How long after its deadline each capture started"
+)
+SINK_BATCH_SECONDS = metrics.Histogram(
+    "energy_sink_batch_seconds", "Time a sink took to handle one batch of readings", ["sink"]
+)
+
+Reading = namedtuple("Reading", ["timestamp", "ts", "watts", "appliance_id", "appliance_name"])
+
+
+class RingBuffer:
+    """Bounded FIFO that overwrites its oldest entry instead of blocking"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._items = deque(maxlen=capacity)
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.put_count = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item):
+        """Append item, returns False if the oldest entry had to be dropped"""
+        with self._cond:
+            dropped = len(self._items) == self.capacity
+            if dropped:
+                self.dropped += 1
+            self._items.append(item)
+            self.put_count += 1
+            self.high_water = max(self.high_water, len(self._items))
+            self._cond.notify()
+        return not dropped
+
+    def get_batch(self, limit=DEFAULT_BATCH_LIMIT, timeout=None):
+        """Up to limit items, waiting up to timeout for the first one
+
+        Returns an empty list on timeout, None once closed and drained.
+        """
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None if self._closed else []
+            count = min(limit, len(self._items))
+            return [self._items.popleft() for _ in range(count)]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "depth": len(self._items),
+            "high_water": self.high_water,
+            "put": self.put_count,
+            "dropped": self.dropped,
+        }
+
+
+class Sink:
+    """Consumer of readings, run on its own worker thread
+
+    open() and close() are called on the worker thread, so sinks can hold
+    thread-bound resources such as SQLite connections.
+    """
+
+    name = "sink"
+    capacity = DEFAULT_CAPACITY
+
+    def open(self):
+        pass
+
+    def handle(self, readings):
+        raise NotImplementedError
+
+    def tick(self):
+        """Called when no readings arrived for IDLE_TICK seconds"""
+
+    def close(self):
+        pass
+
+
+class SQLiteSink(Sink):
+    """Writes readings to the usage table through a BufferedWriter"""
+
+    name = "sqlite"
+    # Roughly a day of single-appliance readings at 5 s, the one sink that should never drop
+    capacity = 20000
+
+    def __init__(self, db_path, batch_size, flush_interval, synchronous="NORMAL", hooks=()):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.hooks = hooks
+        self.conn = None
+        self.writer = None
+
+    def open(self):
+        self.conn = sqlite3.connect(str(self.db_path))
+        configure_connection(self.conn, self.synchronous)
+        self.writer = BufferedWriter(
+            self.conn,
+            batch_size=self.batch_size,
+            flush_interval=self.flush_interval,
+            hooks=self.hooks,
+        )
+
+    def handle(self, readings):
+        self.writer.add_many(
+            (r.timestamp, r.watts, r.appliance_id, r.appliance_name, r.ts) for r in readings
+        )
+
+    def tick(self):
+        # Also retries a failed flush, whose rows stay queued
+        self.writer.flush_if_due()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except sqlite3.Error:
+            logger.error(f"Failed to flush {self.writer.pending} queued readings")
+            raise
+        finally:
+            self.conn.close()
+
+
+class LogSink(Sink):
+    """One 'Time: ..., Power: ... W' line per reading, to the log and the console"""
+
+    name = "log"
+
+    def __init__(self, log=logger, echo=True):
+        self.log = log
+        self.echo = echo
+
+    def handle(self, readings):
+        for r in readings:
+            message = f"Time: {r.timestamp}, Power: {r.watts:.2f} W, Appliance: {r.appliance_id}"
+            self.log.info(message)
+            if self.echo:
+                print(message)
+
+
+class NotifierSink(Sink):
+    """Calls notify(message) when an appliance goes above threshold watts
+
+    Fires once per crossing, and not again for the same appliance within
+    cooldown seconds.
+    """
+
+    name = "notifier"
+    capacity = 256
+
+    def __init__(self, threshold, notify=None, cooldown=300.0):
+        self.threshold = threshold
+        self.notify = notify or (lambda message: logger.warning(message))
+        self.cooldown = cooldown
+        self._above = {}
+        self._last_sent = {}
+        self.sent = 0
+
+    def handle(self, readings):
+        for r in readings:
+            above = r.watts > self.threshold
+            was_above = self._above.get(r.appliance_id, False)
+            self._above[r.appliance_id] = above
+            if not above or was_above:
+                continue
+            last = self._last_sent.get(r.appliance_id)
+            if last is not None and r.ts - last < self.cooldown:
+                continue
+            self._last_sent[r.appliance_id] = r.ts
+            self.sent += 1
+            self.notify(
+                f"{r.appliance_name} (appliance {r.appliance_id}) drawing {r.watts:.0f} W "
+                f"at {r.timestamp}, above {self.threshold:.0f} W"
+            )
+
+
+def webhook_notifier(url, timeout=5.0):
+    """notify callable that POSTs {"text": message} as JSON to url"""
+    def notify(message):
+        request = urllib.request.Request(
+            url,
+            data=json.dumps({"text": message}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=timeout):
+            pass
+    return notify
+
+
+class SinkWorker(threading.Thread):
+    """Drains one ring buffer into one sink"""
+
+    def __init__(self, sink, capacity=None):
+        super().__init__(name=f"sink-{sink.name}", daemon=True)
+        self.sink = sink
+        self.buffer = RingBuffer(capacity or sink.capacity)
+        self.handled = 0
+        self.errors = 0
+        self.clean_exit = False
+        self._batch_seconds = SINK_BATCH_SECONDS.labels(sink.name)
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+            return True
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"{self.sink.name} sink error: {e}")
+            return False
+
+    def run(self):
+        if not self._call(self.sink.open):
+            # Keep draining so the sampler sees drops rather than a stuck buffer
+            while self.buffer.get_batch(timeout=IDLE_TICK) is not None:
+                pass
+            return
+
+        while True:
+            batch = self.buffer.get_batch(timeout=IDLE_TICK)
+            if batch is None:
+                break
+            if batch:
+                with self._batch_seconds.time():
+                    handled = self._call(self.sink.handle, batch)
+                if handled:
+                    self.handled += len(batch)
+            else:
+                self._call(self.sink.tick)
+        self.clean_exit = self._call(self.sink.close)
+
+    def stats(self):
+        return {"handled": self.handled, "errors": self.errors, **self.buffer.stats()}
+
+
+class Sampler(threading.Thread):
+    """Calls read() every interval seconds and publishes the readings
+
+    read() returns objects with watts, appliance_id and appliance_name (the
+    sampling engine's Measurements). The wall-clock time is taken when the
+    capture starts; scheduling only uses the monotonic clock. A slot missed
+    because read() overran is skipped, not made up.
+    """
+
+    def __init__(self, read, publish, interval=DEFAULT_INTERVAL,
+                 clock=time.monotonic, wall_clock=time.time):
+        super().__init__(name="sampler", daemon=True)
+        self.read = read
+        self.publish = publish
+        self.interval = interval
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self._stop_event = threading.Event()
+
+        self.samples = 0
+        self.errors = 0
+        self.overruns = 0
+        self.max_lateness_ms = 0.0
+        self._total_lateness_ms = 0.0
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        next_deadline = self.clock()
+        while not self._stop_event.is_set():
+            lateness_ms = max(self.clock() - next_deadline, 0.0) * 1000
+            self.max_lateness_ms = max(self.max_lateness_ms, lateness_ms)
+            self._total_lateness_ms += lateness_ms
+
+            SAMPLE_LATENESS_SECONDS.observe(lateness_ms / 1000)
+
+            ts = int(self.wall_clock())
+            try:
+                with SAMPLE_SECONDS.time():
+                    measurements = self.read()
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Sampling failed: {e}")
+            else:
+                timestamp = time.strftime(TIMESTAMP_FORMAT, time.localtime(ts))
+                for m in measurements:
+                    self.publish(Reading(timestamp, ts, m.watts, m.appliance_id, m.appliance_name))
+            self.samples += 1
+
+            next_deadline += self.interval
+            now = self.clock()
+            if now >= next_deadline:
+                missed = int((now - next_deadline) // self.interval) + 1
+                self.overruns += missed
+                next_deadline += missed * self.interval
+            self._stop_event.wait(next_deadline - now)
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "errors": self.errors,
+            "overruns": self.overruns,
+            "avg_lateness_ms": self._total_lateness_ms / self.samples if self.samples else 0,
+            "max_lateness_ms": self.max_lateness_ms,
+        }
+
+
+class Pipeline:
+    """A Sampler feeding any number of sinks through per-sink ring buffers"""
+
+    def __init__(self, read, sinks, interval=DEFAULT_INTERVAL, **sampler_kwargs):
+        self.workers = [SinkWorker(sink) for sink in sinks]
+        self.sampler = Sampler(read, self._publish, interval=interval, **sampler_kwargs)
+
+    def _publish(self, reading):
+        for worker in self.workers:
+            if not worker.buffer.put(reading):
+                # Log the first drop and then every hundredth, not every one
+                if worker.buffer.dropped % 100 == 1:
+                    logger.warning(
+                        f"{worker.sink.name} sink is falling behind, "
+                        f"{worker.buffer.dropped} readings dropped"
+                    )
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.sampler.start()
+
+    def stop(self, timeout=30.0):
+        """Stop sampling, let every sink drain and close, returns True if all closed cleanly"""
+        self.sampler.stop()
+        self.sampler.join(timeout)
+        for worker in self.workers:
+            worker.buffer.close()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        return all(worker.clean_exit for worker in self.workers)
+
+    def stats(self):
+        return {
+            "sampler": self.sampler.stats(),
+            "sinks": {worker.sink.name: worker.stats() for worker in self.workers},
+        }
+
+    def register_metrics(self, registry=metrics.REGISTRY):
+        """Export the sampler counters and each sink's queue figures, read at scrape time"""
+        def per_sink(key):
+            return lambda: [((worker.sink.name,), worker.stats()[key]) for worker in self.workers]
+
+        sampler = self.sampler
+        for name, help, func, type in [
+            ("energy_samples", "Captures attempted", lambda: sampler.samples, "counter"),
+            ("energy_sample_errors", "Captures that raised", lambda: sampler.errors, "counter"),
+            ("energy_sample_overruns", "Sample slots skipped because a capture overran",
+             lambda: sampler.overruns, "counter"),
+        ]:
+            metrics.CallbackMetric(name, help, func, type=type, registry=registry)
+
+        for name, help, key, type in [
+            ("energy_sink_queue_depth", "Readings waiting in the sink's buffer", "depth", "gauge"),
+            ("energy_sink_queue_high_water", "Most readings ever waiting in the sink's buffer",
+             "high_water", "gauge"),
+            ("energy_sink_dropped", "Readings dropped because the sink's buffer was full",
+             "dropped", "counter"),
+            ("energy_sink_handled", "Readings handled by the sink", "handled", "counter"),
+            ("energy_sink_errors", "Sink calls that raised", "errors", "counter"),
+        ]:
+            metrics.CallbackMetric(name, help, per_sink(key), type=type, labelnames=["sink"],
+                                   registry=registry)
@@ -0,0 +1,114 @@
+"""
+Bounded cache of serialised API responses
+
+Clients polling a history or log endpoint with the same parameters would
+otherwise have the API query and serialise the same result again and
+again. ResponseCache keeps the bytes of recent responses, keyed on the
+route path and query parameters (in any order).
+
+Every entry is stored with a token describing the data it was built from,
+such as the latest-reading cache's data_version for one appliance or a log
+index's offset. A lookup passes the current token. If it differs, the entry
+is dropped and the lookup is a miss, so entries go stale exactly when new
+data lands rather than on a timer. The TTL only bounds responses that
+depend on the current time too, such as "the last 24 hours".
+
+Entries are evicted least recently used first, to stay within max_entries
+and max_bytes. The cache is used from the event loop only and takes no locks.
+"""
+
+import time
+from collections import OrderedDict, namedtuple
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_TTL = 300.0
+MAX_ENTRY_FRACTION = 8   # Responses over max_bytes / 8 are not stored
+
+# Headers recomputed for every response
+SKIPPED_HEADERS = ("content-length", "content-type")
+
+CachedResponse = namedtuple("CachedResponse", ["token", "expires", "body", "media_type", "headers"])
+
+
+def request_key(request):
+    """(path, sorted query parameters) of a Starlette request"""
+    return request.url.path, tuple(sorted(request.query_params.multi_items()))
+
+
+class ResponseCache:
+    """LRU of response bodies, invalidated by data tokens and bounded by count and bytes"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0     # Dropped to make room
+        self.invalidations = 0  # Dropped because their data changed
+        self.expirations = 0   # Dropped after their TTL
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= len(entry.body)
+
+    def get(self, key, token):
+        """The CachedResponse for key if it was built from token and has not expired"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.token != token:
+                self._drop(key)
+                self.invalidations += 1
+            elif entry.expires < self.clock():
+                self._drop(key)
+                self.expirations += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, token, response, ttl=None):
+        """Store a complete 200 response, returns whether it was stored"""
+        body = getattr(response, "body", None)  # Streaming responses have none
+        if response.status_code != 200 or body is None or len(body) > self.max_bytes // MAX_ENTRY_FRACTION:
+            return False
+        headers = {
+            name: value for name, value in response.headers.items() if name not in SKIPPED_HEADERS
+        }
+        if key in self._entries:
+            self._drop(key)
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = CachedResponse(token, expires, body, response.media_type, headers)
+        self.bytes += len(body)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "expirations": self.expirations,
+        }
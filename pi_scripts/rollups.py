@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Minute/hour/day rollups of the usage table
+
+Each rollup table holds count, sum, min, max and energy (Wh) per appliance
+per bucket. They are kept current as readings are written (RollupMaintainer
+runs inside the sampler's flush transaction) and can be rebuilt from the
+raw usage rows with:
+
+    python3 rollups.py rebuild
+
+Energy is integrated with the trapezoidal rule between consecutive readings
+of the same appliance and credited to the bucket of the later reading. Gaps
+longer than MAX_GAP seconds are not integrated. A reading written between
+two stored ones (a sensor uploading its offline buffer) takes back the
+energy of the interval it splits and credits the two halves instead.
+"""
+
+import argparse
+import logging
+import sqlite3
+import time
+from collections import Counter
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent.absolute()
+DB_PATH = SCRIPT_DIR / "energy_data.db"
+
+logger = logging.getLogger(__name__)
+
+# Bucket width in seconds, days follow local midnight instead
+RESOLUTIONS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+}
+
+MAX_GAP = 300  # Seconds between readings beyond which no energy is credited
+MAX_ROWID = 2 ** 63 - 1
+
+DEFAULT_CHUNK_SIZE = 20000
+DEFAULT_CHUNK_PAUSE = 0.05
+
+UPSERT_SQL = '''
+    INSERT INTO rollup_{resolution} (appliance_id, bucket, count, sum_watts, min_watts, max_watts, wh)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(appliance_id, bucket) DO UPDATE SET
+        count = count + excluded.count,
+        sum_watts = sum_watts + excluded.sum_watts,
+        min_watts = MIN(min_watts, excluded.min_watts),
+        max_watts = MAX(max_watts, excluded.max_watts),
+        wh = wh + excluded.wh
+'''
+
+QUERY_SQL = '''
+    SELECT bucket, count, sum_watts, min_watts, max_watts, wh FROM rollup_{resolution}
+    WHERE appliance_id = ? AND bucket >= ? AND bucket < ? ORDER BY bucket
+'''
+
+# Readings near a batch, the ones whose intervals it can change. rowid < ? keeps
+# to the rows already rolled up when backfilling.
+PREVIOUS_NEAR_SQL = '''
+    SELECT ts, watts FROM usage WHERE appliance_id = ? AND ts < ? AND ts >= ? AND rowid < ?
+    ORDER BY ts DESC LIMIT 1
+'''
+
+RANGE_SQL = '''
+    SELECT ts, watts FROM usage WHERE appliance_id = ? AND ts >= ? AND ts <= ? AND rowid < ?
+'''
+
+NEXT_NEAR_SQL = '''
+    SELECT ts, watts FROM usage WHERE appliance_id = ? AND ts > ? AND ts <= ? AND rowid < ?
+    ORDER BY ts LIMIT 1
+'''
+
+WH_SQL = '''
+    UPDATE rollup_{resolution} SET wh = wh + ? WHERE appliance_id = ? AND bucket = ?
+'''
+
+
+def create_tables(conn):
+    for resolution in RESOLUTIONS:
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS rollup_{resolution} (
+            appliance_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum_watts REAL NOT NULL,
+            min_watts REAL NOT NULL,
+            max_watts REAL NOT NULL,
+            wh REAL NOT NULL,
+            PRIMARY KEY (appliance_id, bucket)
+        ) WITHOUT ROWID''')
+
+
+def local_day_start(ts):
+    lt = time.localtime(ts)
+    return int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+
+def bucket_start(ts, resolution):
+    """Start of the bucket containing ts, as epoch seconds"""
+    if resolution == "day":
+        return local_day_start(ts)
+    size = RESOLUTIONS[resolution]
+    return ts - ts % size
+
+
+def by_appliance(readings):
+    """{appliance_id: [(ts, watts)] sorted} from (appliance_id, ts, watts) readings"""
+    batches = {}
+    for appliance_id, ts, watts in readings:
+        batches.setdefault(appliance_id, []).append((ts, watts))
+    for batch in batches.values():
+        batch.sort()
+    return batches
+
+
+def interval_changes(conn, appliance_id, batch, max_gap=MAX_GAP, credited_below=None):
+    """(sign, prev_ts, prev_watts, ts, watts) intervals to credit (+1) or take back (-1)
+
+    batch is the appliance's new (ts, watts) readings, sorted and already in
+    usage. Every other stored reading has been credited the interval before
+    it, so a new reading landing between two of them takes back the interval
+    it splits. A backfill passes credited_below, the rowid below which rows
+    have been rolled up; rows from there on count as not there yet.
+
+    Only readings within max_gap of the batch are looked up: intervals any
+    longer were never credited.
+    """
+    low, high = batch[0][0], batch[-1][0]
+    limit = MAX_ROWID if credited_below is None else credited_below
+    prev = conn.execute(PREVIOUS_NEAR_SQL, (appliance_id, low, low - max_gap, limit)).fetchone()
+    stored = conn.execute(RANGE_SQL, (appliance_id, low, high, limit)).fetchall()
+    following = conn.execute(NEXT_NEAR_SQL, (appliance_id, high, high + max_gap, limit)).fetchone()
+
+    if credited_below is None:
+        # The batch is in usage too, leave it out
+        remaining = Counter(batch)
+        credited = []
+        for reading in stored:
+            if remaining[reading]:
+                remaining[reading] -= 1
+            else:
+                credited.append(reading)
+        stored = credited
+    before = ([prev] if prev else []) + sorted(stored) + ([following] if following else [])
+    after = sorted(before + batch)
+
+    changes = Counter(zip(after, after[1:]))
+    changes.subtract(zip(before, before[1:]))
+    return [
+        (1 if count > 0 else -1, *a, *b)
+        for (a, b), count in changes.items()
+        for _ in range(abs(count))
+    ]
+
+
+class RollupMaintainer:
+    """Folds batches of readings into the rollup tables
+
+    Used as a BufferedWriter hook, so rollups are updated in the same
+    transaction as the readings themselves. The readings around each batch
+    are looked up in usage rather than remembered, so a rolled-back flush or
+    a restart never leaves stale state behind.
+    """
+
+    def __init__(self, max_gap=MAX_GAP):
+        self.max_gap = max_gap
+        self._day = (None, None)  # Cached (start, end) of the current local day
+
+    def _day_bucket(self, ts):
+        start, end = self._day
+        if start is None or not start <= ts < end:
+            start = local_day_start(ts)
+            end = local_day_start(start + 26 * 3600)  # Handles 23/25 hour DST days
+            self._day = (start, end)
+        return start
+
+    def __call__(self, conn, readings, credited_below=None):
+        """readings: iterable of (appliance_id, ts, watts), see interval_changes() for credited_below"""
+        buckets = {resolution: {} for resolution in RESOLUTIONS}
+        energy = {resolution: {} for resolution in RESOLUTIONS}  # Wh for buckets without new readings
+
+        for appliance_id, batch in by_appliance(readings).items():
+            for ts, watts in batch:
+                for resolution, table in buckets.items():
+                    key = (appliance_id, self._bucket(ts, resolution))
+                    agg = table.get(key)
+                    if agg is None:
+                        table[key] = [1, watts, watts, watts, 0.0]
+                    else:
+                        agg[0] += 1
+                        agg[1] += watts
+                        if watts < agg[2]:
+                            agg[2] = watts
+                        if watts > agg[3]:
+                            agg[3] = watts
+
+            for sign, prev_ts, prev_watts, ts, watts in interval_changes(
+                    conn, appliance_id, batch, self.max_gap, credited_below):
+                dt = ts - prev_ts
+                if dt > self.max_gap:
+                    continue
+                wh = sign * (prev_watts + watts) / 2 * dt / 3600
+                for resolution, table in buckets.items():
+                    key = (appliance_id, self._bucket(ts, resolution))
+                    agg = table.get(key)
+                    if agg is not None:
+                        agg[4] += wh
+                    else:
+                        energy[resolution][key] = energy[resolution].get(key, 0.0) + wh
+
+        for resolution, table in buckets.items():
+            if table:
+                conn.executemany(
+                    UPSERT_SQL.format(resolution=resolution),
+                    [(appliance_id, bucket, *agg) for (appliance_id, bucket), agg in table.items()]
+                )
+            if energy[resolution]:
+                conn.executemany(
+                    WH_SQL.format(resolution=resolution),
+                    [(wh, appliance_id, bucket) for (appliance_id, bucket), wh in energy[resolution].items()]
+                )
+
+    def _bucket(self, ts, resolution):
+        if resolution == "day":
+            return self._day_bucket(ts)
+        return ts - ts % RESOLUTIONS[resolution]
+
+
+def backfill(conn, start_rowid, end_rowid, chunk_size=DEFAULT_CHUNK_SIZE,
+             pause=DEFAULT_CHUNK_PAUSE, on_chunk=None, maintainer=None):
+    """Roll up usage rows with start_rowid <= rowid <= end_rowid in chunked transactions
+
+    conn must be in autocommit mode (isolation_level=None). on_chunk(next_rowid)
+    runs inside each chunk's transaction so callers can record progress.
+    maintainer defaults to a RollupMaintainer; any hook taking
+    (conn, [(appliance_id, ts, watts)], credited_below=rowid) works.
+    """
+    maintainer = maintainer or RollupMaintainer()
+    cursor = start_rowid
+    total = 0
+    while cursor <= end_rowid:
+        high = min(cursor + chunk_size, end_rowid + 1)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT appliance_id, ts, watts FROM usage "
+                "WHERE rowid >= ? AND rowid < ? AND ts IS NOT NULL ORDER BY rowid",
+                (cursor, high)
+            ).fetchall()
+            maintainer(conn, rows, credited_below=cursor)
+            if on_chunk is not None:
+                on_chunk(high)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        cursor = high
+        total += len(rows)
+        logger.info(f"Rolled up {total} rows (up to rowid {cursor - 1})")
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+def rebuild(db_path=DB_PATH, chunk_size=DEFAULT_CHUNK_SIZE, pause=DEFAULT_CHUNK_PAUSE,
+            archive_root=None):
+    """Clear the rollup tables and recompute them from the archive and every usage row"""
+    from archive import ARCHIVE_DIR, Archive, replay_rollups
+
+    conn = sqlite3.connect(str(db_path), isolation_level=None)
+    try:
+        conn.execute("PRAGMA busy_timeout = 5000")
+        create_tables(conn)
+
+        # Clear and snapshot the last rowid together: rows written after this
+        # are rolled up by the running sampler, not by the rebuild
+        conn.execute("BEGIN IMMEDIATE")
+        for resolution in RESOLUTIONS:
+            conn.execute(f"DELETE FROM rollup_{resolution}")
+        end_rowid = conn.execute("SELECT MAX(rowid) FROM usage").fetchone()[0] or 0
+        conn.execute("COMMIT")
+
+        # Archived days are older than anything left in usage, so they go first
+        total = replay_rollups(conn, Archive(archive_root or ARCHIVE_DIR), RollupMaintainer())
+        total += backfill(conn, 1, end_rowid, chunk_size=chunk_size, pause=pause)
+        logger.info(f"Rollup rebuild complete: {total} readings")
+    finally:
+        conn.close()
+
+
+def row_to_dict(row):
+    bucket, count, sum_watts, min_watts, max_watts, wh = row
+    return {
+        "timestamp": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(bucket)),
+        "ts": bucket,
+        "count": count,
+        "avg_watts": sum_watts / count if count else 0,
+        "min_watts": min_watts,
+        "max_watts": max_watts,
+        "wh": wh,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Energy usage rollups")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: recompute all rollups")
+    parser.add_argument("--db", default=str(DB_PATH), help="Path to the SQLite database")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--pause", type=float, default=DEFAULT_CHUNK_PAUSE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    rebuild(args.db, chunk_size=args.chunk_size, pause=args.pause)
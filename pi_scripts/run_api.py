@@ -3,8 +3,11 @@
 FastAPI server runner for Energy Monitoring System
 """
 import uvicorn
+from pathlib import Path
 from api import app
 
+SCRIPT_DIR = Path(__file__).parent.absolute()
+
 if __name__ == "__main__":
     print("Starting Energy Monitoring System API...")
     print("API will be available at: http://localhost:8000")
@@ -16,5 +19,6 @@ if __name__ == "__main__":
         host="0.0.0.0",  # Allow external connections
         port=8000,
         reload=True,     # Auto-reload on code changes
-        log_level="info"
+        log_level="info",
+        log_config=str(SCRIPT_DIR / "logging_config.json")  # api.log with rotation
     ) 
\ No newline at end of file
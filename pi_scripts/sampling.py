@@ -0,0 +1,249 @@
+"""
+Multi-channel PCF8591 sampling engine with true-RMS power computation
+
+Instead of a handful of single-byte reads and a peak/sqrt(2) estimate, the
+engine captures whole mains cycles from every configured channel using
+32-byte I2C block reads (with the ADC's auto-increment mode when more than
+one channel is in use), then computes RMS current, real power and crest
+factor for all channels at once with NumPy.
+
+The current transformers are expected to be biased around a DC midpoint;
+the mean of each capture is removed before the RMS is taken. If a voltage
+sense channel is configured, real power is the mean of instantaneous v*i;
+otherwise it falls back to nominal voltage x RMS current (unity power
+factor), like the original single-channel script.
+
+FakeBus stands in for smbus2.SMBus so the engine can be exercised without
+hardware.
+"""
+
+import math
+import time
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_ADDRESS = 0x48
+BLOCK_SIZE = 32          # Largest SMBus block transfer
+AUTO_INCREMENT = 0x04    # PCF8591 control bit: step to the next channel after each conversion
+CHANNEL_COUNT = 4        # Auto-increment always cycles through all four inputs
+
+DEFAULT_VREF = 3.3
+DEFAULT_MAINS_HZ = 50.0
+DEFAULT_CYCLES = 10      # Mains cycles per capture (200 ms at 50 Hz)
+DEFAULT_NOMINAL_VOLTAGE = 230.0
+
+# The original energy_monitor.py reported current * VOLTAGE / 1000 and its
+# CALIBRATION_FACTOR was tuned against that, so keep the same scale
+POWER_SCALE = 1 / 1000
+
+Measurement = namedtuple("Measurement", [
+    "appliance_id",
+    "appliance_name",
+    "watts",
+    "irms",
+    "vrms",
+    "power_factor",
+    "crest_factor",
+    "sample_rate",
+    "samples",
+])
+
+
+class Channel:
+    """One CT clamp on an ADC input, recorded under an appliance id"""
+
+    def __init__(self, appliance_id, channel, name=None, calibration=19.02):
+        if not 0 <= channel < CHANNEL_COUNT:
+            raise ValueError(f"PCF8591 channel must be 0-3, got {channel}")
+        self.appliance_id = appliance_id
+        self.channel = channel
+        self.name = name or f"Appliance {appliance_id}"
+        self.calibration = calibration  # Amps per volt at the ADC input
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config["id"],
+            config["channel"],
+            name=config.get("name"),
+            calibration=config.get("calibration", 19.02),
+        )
+
+
+class SamplingEngine:
+    """Captures whole mains cycles and turns them into per-appliance measurements"""
+
+    def __init__(self, bus, channels, address=DEFAULT_ADDRESS, vref=DEFAULT_VREF,
+                 mains_hz=DEFAULT_MAINS_HZ, cycles=DEFAULT_CYCLES,
+                 nominal_voltage=DEFAULT_NOMINAL_VOLTAGE,
+                 voltage_channel=None, voltage_calibration=1.0,
+                 clock=time.monotonic):
+        if not channels:
+            raise ValueError("At least one channel is required")
+
+        self.bus = bus
+        self.channels = list(channels)
+        self.address = address
+        self.vref = vref
+        self.mains_hz = mains_hz
+        self.cycles = cycles
+        self.nominal_voltage = nominal_voltage
+        self.voltage_channel = voltage_channel
+        self.voltage_calibration = voltage_calibration  # Mains volts per ADC volt
+        self.clock = clock
+
+        used = {ch.channel for ch in self.channels}
+        if voltage_channel is not None:
+            used.add(voltage_channel)
+        if len(used) == 1:
+            self._frame_size = 1
+            self._control = used.pop()
+        else:
+            self._frame_size = CHANNEL_COUNT
+            self._control = AUTO_INCREMENT
+        # Whole frames per block after dropping the stale first byte
+        self._block_bytes = (BLOCK_SIZE - 1) // self._frame_size * self._frame_size
+
+    @property
+    def capture_seconds(self):
+        return self.cycles / self.mains_hz
+
+    def capture(self):
+        """Read blocks until whole cycles are covered, returns (samples, per-channel rate)
+
+        samples is an (n, frame_size) array of ADC volts; column i is input i
+        in auto-increment mode, or the single channel otherwise.
+        """
+        buffer = array('B')
+        duration = self.capture_seconds
+        start = self.clock()
+        while True:
+            # The first byte of every read is the previous conversion result
+            block = self.bus.read_i2c_block_data(self.address, self._control, BLOCK_SIZE)
+            buffer.extend(block[1:1 + self._block_bytes])
+            elapsed = self.clock() - start
+            if elapsed >= duration:
+                break
+
+        counts = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, self._frame_size)
+        rate = len(counts) / elapsed if elapsed > 0 else 0.0
+
+        # Trim to a whole number of mains cycles so the RMS isn't biased
+        whole = int(round(rate * duration))
+        if 0 < whole < len(counts):
+            counts = counts[:whole]
+        return counts * (self.vref / 255.0), rate
+
+    def _column(self, channel):
+        return 0 if self._frame_size == 1 else channel
+
+    def _align(self, v_inst, channel):
+        """Voltage interpolated to the instants channel was sampled
+
+        In auto-increment mode the inputs are converted one after another, so
+        within a frame the voltage channel lags or leads each current channel
+        by a few conversions, which would otherwise show up as a phase error.
+        """
+        if self._frame_size == 1 or channel == self.voltage_channel:
+            return v_inst
+        frames = np.arange(len(v_inst), dtype=float)
+        offset = (self.voltage_channel - channel) / self._frame_size
+        return np.interp(frames - offset, frames, v_inst)
+
+    def read(self):
+        """Capture once and return a Measurement per configured channel"""
+        volts, rate = self.capture()
+        ac = volts - volts.mean(axis=0)            # Remove the DC bias of every input
+        rms = np.sqrt(np.mean(ac * ac, axis=0))
+        peak = np.max(np.abs(ac), axis=0)
+
+        columns = [self._column(ch.channel) for ch in self.channels]
+        calibration = np.array([ch.calibration for ch in self.channels])
+        currents = ac[:, columns] * calibration   # Instantaneous amps, one column per appliance
+        irms = rms[columns] * calibration
+        crest = np.divide(peak[columns], rms[columns],
+                          out=np.zeros(len(columns)), where=rms[columns] > 0)
+
+        if self.voltage_channel is not None:
+            v_inst = ac[:, self._column(self.voltage_channel)] * self.voltage_calibration
+            vrms = float(np.sqrt(np.mean(v_inst * v_inst)))
+            real = np.array([
+                np.mean(currents[:, i] * self._align(v_inst, ch.channel))
+                for i, ch in enumerate(self.channels)
+            ])
+        else:
+            vrms = self.nominal_voltage
+            real = irms * vrms
+        apparent = irms * vrms
+        power_factor = np.divide(real, apparent, out=np.ones(len(columns)), where=apparent > 0)
+
+        return [
+            Measurement(
+                appliance_id=ch.appliance_id,
+                appliance_name=ch.name,
+                watts=abs(float(real[i])) * POWER_SCALE,
+                irms=float(irms[i]),
+                vrms=vrms,
+                power_factor=float(power_factor[i]),
+                crest_factor=float(crest[i]),
+                sample_rate=rate,
+                samples=len(volts),
+            )
+            for i, ch in enumerate(self.channels)
+        ]
+
+
+class FakeBus:
+    """smbus2.SMBus stand-in that returns synthetic waveforms from a PCF8591
+
+    signals maps channel -> function(t) returning the input voltage at time t.
+    Each byte read advances a virtual clock by byte_time, which clock()
+    exposes so the engine can be driven deterministically.
+    """
+
+    def __init__(self, signals, vref=DEFAULT_VREF, byte_time=1 / 11000):
+        self.signals = signals
+        self.vref = vref
+        self.byte_time = byte_time
+        self.now = 0.0
+        self._channel = 0
+        self._auto_increment = False
+        self._last = 0
+        self.reads = 0
+
+    def clock(self):
+        return self.now
+
+    def _convert(self):
+        signal = self.signals.get(self._channel)
+        volts = signal(self.now) if signal else 0.0
+        value = int(round(volts / self.vref * 255))
+        self.now += self.byte_time
+        if self._auto_increment:
+            self._channel = (self._channel + 1) % CHANNEL_COUNT
+        return min(max(value, 0), 255)
+
+    def write_byte(self, address, control):
+        self._channel = control & 0x03
+        self._auto_increment = bool(control & AUTO_INCREMENT)
+
+    def read_byte(self, address):
+        previous, self._last = self._last, self._convert()
+        return previous
+
+    def read_i2c_block_data(self, address, control, length):
+        self.write_byte(address, control)
+        self.reads += 1
+        return [self.read_byte(address) for _ in range(length)]
+
+
+def sine(amplitude, hz=DEFAULT_MAINS_HZ, offset=DEFAULT_VREF / 2, phase=0.0, harmonics=()):
+    """Biased sine (plus optional (order, relative amplitude) harmonics) for FakeBus"""
+    def signal(t):
+        value = math.sin(2 * math.pi * hz * t + phase)
+        for order, relative in harmonics:
+            value += relative * math.sin(2 * math.pi * hz * order * t + phase)
+        return offset + amplitude * value
+    return signal
@@ -33,8 +33,9 @@ touch energy_monitor.log
 # Start the API server with logging
 echo "   Starting server with logging enabled..."
 echo "   Press Ctrl+C to stop the server"
-echo "   Logs will be saved to api.log"
+echo "   Logs will be saved to api.log (rotated and gzipped as api.log.<date>.gz)"
 echo ""
 
-# Start uvicorn with access logging to file
-uvicorn api:app --host 0.0.0.0 --port 8000 --reload --access-log --log-config=logging_config.json 2>&1 | tee -a api.log 
+# Start uvicorn with access logging to file. logging_config.json writes api.log
+# itself (with rotation), so the console output is not tee'd into it as well.
+uvicorn api:app --host 0.0.0.0 --port 8000 --reload --access-log --log-config=logging_config.json
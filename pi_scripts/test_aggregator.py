@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Tests for multi-node aggregation against stand-in collectors
+"""
+import asyncio
+import sqlite3
+
+import pytest
+
+import aggregator
+import appliances
+import disaggregate
+from aggregator import Aggregator
+from db_writer import BufferedWriter
+from migrate_database import run_migrations
+from rollups import RollupMaintainer
+
+START = 1_700_000_000
+
+
+def make_node(path, readings):
+    conn = sqlite3.connect(str(path))
+    run_migrations(conn, pause=0)
+    add_readings(conn, readings)
+    return conn
+
+
+def add_readings(conn, readings):
+    writer = BufferedWriter(conn, batch_size=100)
+    for ts, watts, appliance_id, name in readings:
+        writer.add(f"reading {ts}", watts, appliance_id, name, ts=ts)
+    writer.close()
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    garage = make_node(tmp_path / "garage.db", [(START + 5 * i, 100.0, 1, "Heater") for i in range(10)])
+    kitchen = make_node(tmp_path / "kitchen.db", [
+        (START + 5 * i, 50.0 + appliance_id, appliance_id, f"Plug {appliance_id}")
+        for i in range(4) for appliance_id in (1, 2)
+    ])
+    servers = [
+        aggregator.serve_collector(tmp_path / f"{name}.db", 0, node_id=name)
+        for name in ("garage", "kitchen")
+    ]
+    urls = {
+        name: f"http://127.0.0.1:{server.server_address[1]}"
+        for name, server in zip(("garage", "kitchen"), servers)
+    }
+    yield urls, {"garage": garage, "kitchen": kitchen}
+    for server in servers:
+        server.shutdown()
+    garage.close()
+    kitchen.close()
+
+
+def run(agg, rounds):
+    """Open the aggregate database and run pull rounds, returns rows stored per round"""
+    async def main():
+        await agg._write(agg.open)
+        results = [await agg.sync_all() for _ in range(rounds)]
+        await agg.stop()
+        return results
+    return asyncio.run(main())
+
+
+def test_pulls_every_node_into_one_store(nodes, tmp_path):
+    urls, conns = nodes
+    db_path = tmp_path / "aggregate.db"
+    agg = Aggregator(db_path, urls, page_size=3, hooks=[RollupMaintainer()])
+    assert run(agg, 1) == [{"garage": 10, "kitchen": 8}]
+
+    conn = sqlite3.connect(str(db_path))
+    mapping = conn.execute(
+        "SELECT node_id, remote_appliance_id, name FROM node_appliances ORDER BY node_id, remote_appliance_id"
+    ).fetchall()
+    assert mapping == [("garage", 1, "Heater"), ("kitchen", 1, "Plug 1"), ("kitchen", 2, "Plug 2")]
+    names = dict(conn.execute(
+        "SELECT name, COUNT(*) FROM usage JOIN appliances ON appliances.id = appliance_id GROUP BY name"
+    ))
+    assert names == {"garage/Heater": 10, "kitchen/Plug 1": 4, "kitchen/Plug 2": 4}
+
+    heater = conn.execute("SELECT appliance_id FROM node_appliances WHERE node_id = 'garage'").fetchone()[0]
+    wh = conn.execute("SELECT SUM(wh) FROM rollup_minute WHERE appliance_id = ?", (heater,)).fetchone()[0]
+    assert wh == pytest.approx(100.0 * 45 / 3600)
+    assert dict(conn.execute("SELECT node_id, cursor FROM node_cursors")) == {"garage": 10, "kitchen": 8}
+
+    # New readings on one node only; a fresh aggregator resumes from the saved cursors
+    add_readings(conns["kitchen"], [(START + 100, 75.0, 2, "Plug 2"), (START + 100, 60.0, 3, "Kettle")])
+    agg = Aggregator(db_path, urls, hooks=[])
+    assert run(agg, 2) == [{"garage": 0, "kitchen": 2}, {"garage": 0, "kitchen": 0}]
+    assert conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0] == 20
+    kitchen = [node for node in agg.status() if node["node"] == "kitchen"][0]
+    assert [a["name"] for a in kitchen["appliances"]] == ["Plug 1", "Plug 2", "Kettle"]
+    assert kitchen["rows"] == 10 and kitchen["lag_rows"] == 0
+    conn.close()
+
+
+def test_node_appliances_get_reserved_ids_and_sources(nodes, tmp_path):
+    urls, conns = nodes
+    with conns["garage"]:
+        appliances.register(conns["garage"], 1, "Heater", source="sampler")
+    with conns["kitchen"]:
+        appliances.register(conns["kitchen"], 2, "Plug 2", source=disaggregate.VIRTUAL_SOURCE)
+    db_path = tmp_path / "aggregate.db"
+    own = make_node(db_path, [(START + 5 * i, 7.0, 1, "Main Appliance") for i in range(3)])
+
+    agg = Aggregator(db_path, urls, hooks=[])
+    run(agg, 1)
+    mapping = own.execute(
+        "SELECT node_id, remote_appliance_id, appliance_id, source FROM node_appliances ORDER BY appliance_id"
+    ).fetchall()
+    assert [row[2] for row in mapping] == list(range(appliances.RESERVED_ID_START, appliances.RESERVED_ID_START + 3))
+    assert {(row[0], row[1]): row[3] for row in mapping}[("garage", 1)] == "sampler"
+    # A node's estimates stay out of the site totals
+    kitchen_plug = {(row[0], row[1]): row[2] for row in mapping}[("kitchen", 2)]
+    assert [row[0] for row in own.execute(disaggregate.VIRTUAL_IDS_SQL)] == [kitchen_plug]
+
+    # The aggregator's own main channel is not merged with any node's appliance 1
+    assert own.execute("SELECT COUNT(*), MAX(watts) FROM usage WHERE appliance_id = 1").fetchone() == (3, 7.0)
+    garage = [node for node in agg.status() if node["node"] == "garage"][0]
+    assert garage["appliances"][0]["source"] == "sampler"
+    own.close()
+
+
+def test_unreachable_node_does_not_stop_the_others(nodes, tmp_path):
+    urls, _ = nodes
+    urls = dict(urls, attic="http://127.0.0.1:9")
+    agg = Aggregator(tmp_path / "aggregate.db", urls, timeout=1, hooks=[])
+    assert run(agg, 1) == [{"garage": 10, "kitchen": 8, "attic": 0}]
+
+    status = {node["node"]: node for node in agg.status()}
+    assert status["attic"]["last_error"] and status["attic"]["last_sync"] is None
+    assert status["garage"]["last_error"] is None
+
+
+def test_failed_store_keeps_cursor_and_retries(nodes, tmp_path):
+    urls, _ = nodes
+    calls = []
+
+    def flaky_hook(conn, readings):
+        calls.append(len(readings))
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("disk I/O error")
+
+    db_path = tmp_path / "aggregate.db"
+    agg = Aggregator(db_path, {"garage": urls["garage"]}, hooks=[flaky_hook])
+    assert run(agg, 2) == [{"garage": 0}, {"garage": 10}]
+
+    conn = sqlite3.connect(str(db_path))
+    assert conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0] == 10
+    assert conn.execute("SELECT COUNT(*) FROM node_appliances").fetchone()[0] == 1
+    conn.close()
+
+
+def test_load_nodes_validates_config(tmp_path):
+    path = tmp_path / "nodes.json"
+    path.write_text('{"interval": 5, "nodes": [{"id": "a", "url": "http://a:8000"}]}')
+    assert aggregator.load_nodes(path) == ({"a": "http://a:8000"}, {"interval": 5})
+
+    path.write_text('{"nodes": [{"id": "a", "url": "http://a"}, {"id": "a", "url": "http://b"}]}')
+    with pytest.raises(ValueError):
+        aggregator.load_nodes(path)
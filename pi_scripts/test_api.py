@@ -142,6 +142,28 @@ def test_download_endpoints():
         except Exception as e:
             print(f"Error downloading {filename}: {e}")
 
+def test_overflowing_time_params_are_rejected(tmp_path):
+    """inf and 1e400 are floats that no int holds: a 400, not a 500"""
+    import os
+    import subprocess
+    import sys
+    # api.py serves one data directory per process (see benchmark.load_api), so check it in its own
+    script = (
+        "import api\n"
+        "from fastapi.testclient import TestClient\n"
+        "with TestClient(api.app) as client:\n"
+        "    for path in ('/energy/history?from=inf', '/energy/consumption?date=1e400',\n"
+        "                 '/energy/rollup?to=-inf'):\n"
+        "        response = client.get(path)\n"
+        "        assert response.status_code == 400, (path, response.status_code)\n"
+        "        assert 'Invalid' in response.json()['detail'], path\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=SCRIPT_DIR, capture_output=True, text=True,
+        env={**os.environ, "ENERGY_DATA_DIR": str(tmp_path)}
+    )
+    assert result.returncode == 0, result.stderr
+
 def create_sample_data():
     """Create sample data if database is empty"""
     try:
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Tests for the appliance registry, its migrations and the cached copy in the API
+"""
+import json
+import sqlite3
+
+import pytest
+
+import appliances
+from appliances import ApplianceRegistry
+from db_writer import BufferedWriter
+from latest_cache import LatestReadingCache
+from migrate_database import run_migrations
+
+
+def test_migration_moves_names_to_registry(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "energy.db"))
+    conn.execute("CREATE TABLE usage (timestamp TEXT, watts REAL, appliance_id INTEGER, appliance_name TEXT)")
+    conn.executemany("INSERT INTO usage VALUES (?, ?, ?, ?)", [
+        ("2024-01-15 14:00:00", 1.0, 1, "Main Appliance"),
+        ("2024-01-15 14:00:00", 2.0, 2, "Fridge"),
+        ("2024-01-15 14:05:00", 3.0, 2, "Kitchen Fridge"),
+        ("2024-01-15 14:10:00", 4.0, 1, "Main Appliance"),
+    ])
+    conn.commit()
+
+    run_migrations(conn, chunk_size=3, pause=0)
+    # The newest stored name wins
+    assert conn.execute("SELECT id, name, source FROM appliances").fetchall() == [
+        (1, "Main Appliance", "usage"), (2, "Kitchen Fridge", "usage")
+    ]
+    assert conn.execute("SELECT COUNT(*) FROM usage WHERE appliance_name IS NOT NULL").fetchone()[0] == 0
+
+
+def test_register_keeps_metadata_not_given(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "energy.db"))
+    run_migrations(conn, pause=0)
+    appliances.register(conn, 1, "Main Appliance", channel=0, calibration=19.02,
+                        nominal_voltage=230.0, source="sampler")
+    appliances.register(conn, 1, "Mains")
+    appliances.ensure(conn, 1)
+    appliances.ensure(conn, 7, source="ingest")
+
+    rows = [appliances.row_to_dict(row) for row in conn.execute(appliances.SELECT_SQL)]
+    assert [(a["id"], a["name"], a["channel"], a["calibration"], a["source"]) for a in rows] == [
+        (1, "Mains", 0, 19.02, "sampler"), (7, "Appliance 7", None, None, "ingest")
+    ]
+
+
+def test_reserved_id_blocks(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "energy.db"))
+    run_migrations(conn, pause=0)
+    start = appliances.RESERVED_ID_START
+    appliances.register(conn, start + 3, "Registered before the range was reserved")
+
+    assert appliances.reserve(conn, "node:garage:1") == start + 4
+    assert appliances.reserve(conn, "nilm:1", 100) == start + 5
+    assert appliances.reserve(conn, "node:garage:2") == start + 105
+    assert appliances.reserve(conn, "node:garage:1") == start + 4  # Same owner, same ids
+    with pytest.raises(ValueError, match="reserved"):
+        appliances.reserve(conn, "nilm:1", 200)
+
+
+def test_cache_reloads_registry_and_renames_entries(tmp_path):
+    db = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(db))
+    run_migrations(conn, pause=0)
+    writer = BufferedWriter(conn, batch_size=1)
+    writer.add("2024-01-15 14:30:00", 50.0, 2, "Fridge")
+
+    registry = ApplianceRegistry()
+    cache = LatestReadingCache(db, registry=registry)
+    assert not registry.loaded
+    assert cache.refresh()
+    assert [a["name"] for a in json.loads(registry.body)["appliances"]] == ["Fridge"]
+    entry = cache.get(2)
+    assert entry.appliance_name == "Fridge"
+
+    with conn:
+        appliances.register(conn, 2, "Kitchen Fridge")
+    assert cache.refresh()
+    assert registry.name(2) == "Kitchen Fridge"
+    assert cache.get(2).appliance_name == "Kitchen Fridge"
+    assert cache.get(2).watts == 50.0 and cache.get(2).etag != entry.etag
+    assert json.loads(cache.get(2).appliance_body)["appliance_name"] == "Kitchen Fridge"
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Tests for the benchmark harness, on a tiny synthetic dataset
+"""
+import json
+
+import benchmark
+
+
+def test_small_run_covers_every_endpoint(tmp_path):
+    data_dir = tmp_path / "data"
+    # Two minutes apart, so each appliance has the day of readings a forecast needs
+    report = benchmark.run(
+        data_dir, rows=2000, appliances=2, interval=120, log_lines=500,
+        requests=4, concurrency=2, warmup=1, write_rows=500
+    )
+
+    names = [name for name, _ in benchmark.endpoint_cases(report["dataset"])]
+    assert list(report["endpoints"]) == names
+    for name, result in report["endpoints"].items():
+        assert result["errors"] == 0, name
+        assert result["requests"] == 4
+        assert 0 < result["p50_ms"] <= result["p99_ms"]
+    assert report["storage"]["buffered_writes"]["rows"] == 500
+    assert report["peak_rss_kb"] > 0
+    json.dumps(report)
+
+    # Same parameters reuse the generated dataset
+    manifest = benchmark.prepare_dataset(data_dir, 2000, 2, 120, 500, None)
+    assert manifest == report["dataset"]
+
+
+def test_compare_flags_regressions():
+    def result(p50, p99, rps, errors=0):
+        return {"p50_ms": p50, "p99_ms": p99, "throughput_rps": rps, "errors": errors}
+
+    baseline = {"endpoints": {"energy": result(1.0, 2.0, 1000), "health": result(1.0, 2.0, 1000)}}
+    report = {"endpoints": {
+        "energy": result(1.1, 4.0, 700),
+        "health": result(1.2, 2.4, 900),
+        "new": result(50, 50, 1),
+    }}
+
+    assert benchmark.compare(baseline, report, tolerance=0.25) == [
+        ("energy", "p99_ms", 2.0, 4.0),
+        ("energy", "throughput_rps", 1000, 700),
+    ]
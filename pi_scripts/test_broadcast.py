@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for the /energy/stream broadcaster
+"""
+import asyncio
+import sqlite3
+
+from broadcast import Broadcaster
+from db_writer import BufferedWriter, configure_connection
+from latest_cache import LatestEntry, LatestReadingCache
+from migrate_database import run_migrations
+
+
+def entry(appliance_id, ts, watts=10.0):
+    return LatestEntry(ts, appliance_id, "2024-01-15 14:30:00", watts, "Main Appliance", ts)
+
+
+def test_fan_out_to_every_subscriber():
+    async def run():
+        broadcaster = Broadcaster()
+        everyone = [broadcaster.subscribe() for _ in range(50)]
+        fridge = broadcaster.subscribe(appliance_id=2)
+
+        broadcaster.publish([entry(1, 100), entry(2, 100)])
+
+        for subscription in everyone:
+            assert (await subscription.get(timeout=0.1)).appliance_id == 1
+            assert (await subscription.get(timeout=0.1)).appliance_id == 2
+        message = await fridge.get(timeout=0.1)
+        assert message.appliance_id == 2
+        assert message.frame.startswith(b"event: reading\nid: 100\ndata: {")
+        assert await fridge.get(timeout=0.01) is None
+        assert broadcaster.stats()["delivered"] == 101
+
+    asyncio.run(run())
+
+
+def test_slow_subscriber_drops_oldest():
+    async def run():
+        broadcaster = Broadcaster(queue_size=3)
+        subscription = broadcaster.subscribe()
+        broadcaster.publish([entry(1, ts) for ts in range(5)])
+
+        received = [(await subscription.get(timeout=0.1)).frame for _ in range(3)]
+        assert received[0].startswith(b"event: reading\nid: 2\n")
+        assert broadcaster.stats()["dropped"] == 2
+
+        broadcaster.unsubscribe(subscription)
+        assert broadcaster.stats()["subscribers"] == 0
+
+    asyncio.run(run())
+
+
+def test_cache_reports_every_new_reading(tmp_path):
+    db = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(db))
+    configure_connection(conn)
+    run_migrations(conn)
+    writer = BufferedWriter(conn, batch_size=100)
+    writer.add("2024-01-15 14:30:00", 10.0)
+    writer.close()
+
+    cache = LatestReadingCache(db)
+    cache.add_listener(lambda entries: None)
+    cache.refresh()
+    assert cache.drain_updates() == []  # Initial load is not a stream of updates
+
+    writer.add("2024-01-15 14:30:05", 11.0)
+    writer.add("2024-01-15 14:30:10", 12.0)
+    writer.close()
+    cache.refresh()
+    assert [e.watts for e in cache.drain_updates()] == [11.0, 12.0]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Tests for the kWh accumulators and tariff costs
+"""
+import json
+import sqlite3
+import time
+
+import pytest
+
+import consumption
+import rollups
+from consumption import ConsumptionMaintainer, Tariff, period_start
+from db_writer import BufferedWriter
+from migrate_database import run_migrations
+
+TARIFF_CONFIG = {
+    "currency": "USD",
+    "standing_charge_per_day": 0.5,
+    "bands": {
+        "peak": {"price_per_kwh": 0.30,
+                 "times": [{"start": "17:00", "end": "19:00", "days": ["mon", "tue", "wed", "thu", "fri"]}]},
+        "off_peak": {"price_per_kwh": 0.10, "times": [{"start": "23:00", "end": "07:00"}]},
+        "standard": {"price_per_kwh": 0.20},
+    },
+}
+TARIFF = Tariff.from_dict(TARIFF_CONFIG)
+
+
+def local(*fields):
+    return int(time.mktime(fields + (0,) * (6 - len(fields)) + (0, 0, -1)))
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "energy.db"))
+    run_migrations(conn, pause=0)
+    yield conn
+    conn.close()
+
+
+def write(conn, readings, hooks=None):
+    writer = BufferedWriter(conn, batch_size=3, hooks=hooks or [ConsumptionMaintainer(TARIFF)])
+    for ts, watts, appliance_id in readings:
+        writer.add(f"reading {ts}", watts, appliance_id, ts=ts)
+    writer.close()
+
+
+def totals(conn, period):
+    return {
+        (appliance_id, start, band): (wh, covered)
+        for appliance_id, start, band, wh, covered in conn.execute(
+            "SELECT appliance_id, period_start, band, wh, covered_s FROM energy_totals WHERE period = ?",
+            (period,)
+        )
+    }
+
+
+def test_tariff_bands_by_time_and_weekday():
+    monday, saturday = local(2024, 1, 15), local(2024, 1, 20)
+
+    def band(day, hour):
+        ts = day + hour * 3600
+        return next(TARIFF.split(ts, 1.0, ts + 1, 1.0))[1]
+
+    assert [band(monday, h) for h in (0, 6, 7, 17, 18, 19, 23)] == [
+        "off_peak", "off_peak", "standard", "peak", "peak", "standard", "off_peak"
+    ]
+    assert band(saturday, 17) == "standard"
+
+    with pytest.raises(ValueError):
+        Tariff({"a": {"price_per_kwh": 1.0}, "b": {"price_per_kwh": 2.0}})
+
+
+def test_interval_is_split_at_band_boundary_with_interpolated_power():
+    t0 = local(2024, 1, 15, 6, 59)
+    # 0 W -> 240 W over two minutes, crossing 07:00 half way
+    pieces = list(TARIFF.split(t0, 0.0, t0 + 120, 240.0))
+
+    assert [(band, seconds) for _, band, seconds, _ in pieces] == [("off_peak", 60), ("standard", 60)]
+    assert pieces[0][3] == pytest.approx(60 * 60 / 3600)   # Mean 60 W for a minute
+    assert pieces[1][3] == pytest.approx(180 * 60 / 3600)  # Mean 180 W for a minute
+
+
+def test_accumulates_per_period_and_skips_gaps(conn):
+    before_midnight = local(2024, 1, 31, 23, 58)
+    readings = [(before_midnight + 60 * i, 600.0, 1) for i in range(5)]  # 23:58 .. 00:02
+    readings += [(before_midnight + 240 + rollups.MAX_GAP + 1, 600.0, 1)]  # After a gap
+    readings += [(before_midnight, 100.0, 2), (before_midnight + 60, 100.0, 2)]
+    write(conn, readings)
+
+    jan, feb = local(2024, 1, 31), local(2024, 2, 1)
+    days = totals(conn, "day")
+    assert days[(1, jan, "off_peak")] == (pytest.approx(20.0), 120)  # 600 W for 2 min
+    assert days[(1, feb, "off_peak")] == (pytest.approx(20.0), 120)
+    assert days[(2, jan, "off_peak")] == (pytest.approx(100 / 60), 60)
+
+    months = totals(conn, "month")
+    assert months[(1, local(2024, 1, 1), "off_peak")][0] == pytest.approx(20.0)
+    assert months[(1, local(2024, 2, 1), "off_peak")][0] == pytest.approx(20.0)
+    years = totals(conn, "year")
+    assert years[(1, local(2024, 1, 1), "off_peak")] == (pytest.approx(40.0), 240)
+    assert period_start(feb, "week") == local(2024, 1, 29)
+
+
+def test_rebuild_matches_live_accumulation(conn, tmp_path):
+    start = local(2024, 3, 4, 16, 50)
+    readings = [(start + 7 * i, 100.0 + i, 1 + i % 2) for i in range(400)]  # Irregular spacing per appliance
+    write(conn, readings)
+    live = totals(conn, "week")
+
+    tariff_path = tmp_path / "tariff.json"
+    tariff_path.write_text(json.dumps(TARIFF_CONFIG))
+    consumption.rebuild(tmp_path / "energy.db", tariff_path, archive_root=tmp_path / "archive", pause=0)
+    rebuilt = totals(conn, "week")
+
+    assert rebuilt.keys() == live.keys()
+    for key, (wh, covered) in live.items():
+        assert rebuilt[key][0] == pytest.approx(wh)
+        assert rebuilt[key][1] == covered
+
+
+def test_summarize_prices_bands_and_standing_charge():
+    start = local(2024, 1, 15)
+    end = consumption.next_period_start(start, "week")
+    rows = [
+        (1, "peak", 2000.0, 3600),
+        (1, "standard", 1000.0, 3600),
+        (2, "standard", 500.0, 1800),
+        (2, "retired_band", 100.0, 60),
+    ]
+    now = start + 2 * 86400 + 3600  # During the third day
+
+    house = consumption.summarize(rows, TARIFF, "week", start, end, now)
+    assert house["kwh"] == pytest.approx(3.6)
+    assert house["energy_cost"] == pytest.approx(2 * 0.30 + 1.5 * 0.20)
+    assert house["standing_charge"] == pytest.approx(1.5)
+    assert house["total_cost"] == pytest.approx(0.9 + 1.5)
+    retired = [b for b in house["bands"] if b["band"] == "retired_band"][0]
+    assert retired["cost"] is None
+    assert [a["appliance_id"] for a in house["appliances"]] == [1, 2]
+
+    one = consumption.summarize(rows, TARIFF, "week", start, end, now, appliance_id=1)
+    assert one["kwh"] == pytest.approx(3.0)
+    assert one["standing_charge"] == 0
+    assert one["appliances"][0]["coverage"] == pytest.approx(7200 / (now - start))
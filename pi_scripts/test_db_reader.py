@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Tests for the pooled read-only database access layer
+"""
+import asyncio
+import sqlite3
+
+import pytest
+
+import db_reader
+from db_reader import ReadPool
+from db_writer import BufferedWriter, configure_connection
+from migrate_database import run_migrations
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(path))
+    configure_connection(conn)
+    run_migrations(conn)
+    writer = BufferedWriter(conn, batch_size=100)
+    for i in range(10):
+        writer.add(f"2024-01-15 14:30:{i:02d}", float(i))
+    writer.close()
+    yield path
+    conn.close()
+
+
+LATEST_SQL = "SELECT timestamp, watts FROM usage WHERE appliance_id = ? ORDER BY ts DESC LIMIT 1"
+
+
+def test_fetchone_and_fetchall(db_path):
+    pool = ReadPool(db_path, size=2)
+
+    async def queries():
+        latest = await pool.fetchone(LATEST_SQL, (1,))
+        rows = await pool.fetchall("SELECT watts FROM usage ORDER BY ts")
+        return latest, rows
+
+    latest, rows = asyncio.run(queries())
+    assert latest == ("2024-01-15 14:30:09", 9.0)
+    assert len(rows) == 10
+    pool.close()
+
+
+def test_pool_is_bounded_and_records_timings(db_path):
+    pool = ReadPool(db_path, size=2)
+
+    async def queries():
+        return await asyncio.gather(*(pool.fetchone(LATEST_SQL, (1,)) for _ in range(20)))
+
+    assert len(asyncio.run(queries())) == 20
+    stats = pool.stats()
+    assert stats["open"] <= 2
+    assert stats["in_use"] == 0
+    assert stats["wait"]["count"] == 20
+    assert stats["queries"][LATEST_SQL]["count"] == 20
+    pool.close()
+
+
+def test_connections_are_read_only(db_path):
+    pool = ReadPool(db_path, size=1)
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(pool.fetchone("DELETE FROM usage"))
+    # The connection goes back to the pool after an error
+    assert pool.stats()["in_use"] == 0
+    pool.close()
+
+
+def test_query_stats_stay_bounded(db_path, monkeypatch):
+    monkeypatch.setattr(db_reader, "MAX_QUERY_STATS", 3)
+    pool = ReadPool(db_path, size=1)
+
+    async def queries():
+        for n in range(1, 6):
+            await pool.fetchall(f"SELECT watts FROM usage WHERE appliance_id IN ({', '.join('?' * n)})", (1,) * n)
+        for n in range(5):
+            await pool.fetchone(f"SELECT {n}")
+
+    asyncio.run(queries())
+    counts = {key: stats["count"] for key, stats in pool.stats()["queries"].items()}
+    assert counts == {
+        "SELECT watts FROM usage WHERE appliance_id IN (?)": 1,
+        "SELECT watts FROM usage WHERE appliance_id IN (?, ...)": 4,
+        "SELECT 0": 1,
+        db_reader.OTHER_QUERIES: 4,
+    }
+    pool.close()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tests for the buffered SQLite writer
+"""
+import sqlite3
+
+import pytest
+
+from db_writer import BufferedWriter, configure_connection
+from migrate_database import run_migrations
+
+
+def make_db(path):
+    conn = sqlite3.connect(str(path))
+    run_migrations(conn)
+    return conn
+
+
+def count_rows(path):
+    conn = sqlite3.connect(str(path))
+    count = conn.execute("SELECT COUNT(*) FROM usage").fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_wal_mode(tmp_path):
+    conn = make_db(tmp_path / "energy.db")
+    assert configure_connection(conn, "normal") == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+
+
+def test_flushes_on_batch_size(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=3, flush_interval=3600)
+
+    writer.add("2024-01-15 14:30:25", 10.0)
+    writer.add("2024-01-15 14:30:30", 11.0)
+    assert count_rows(db) == 0
+    assert writer.pending == 2
+
+    writer.add("2024-01-15 14:30:35", 12.0)
+    assert count_rows(db) == 3
+    assert writer.stats()["flushes"] == 1
+    assert writer.stats()["rows_per_commit"] == 3
+
+
+def test_flushes_on_interval(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=100, flush_interval=0)
+
+    writer.add("2024-01-15 14:30:25", 10.0)
+    assert count_rows(db) == 1
+
+
+def test_close_flushes_pending(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=100, flush_interval=3600)
+    writer.add("2024-01-15 14:30:25", 10.0, 2, "Fridge")
+    writer.close()
+
+    conn = sqlite3.connect(str(db))
+    assert conn.execute("SELECT watts, appliance_id, appliance_name FROM usage").fetchall() == [(10.0, 2, None)]
+    assert conn.execute("SELECT id, name FROM appliances").fetchall() == [(2, "Fridge")]
+
+
+def test_registers_each_name_once(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=2, flush_interval=3600)
+    writer.add("2024-01-15 14:30:25", 10.0, 2, "Fridge")
+    writer.add("2024-01-15 14:30:30", 11.0, 2, "Fridge")
+    conn = sqlite3.connect(str(db))
+    with conn:
+        conn.execute("UPDATE appliances SET updated_ts = 0")
+
+    writer.add("2024-01-15 14:30:35", 12.0, 2, "Fridge")
+    writer.add("2024-01-15 14:30:40", 13.0, 3, "Freezer")
+    registered = conn.execute("SELECT id, name, updated_ts > 0 FROM appliances ORDER BY id").fetchall()
+    assert registered == [(2, "Fridge", 0), (3, "Freezer", 1)]
+
+    writer.add("2024-01-15 14:30:45", 14.0, 2, "Kitchen Fridge")
+    writer.close()
+    assert conn.execute("SELECT name FROM appliances WHERE id = 2").fetchone()[0] == "Kitchen Fridge"
+
+
+def test_failed_flush_keeps_rows(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "energy.db"))
+    writer = BufferedWriter(conn, batch_size=100, flush_interval=3600)
+    writer.add("2024-01-15 14:30:25", 10.0)
+
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    assert writer.pending == 1
+    assert writer.stats()["failed_flushes"] == 1
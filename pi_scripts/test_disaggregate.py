@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Tests for the load disaggregation of the main channel
+"""
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+import appliances
+import consumption
+import disaggregate
+from db_writer import BufferedWriter, configure_connection
+from disaggregate import Disaggregator, DisaggregationSink
+from migrate_database import run_migrations
+from pipeline import Reading
+
+START = 1733300000
+ID_BASE = 5000
+
+
+def house(n, seed=0):
+    """n 5 s readings: 80 W base, a 120 W fridge cycling every 500 samples, a 2 kW kettle now and then"""
+    ts = START + 5 * np.arange(n)
+    watts = np.full(n, 80.0)
+    for s in range(0, n, 500):
+        watts[s + 50:s + 250] += 120
+    for s in range(100, n, 3000):
+        watts[s:s + 40] += 2000
+    watts += np.random.default_rng(seed).normal(0, 3, n)
+    return ts, np.round(watts, 2)
+
+
+def run(ts, watts, chunk):
+    disaggregator = Disaggregator(id_base=ID_BASE)
+    parts = [disaggregator.process(ts[i:i + chunk], watts[i:i + chunk]) for i in range(0, len(ts), chunk)]
+    return disaggregator, [np.concatenate(column) for column in zip(*parts)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(path))
+    configure_connection(conn)
+    run_migrations(conn, pause=0)
+    with conn:
+        appliances.register(conn, 1, "Main Appliance")
+    yield path, conn
+    conn.close()
+
+
+def add_readings(conn, ts, watts):
+    tariff = consumption.Tariff({"standard": {"price_per_kwh": 0.0}})
+    writer = BufferedWriter(conn, batch_size=5000, hooks=[consumption.ConsumptionMaintainer(tariff)])
+    for t, w in zip(ts.tolist(), watts.tolist()):
+        writer.add(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)), w, ts=t)
+    writer.close()
+
+
+def test_devices_are_clustered_and_split_off():
+    ts, watts = house(9000)
+    disaggregator, (out_ts, ids, out_watts) = run(ts, watts, len(ts))
+
+    devices = sorted(disaggregator.devices, key=lambda d: d.watts)
+    assert [round(d.watts, -1) for d in devices] == [120, 2000]
+    assert devices[0].cycles == 18 and devices[1].cycles == 3
+    assert disaggregator.last_ts == ts[-1] and np.all(np.diff(out_ts) >= 0)
+
+    # Once reported, the estimates add up to the reading except on the sample
+    # of each edge, where the new level is not confirmed yet
+    fridge, kettle = devices[0].appliance_id, devices[1].appliance_id
+    late = out_ts >= ts[3000]
+    totals = np.zeros(len(ts))
+    np.add.at(totals, np.searchsorted(ts, out_ts[late]), out_watts[late])
+    off = np.abs(totals[3000:] - watts[3000:]) > 30
+    assert off.sum() <= 12 * 2 + 2 * 2 and np.all(np.abs(np.diff(watts))[2999:][off] > 40)
+    other = out_watts[late & (ids == ID_BASE)]
+    assert len(other) == 6000 and abs(np.median(other) - 80) < 10
+    fridge_on = late & (ids == fridge) & (out_watts > 0)
+    assert fridge_on.sum() == pytest.approx(12 * 200, abs=24)
+    assert ((ids == kettle) & (out_watts == 0)).sum() == 1  # Reported on its second cycle, one off so far
+
+
+def test_incremental_matches_one_batch_and_skips_replays():
+    ts, watts = house(4000, seed=1)
+    _, expected = run(ts, watts, len(ts))
+    for chunk in (1, 7, 333):
+        _, result = run(ts, watts, chunk)
+        for column, expected_column in zip(result, expected):
+            assert np.array_equal(column, expected_column)
+
+    # Already processed readings produce nothing
+    disaggregator, _ = run(ts, watts, 1000)
+    assert all(len(column) == 0 for column in disaggregator.process(ts[-10:], watts[-10:]))
+
+
+def test_backfill_resumes_and_matches_live_sink(db, tmp_path):
+    path, conn = db
+    ts, watts = house(6000, seed=2)
+    add_readings(conn, ts[:4000], watts[:4000])
+
+    first = disaggregate.backfill(path, chunk_size=1500)
+    assert first > 4000
+    assert disaggregate.backfill(path) == 0  # Nothing new
+    add_readings(conn, ts[4000:], watts[4000:])
+    second = disaggregate.backfill(path, chunk_size=1500)
+
+    # Other, fridge and kettle, from the block reserved for appliance 1
+    base = disaggregate.id_block(conn, 1)
+    virtual = [row[0] for row in conn.execute(disaggregate.VIRTUAL_IDS_SQL)]
+    assert base >= appliances.RESERVED_ID_START and sorted(virtual) == [base, base + 1, base + 2]
+    assert conn.execute("SELECT COUNT(*) FROM usage WHERE appliance_id >= ?", (base,)).fetchone()[0] == first + second
+    assert conn.execute("SELECT COUNT(*) FROM rollup_hour WHERE appliance_id = ?", (base,)).fetchone()[0] > 0
+    assert conn.execute("SELECT name FROM appliances WHERE id = ?", (base + 1,)).fetchone()[0].startswith("Device 1 ")
+
+    # Whole-house totals leave the estimates out
+    day = consumption.period_start(int(ts[0]), "day")
+    rows = conn.execute(consumption.QUERY_SQL + disaggregate.MEASURED_FILTER, ("day", day)).fetchall()
+    assert {row[0] for row in rows} == {1}
+
+    # The same readings through the live sink give the same estimates
+    live_path = tmp_path / "live.db"
+    live = sqlite3.connect(str(live_path))
+    run_migrations(live, pause=0)
+    live.close()
+    sink = DisaggregationSink(live_path, batch_size=50)
+    sink.open()
+    for i in range(0, len(ts), 12):
+        sink.handle([Reading("", t, w, 1, "Main Appliance") for t, w in zip(ts[i:i + 12].tolist(),
+                                                                           watts[i:i + 12].tolist())])
+        sink.handle([Reading("", int(ts[i]), 5.0, 2, "Fridge")])  # Other appliances are ignored
+    sink.close()
+
+    # Both databases reserve the same first block, so the ids match too
+    query = "SELECT ts, appliance_id, watts FROM usage WHERE appliance_id >= ? ORDER BY ts, appliance_id"
+    live = sqlite3.connect(str(live_path))
+    assert sink.disaggregator.id_base == base
+    assert live.execute(query, (base,)).fetchall() == conn.execute(query, (base,)).fetchall()
+    reloaded = Disaggregator()
+    assert reloaded.load(live) and reloaded.last_ts == ts[-1]
+    assert [d.watts for d in reloaded.devices] == pytest.approx([d.watts for d in sink.disaggregator.devices])
+    live.close()
+
+    # Rebuilding starts over and ends up in the same place
+    assert disaggregate.backfill(path, rebuild=True) == first + second
+
+
+def test_status_does_not_write(db, capsys):
+    path, conn = db
+    disaggregate.print_status(path)
+    assert capsys.readouterr().out == "Nothing disaggregated yet\n"
+    assert appliances.reserved(conn, disaggregate.block_owner(1)) is None
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'appliance_id_blocks'").fetchone() is None
+
+    ts, watts = house(3000, seed=4)
+    add_readings(conn, ts, watts)
+    disaggregate.backfill(path)
+    disaggregate.print_status(path)
+    assert capsys.readouterr().out.startswith("Processed up to ")
+
+
+def test_sources_get_their_own_id_blocks(db):
+    path, conn = db
+    ts, watts = house(3000, seed=3)
+    add_readings(conn, ts, watts)
+    writer = BufferedWriter(conn, batch_size=5000)
+    for t, w in zip(ts.tolist(), (watts * 2).tolist()):
+        writer.add("", w, 2, "Sub-board", ts=t)
+    writer.close()
+
+    main_rows = disaggregate.backfill(path, source_id=1)
+    disaggregate.backfill(path, source_id=2)
+    main, sub = disaggregate.id_block(conn, 1), disaggregate.id_block(conn, 2)
+    assert sub == main + disaggregate.ID_BLOCK
+    # An appliance registered in the range afterwards does not move them
+    with conn:
+        appliances.register(conn, sub + disaggregate.ID_BLOCK, "Someone else's")
+    assert disaggregate.id_block(conn, 2) == sub
+
+    # Rebuilding one source leaves the other's estimates alone
+    block = "SELECT COUNT(*) FROM usage WHERE appliance_id >= ? AND appliance_id < ?"
+    before = conn.execute(block, (sub, sub + disaggregate.ID_BLOCK)).fetchone()[0]
+    disaggregate.clear(conn, 1)
+    assert conn.execute(block, (main, main + disaggregate.ID_BLOCK)).fetchone()[0] == 0
+    assert conn.execute(block, (sub, sub + disaggregate.ID_BLOCK)).fetchone()[0] == before > 0
+    assert disaggregate.backfill(path, source_id=1) == main_rows
+
+    with pytest.raises(ValueError):
+        Disaggregator(settings={"max_devices": disaggregate.ID_BLOCK})
+    with pytest.raises(RuntimeError):
+        Disaggregator().process(ts, watts)
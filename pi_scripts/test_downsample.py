@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Tests for chart downsampling
+"""
+import numpy as np
+import pytest
+
+from downsample import lttb, minmax
+
+
+def test_minmax_keeps_spikes_and_bounds_size():
+    ts = np.arange(100000)
+    watts = np.full(len(ts), 100.0)
+    watts[12345] = 5000.0   # Kettle spike
+    watts[67890] = 0.0      # Dropout
+
+    out_ts, out_watts = minmax(ts, watts, watts, 0, len(ts), 500)
+
+    assert len(out_ts) <= 500
+    assert np.all(np.diff(out_ts) > 0)
+    assert 5000.0 in out_watts and 0.0 in out_watts
+    assert out_ts[out_watts.argmax()] == 12345
+
+
+def test_minmax_uses_rollup_extremes():
+    ts = np.arange(0, 6000, 60)
+    low = np.full(len(ts), 10.0)
+    high = np.full(len(ts), 20.0)
+    high[50] = 900.0
+
+    _, out = minmax(ts, low, high, 0, 6000, 10)
+
+    assert out.min() == 10.0 and out.max() == 900.0
+
+
+def test_short_series_returned_whole():
+    ts = np.arange(5)
+    watts = np.arange(5, dtype=float)
+    out_ts, out_watts = minmax(ts, watts, watts, 0, 5, 100)
+    assert out_ts.tolist() == ts.tolist()
+    assert lttb(ts, watts, 100)[1].tolist() == watts.tolist()
+
+
+def test_lttb_picks_shape_points():
+    ts = np.arange(1000)
+    watts = np.zeros(1000)
+    watts[500] = 1000.0
+
+    out_ts, out_watts = lttb(ts, watts, 20)
+
+    assert len(out_ts) == 20
+    assert out_ts[0] == 0 and out_ts[-1] == 999
+    assert 500 in out_ts.tolist()
+
+    with pytest.raises(ValueError):
+        lttb(ts, watts, 2)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Tests for response compression and the compact history formats
+"""
+import json
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+import encoding
+from encoding import CompressionMiddleware, FastJSONResponse
+
+
+@pytest.fixture
+def client():
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.add_middleware(CompressionMiddleware)
+
+    @app.get("/big")
+    def big():
+        return {"data": [{"timestamp": "2024-12-04 10:30:45", "watts": 125.5}] * 200}
+
+    @app.get("/small")
+    def small():
+        return {"status": "ok"}
+
+    @app.get("/events")
+    def events():
+        return PlainTextResponse("data: x\n\n" * 500, media_type="text/event-stream")
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse((b'{"n": %d}\n' % i for i in range(1000)), media_type="application/x-ndjson")
+
+    return TestClient(app)
+
+
+def test_accepted_encoding(monkeypatch):
+    monkeypatch.setattr(encoding, "brotli", None)
+    assert encoding.accepted_encoding("gzip, deflate") == "gzip"
+    assert encoding.accepted_encoding("br, gzip") == "gzip"  # brotli not installed
+    assert encoding.accepted_encoding("identity") is None
+    assert encoding.accepted_encoding("gzip;q=0, *") is None
+    assert encoding.accepted_encoding("*") == "gzip"
+
+    monkeypatch.setattr(encoding, "brotli", object())
+    assert encoding.accepted_encoding("gzip, br") == "br"
+    assert encoding.accepted_encoding("gzip;q=1.0, br;q=0.5") == "gzip"
+
+
+def test_compresses_large_and_streamed_bodies(client):
+    headers = {"Accept-Encoding": "gzip"}
+
+    response = client.get("/big", headers=headers)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(response.content) // 10
+    assert len(response.json()["data"]) == 200
+
+    response = client.get("/stream", headers=headers)
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert response.text.splitlines()[-1] == '{"n": 999}'
+
+
+def test_leaves_small_event_and_unrequested_bodies_alone(client):
+    assert "content-encoding" not in client.get("/small", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in client.get("/events", headers={"Accept-Encoding": "gzip"}).headers
+
+    response = client.get("/big", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert len(response.json()["data"]) == 200
+
+
+def test_packed_history_round_trip():
+    ts = [1733304645, 1733304650, 1733304655]
+    watts = [125.5, 0.0, 2999.25]
+    body = encoding.packed_history(ts, watts)
+    assert len(body) == 8 * len(ts)
+
+    unpacked_ts, unpacked_watts = encoding.packed_arrays(body)
+    assert unpacked_ts.tolist() == ts
+    assert unpacked_watts.dtype == np.float32 and unpacked_watts.tolist() == watts
+    assert json.loads(encoding.dumps({"ts": ts, "watts": watts})) == {"ts": ts, "watts": watts}
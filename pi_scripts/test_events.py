@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Tests for the streaming event detector and its pipeline sink
+"""
+import sqlite3
+import time
+
+import pytest
+
+from events import EventDetector, EventSink
+from migrate_database import run_migrations
+from pipeline import Reading
+
+START = 1_700_000_000
+
+
+def feed(detector, watts, appliance_id=1, interval=5):
+    found = []
+    for i, w in enumerate(watts):
+        found.extend(detector.update(START + i * interval, appliance_id, w, "Fridge"))
+    return [(e.ts - START) // interval for e in found], [e.kind for e in found]
+
+
+def test_on_off_with_hysteresis_and_confirmation():
+    detector = EventDetector()
+    # A single reading above on_watts is not enough, and 8 W / 7 W stay above off_watts
+    watts = [0, 0, 12, 0, 0, 150, 150, 150, 8, 7, 151, 150, 3, 2, 0]
+    positions, kinds = feed(detector, watts)
+    assert kinds == ["on", "off"]
+    assert positions == [6, 13]
+
+
+def test_step_changes_ignore_noise_and_spikes():
+    detector = EventDetector()
+    noise = [100, 102, 98, 101, 99, 100, 103, 97, 100]
+    # A single 900 W spike, then a level of 400 W that holds
+    watts = [0] + noise + [900] + noise + [400, 405, 398, 402, 400, 401] + [100, 99, 101]
+    positions, kinds = feed(detector, watts)
+    assert kinds == ["on", "step_up", "step_down"]
+    step_up = positions[1]
+    assert step_up == len(noise) + 1 + len(noise) + 2
+    # The baseline moved to the new level, so going back down is a step too
+    assert positions[2] == len(watts) - 2
+
+
+def test_over_limit_and_stall():
+    detector = EventDetector(appliance_rules={1: {"max_watts": 1000}})
+    _, kinds = feed(detector, [500, 1200, 1300, 800, 1100])
+    assert kinds == ["over_limit", "over_limit"]
+
+    last_ts = START + 4 * 5
+    assert detector.check_stalled(last_ts + 30) == []
+    stalled = detector.check_stalled(last_ts + 61)
+    assert [(e.kind, e.appliance_id) for e in stalled] == [("stalled", 1)]
+    assert detector.check_stalled(last_ts + 120) == []  # Reported once
+
+    resumed = detector.update(last_ts + 200, 1, 800, "Fridge")
+    assert [e.kind for e in resumed] == ["resumed"]
+    assert "200 s" in resumed[0].message
+
+
+def test_sink_writes_events(tmp_path):
+    db_path = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(db_path))
+    run_migrations(conn, pause=0)
+
+    messages = []
+    sink = EventSink(db_path, notify=messages.append)
+    sink.open()
+    now = int(time.time())
+    sink.handle([
+        Reading("", now + i, w, 2, "Kettle") for i, w in enumerate([0, 0, 2000, 2000, 0, 0])
+    ])
+    sink.close()
+
+    rows = conn.execute("SELECT appliance_id, kind, watts, message FROM events ORDER BY id").fetchall()
+    assert [(row[0], row[1]) for row in rows] == [(2, "on"), (2, "off")]
+    assert rows[0][2] == pytest.approx(2000)
+    assert messages == [row[3] for row in rows] and messages[0].startswith("Kettle turned on")
+    conn.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Tests for the streamed bulk export
+"""
+import json
+import sqlite3
+import time
+
+import pytest
+
+import export
+import rollups
+from archive import Archive, archive_old_readings
+from db_reader import ReadPool
+from db_writer import BufferedWriter, configure_connection
+from migrate_database import run_migrations
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Five days of minute readings, the oldest days archived; (pool, archive, first ts, end)"""
+    db_path = tmp_path / "energy.db"
+    now = int(time.time())
+    start = rollups.local_day_start(now - 5 * 86400)
+    conn = sqlite3.connect(str(db_path))
+    configure_connection(conn)
+    run_migrations(conn, pause=0)
+    writer = BufferedWriter(conn, batch_size=5000)
+    for ts in range(start, now, 60):
+        writer.add(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)), float(ts % 1000), ts=ts)
+    writer.close()
+    conn.close()
+    archive_old_readings(db_path, tmp_path / "archive", days=2, pause=0)
+
+    pool = ReadPool(db_path, size=1)
+    yield pool, Archive(tmp_path / "archive"), start, now
+    pool.close()
+
+
+def test_csv_merges_archive_and_database_in_order(store, monkeypatch):
+    pool, archive, start, end = store
+    monkeypatch.setattr(export, "TEXT_CHUNK_ROWS", 1000)
+    chunks = list(export.export_chunks(export.iter_readings(pool, archive, 1, start, end), 1, "csv"))
+
+    lines = b"".join(chunks).decode().splitlines()
+    assert lines[0] == "timestamp,ts,watts"
+    ts = [int(line.split(",")[1]) for line in lines[1:]]
+    assert ts == list(range(start, end, 60))
+    assert lines[1] == f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))},{start},{float(start % 1000)}"
+    # Header, then one chunk per 1000 rows
+    assert len(chunks) == 1 + -(-len(ts) // 1000)
+    assert pool.stats()["in_use"] == 0
+
+
+def test_ndjson_range(store):
+    pool, archive, start, end = store
+    first, last = start + 86400, start + 86400 + 600
+    body = b"".join(export.export_chunks(export.iter_readings(pool, archive, 1, first, last), 1, "ndjson"))
+    records = [json.loads(line) for line in body.splitlines()]
+    assert [r["ts"] for r in records] == list(range(first, last, 60))
+    assert records[0]["watts"] == float(first % 1000)
+    assert list(export.iter_readings(pool, archive, 2, start, end)) == []
+
+
+def test_columnar_formats(store, monkeypatch):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    pool, archive, start, end = store
+    monkeypatch.setattr(export, "COLUMNAR_BATCH_ROWS", 1000)
+    expected = list(range(start, end, 60))
+
+    parquet = b"".join(export.export_chunks(export.iter_readings(pool, archive, 1, start, end), 1, "parquet"))
+    table = pq.read_table(pa.BufferReader(parquet))
+    assert table.column("ts").cast(pa.int64()).to_pylist() == expected
+    assert pq.ParquetFile(pa.BufferReader(parquet)).num_row_groups == -(-len(expected) // 1000)
+
+    stream = b"".join(export.export_chunks(export.iter_readings(pool, archive, 1, start, end), 1, "arrow"))
+    table = pa.ipc.open_stream(stream).read_all()
+    assert table.num_rows == len(expected)
+    assert table.schema.metadata[b"appliance_id"] == b"1"
+
+
+def test_database_is_paged_without_holding_a_connection(store, monkeypatch):
+    pool, archive, start, end = store
+    monkeypatch.setattr(export, "EXPORT_PAGE_ROWS", 7)
+    recent = rollups.local_day_start(end - 86400)
+    conn = sqlite3.connect(str(pool.db_path))
+    # Readings sharing a ts straddle page boundaries
+    with conn:
+        conn.executemany(
+            "INSERT INTO usage (timestamp, ts, watts, appliance_id) VALUES ('', ?, ?, 1)",
+            [(recent, float(i)) for i in range(10)]
+        )
+    conn.close()
+
+    rows = export.iter_readings(pool, archive, 1, recent, recent + 3600)
+    first = next(rows)
+    # Between pages the size-1 pool is free for other requests
+    assert pool.stats()["in_use"] == 0
+    assert pool.fetchall_blocking("SELECT 1") == [(1,)]
+    ts = [first[2]] + [row[2] for row in rows]
+    assert ts == [recent] * 11 + list(range(recent + 60, recent + 3600, 60))
+
+
+def test_newest_first_pages_merge_the_archive(store, monkeypatch):
+    pool, archive, start, end = store
+    monkeypatch.setattr(export, "EXPORT_PAGE_ROWS", 50)
+    expected = list(range(start, end, 60))[::-1]
+
+    rows = export.iter_newest_readings(pool, archive, 1)
+    first = next(rows)
+    assert pool.stats()["in_use"] == 0
+    assert [first[2]] + [row[2] for row in rows] == expected
+
+    before = expected[100]
+    assert [row[2] for row in export.iter_newest_readings(pool, archive, 1, before=before, limit=30)] \
+        == expected[101:131]
+    assert [row[2] for row in export.iter_newest_readings(pool, archive, 1, before=start + 600)] \
+        == expected[-10:]
+    assert pool.stats()["in_use"] == 0
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Tests for the hourly consumption forecasts
+"""
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+import appliances
+import forecast
+from forecast import Forecaster, Model, HOUR
+from migrate_database import run_migrations
+
+NOW = 1733300000 - 1733300000 % HOUR + 1800  # Half past an hour
+
+
+def daily_profile(buckets):
+    hours = forecast.season_slots(buckets)
+    return 100.0 + 50.0 * np.sin(2 * np.pi * hours / 24)
+
+
+def add_hours(conn, appliance_id, buckets, watts):
+    conn.executemany(
+        "INSERT OR REPLACE INTO rollup_hour (appliance_id, bucket, count, sum_watts, min_watts, max_watts, wh) "
+        "VALUES (?, ?, 720, ?, ?, ?, ?)",
+        [(appliance_id, b, w * 720, w, w, w) for b, w in zip(buckets.tolist(), watts.tolist())]
+    )
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(path))
+    run_migrations(conn, pause=0)
+    with conn:
+        appliances.register(conn, 1, "Main Appliance")
+        appliances.register(conn, 2, "Fridge")
+        buckets = np.arange(NOW - NOW % HOUR - 10 * 86400, NOW - NOW % HOUR, HOUR)
+        add_hours(conn, 1, buckets, daily_profile(buckets))
+        add_hours(conn, 2, buckets[-5:], np.full(5, 40.0))  # Under a day: no model
+    yield path, conn
+    conn.close()
+
+
+def test_fit_learns_daily_profile_and_skips_gaps():
+    end = NOW - NOW % HOUR
+    buckets = np.arange(end - 14 * 86400, end, HOUR)
+    rng = np.random.default_rng(0)
+    watts = daily_profile(buckets) + rng.normal(0, 2, len(buckets))
+    watts[100:130] = np.nan
+
+    model = Model.fit(1, buckets, watts, now=NOW)
+    assert model.last_bucket == end - HOUR and model.mae < 5
+    predicted_buckets, predicted = model.predict(end, 48)
+    assert predicted_buckets[0] == end and len(predicted) == 48
+    assert np.abs(predicted - daily_profile(predicted_buckets)).max() < 10
+
+    # Under a day is not enough; an exactly repeating day is seasonal-naive's
+    assert Model.fit(1, buckets[:20], watts[:20]) is None
+    repeated = np.tile(np.arange(24, dtype=float), 14)
+    assert Model.fit(1, buckets, repeated).kind == "seasonal_naive"
+
+
+def test_update_saves_models_and_advances_incrementally(db):
+    path, conn = db
+    clock = [NOW]
+    forecaster = Forecaster(path, clock=lambda: clock[0])
+    assert forecaster.update() == 1
+    assert set(forecaster.models) == {1} and forecaster.fits == 1
+    model = forecaster.models[1]
+    assert model.last_bucket == NOW - NOW % HOUR - HOUR
+
+    # Nothing new: nothing refitted or saved
+    assert forecaster.update() == 0
+
+    # Two more hours: fed through the saved model, no refit
+    end = NOW - NOW % HOUR
+    with conn:
+        add_hours(conn, 1, np.array([end, end + HOUR]), np.array([500.0, 500.0]))
+    clock[0] = NOW + 2 * HOUR
+    assert forecaster.update() == 1
+    advanced = forecaster.models[1]
+    assert forecaster.fits == 1 and forecaster.updates == 1
+    assert advanced.last_bucket == end + HOUR
+    assert advanced.predict(end + 86400, 1)[1][0] > model.predict(end + 86400, 1)[1][0]
+    assert advanced.alpha == model.alpha and model.last_bucket == end - HOUR  # Replaced, not modified
+    forecaster.close()
+
+    # A new process loads the saved state instead of fitting
+    reloaded = Forecaster(path, clock=lambda: clock[0])
+    reloaded.open()
+    assert reloaded.models[1].seasonal.tolist() == pytest.approx(advanced.seasonal.tolist())
+    assert reloaded.update() == 0 and reloaded.fits == 0
+    reloaded.close()
+
+
+def test_forecast_response(db):
+    path, _ = db
+    forecaster = Forecaster(path, clock=lambda: NOW)
+    forecaster.update()
+
+    result = forecaster.forecast(1, 24)
+    start = NOW - NOW % HOUR
+    assert result["next_hour"]["ts"] == start
+    assert [hour["ts"] for hour in result["hourly"]] == list(range(start, start + 24 * HOUR, HOUR))
+    assert result["hourly"][0]["timestamp"] == time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))
+    assert result["next_day"]["wh"] == pytest.approx(24 * 100.0, rel=0.05)
+    assert result["next_day"]["kwh"] == pytest.approx(result["next_day"]["wh"] / 1000, abs=0.001)
+
+    # Hours since the last update are skipped, not served from the past
+    later = forecaster.forecast(1, 3, now=NOW + 5 * HOUR)
+    assert later["hourly"][0]["ts"] == start + 5 * HOUR and later["next_day"] is None
+    assert forecaster.forecast(2) is None
+    forecaster.close()
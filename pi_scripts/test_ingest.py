@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests for bulk ingestion: parsing, validation and deduplicated writes
+"""
+import json
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+import consumption
+import ingest
+import rollups
+from ingest import IngestError, Ingestor
+from migrate_database import run_migrations
+from rollups import RollupMaintainer
+
+NOW = 1_733_234_567
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(path))
+    run_migrations(conn, pause=0)
+    conn.close()
+    return path
+
+
+def ndjson(*records):
+    return "\n".join(json.dumps(record) for record in records).encode()
+
+
+def binary(*records):
+    return np.array(list(records), dtype=ingest.BINARY_RECORD).tobytes()
+
+
+def stored(db_path):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        return conn.execute(
+            "SELECT appliance_id, ts, watts FROM usage ORDER BY appliance_id, ts"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def test_ndjson_batch_is_written_once(db_path):
+    body = ndjson(
+        {"appliance_id": 3, "ts": NOW - 10, "watts": 12.5, "appliance_name": "Desk"},
+        {"appliance_id": 3, "ts": NOW - 5, "watts": 13},
+        {"appliance_id": 3, "ts": NOW - 5, "watts": 99},  # Repeated within the batch
+        {"appliance_id": 4, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(NOW - 20)), "watts": 40.0},
+    )
+    ingestor = Ingestor(db_path, hooks=[RollupMaintainer()])
+    readings = ingest.parse(body, "application/x-ndjson", now=NOW)
+
+    assert ingestor.write(readings) == {"received": 4, "inserted": 3, "duplicates": 1, "late": 0}
+    # A resent batch only adds what is new
+    more = ingest.parse(body + b"\n" + ndjson({"appliance_id": 3, "ts": NOW, "watts": 14}),
+                        "application/x-ndjson", now=NOW)
+    assert ingestor.write(more) == {"received": 5, "inserted": 1, "duplicates": 4, "late": 0}
+    ingestor.close()
+
+    rows = stored(db_path)
+    assert [row for row in rows if row[0] == 3] == [(3, NOW - 10, 12.5), (3, NOW - 5, 13.0), (3, NOW, 14.0)]
+
+    conn = sqlite3.connect(str(db_path))
+    # Named once, kept by the unnamed readings that follow
+    assert dict(conn.execute("SELECT id, name FROM appliances")) == {3: "Desk", 4: "Appliance 4"}
+    assert conn.execute("SELECT SUM(count) FROM rollup_minute").fetchone()[0] == 4
+    conn.close()
+
+
+def test_invalid_batch_is_rejected_whole(db_path):
+    body = ndjson(
+        {"appliance_id": 1, "ts": NOW, "watts": 1.0},
+        {"appliance_id": 0, "ts": NOW, "watts": 1.0},
+        {"appliance_id": 1, "ts": NOW + 3600, "watts": 1.0},
+        {"appliance_id": 1, "ts": NOW, "watts": "lots"},
+        {"appliance_id": 100000, "ts": NOW, "watts": 1.0},  # Reserved for node and virtual appliances
+    ) + b"\n{not json"
+
+    with pytest.raises(IngestError) as excinfo:
+        ingest.parse(body, "application/x-ndjson", now=NOW)
+    assert [error.split(":")[0] for error in excinfo.value.errors] == [
+        "line 2", "line 3", "line 4", "line 5", "line 6"
+    ]
+
+    with pytest.raises(ValueError, match="Unsupported content type"):
+        ingest.parse(body, "text/csv", now=NOW)
+    assert stored(db_path) == []
+
+
+def test_binary_records(db_path):
+    body = binary((1, NOW - 5, 100.25), (2, NOW - 5, 7.5), (1, NOW, 101.0))
+    readings = ingest.parse(body, "application/octet-stream", now=NOW)
+    assert readings == [(1, NOW - 5, 100.25, None), (2, NOW - 5, 7.5, None), (1, NOW, 101.0, None)]
+
+    ingestor = Ingestor(db_path)
+    assert ingestor.write(readings)["inserted"] == 3
+    ingestor.close()
+    assert stored(db_path) == [(1, NOW - 5, 100.25), (1, NOW, 101.0), (2, NOW - 5, 7.5)]
+
+    with pytest.raises(IngestError, match="not a multiple of 10"):
+        ingest.parse(body[:-1], "application/octet-stream", now=NOW)
+    with pytest.raises(IngestError) as excinfo:
+        ingest.parse(binary((0, NOW, 1.0), (1, 5, 1.0), (1, NOW, np.inf)), "application/octet-stream", now=NOW)
+    assert [error.split(":")[0] for error in excinfo.value.errors] == ["record 1", "record 2", "record 3"]
+
+
+def test_late_reading_splits_the_interval_it_lands_in(db_path, tmp_path):
+    tariff = consumption.Tariff({"standard": {"price_per_kwh": 0.0}})
+    ingestor = Ingestor(db_path, hooks=[RollupMaintainer(), consumption.ConsumptionMaintainer(tariff)])
+    first = [(5, ts, 100.0, None) for ts in range(NOW - 60, NOW + 1, 10)]
+    assert ingestor.write(first)["inserted"] == 7
+
+    def energy():
+        conn = sqlite3.connect(str(db_path))
+        try:
+            rollup = conn.execute("SELECT SUM(wh) FROM rollup_day WHERE appliance_id = 5").fetchone()[0]
+            totals = conn.execute(
+                "SELECT SUM(wh) FROM energy_totals WHERE appliance_id = 5 AND period = 'day'"
+            ).fetchone()[0]
+            return rollup, totals
+        finally:
+            conn.close()
+
+    before = energy()
+    assert before[0] == pytest.approx(100.0 * 60 / 3600) and before[1] == pytest.approx(before[0])
+
+    # A reading between two stored ones replaces the 10 s interval it lands in with two halves
+    result = ingestor.write([(5, NOW - 35, 5000.0, None), (5, NOW + 10, 100.0, None)])
+    ingestor.close()
+    assert result == {"received": 2, "inserted": 2, "duplicates": 0, "late": 1}
+    assert (5, NOW - 35, 5000.0) in stored(db_path)
+    expected = (100.0 * 70 - 100.0 * 10 + (100.0 + 5000.0) / 2 * 10) / 3600
+    assert energy() == pytest.approx((expected, expected))
+
+    # A rebuild, where the late reading comes in a later chunk than its neighbours, agrees
+    rollups.rebuild(db_path, chunk_size=3, pause=0, archive_root=tmp_path / "archive")
+    consumption.rebuild(db_path, tariff_path=tmp_path / "tariff.json", archive_root=tmp_path / "archive",
+                        chunk_size=3, pause=0)
+    assert energy() == pytest.approx((expected, expected))
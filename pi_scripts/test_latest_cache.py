@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Tests for the latest-reading cache
+"""
+import sqlite3
+
+import latest_cache
+from db_writer import BufferedWriter, configure_connection
+from latest_cache import LatestReadingCache
+from migrate_database import run_migrations
+
+
+def make_db(path):
+    conn = sqlite3.connect(str(path))
+    configure_connection(conn)
+    run_migrations(conn)
+    return conn
+
+
+def test_loads_latest_per_appliance(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=100)
+    writer.add("2024-01-15 14:30:00", 10.0, 1, "Main Appliance")
+    writer.add("2024-01-15 14:30:05", 11.0, 1, "Main Appliance")
+    writer.add("2024-01-15 14:30:00", 50.0, 2, "Fridge")
+    writer.close()
+
+    cache = LatestReadingCache(db)
+    assert cache.refresh()
+    assert cache.get(1).watts == 11.0
+    assert cache.get(2).appliance_name == "Fridge"
+    assert cache.get(3) is None
+
+
+def test_refreshes_only_when_data_changes(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=1)
+    writer.add("2024-01-15 14:30:00", 10.0)
+
+    cache = LatestReadingCache(db)
+    assert cache.refresh()
+    etag = cache.get(1).etag
+    assert not cache.refresh()
+
+    writer.add("2024-01-15 14:30:05", 12.0)
+    assert cache.refresh()
+    assert cache.get(1).watts == 12.0
+    assert cache.get(1).etag != etag
+
+
+def test_older_late_reading_does_not_replace_latest(tmp_path):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=1)
+    writer.add("2024-01-15 14:30:05", 12.0)
+
+    cache = LatestReadingCache(db)
+    cache.refresh()
+    writer.add("2024-01-15 14:00:00", 3.0)
+    cache.refresh()
+    assert cache.get(1).watts == 12.0
+
+
+def test_deleted_newest_rows_are_dropped(tmp_path):
+    db = tmp_path / "energy.db"
+    conn = make_db(db)
+    writer = BufferedWriter(conn, batch_size=1)
+    writer.add("2024-01-15 14:30:00", 10.0, 1, "Main Appliance")
+    writer.add("2024-01-15 14:30:00", 50.0, 2, "Fridge")
+    writer.add("2024-01-15 14:30:05", 11.0, 1, "Main Appliance")
+
+    cache = LatestReadingCache(db)
+    cache.refresh()
+    main = cache.data_version(1)
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    # Neither the first nor the last row, so MIN(rowid) alone would miss it
+    with conn:
+        conn.execute("DELETE FROM usage WHERE appliance_id = 2")
+    writer.add("2024-01-15 14:30:10", 12.0, 1, "Main Appliance")
+    cache.refresh()
+    assert cache.get(2) is None and cache.get(1).watts == 12.0
+    assert cache.data_version(1) != main
+    # Noticed through the trigger-maintained counter, not by counting rows
+    assert not [sql for sql in statements if "COUNT(" in sql.upper()]
+
+    with conn:
+        conn.execute("DELETE FROM usage WHERE rowid = (SELECT MAX(rowid) FROM usage)")
+    cache.refresh()
+    assert cache.get(1).watts == 11.0
+
+
+def test_bulk_insert_builds_one_entry_per_appliance(tmp_path, monkeypatch):
+    db = tmp_path / "energy.db"
+    writer = BufferedWriter(make_db(db), batch_size=1000)
+    writer.add("2024-01-15 14:30:00", 10.0, 1, "Main Appliance")
+    writer.close()
+
+    cache = LatestReadingCache(db)
+    cache.refresh()
+    built = []
+
+    class CountingEntry(latest_cache.LatestEntry):
+        __slots__ = ()
+
+        def __init__(self, *row):
+            built.append(row[1])
+            super().__init__(*row)
+
+    monkeypatch.setattr(latest_cache, "LatestEntry", CountingEntry)
+    for second in range(1, 60):
+        writer.add(f"2024-01-15 14:35:{second:02d}", float(second), 1, "Main Appliance")
+        writer.add(f"2024-01-15 14:35:{second:02d}", 50.0, 2, "Fridge")
+    writer.close()
+    assert cache.refresh()
+    assert sorted(built) == [1, 2]
+    assert cache.get(1).watts == 59.0 and cache.get(2).appliance_name == "Fridge"
+
+
+def test_missing_database_is_retried(tmp_path):
+    cache = LatestReadingCache(tmp_path / "missing.db")
+    assert not cache.refresh()
+    assert cache.get(1) is None
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Tests for the incremental log index
+"""
+import os
+
+from log_index import ENERGY_RECORD_RE, LogIndex
+
+
+def energy_line(hour, minute, watts):
+    return f"2024-01-15 {hour:02d}:{minute:02d}:00,000 - INFO - Time: 2024-01-15 {hour:02d}:{minute:02d}:00, Power: {watts:.2f} W\n"
+
+
+def write_log(path, lines, mode='a'):
+    with open(path, mode) as f:
+        f.writelines(lines)
+
+
+def test_counts_records_incrementally(tmp_path):
+    log = tmp_path / "energy_monitor.log"
+    write_log(log, [energy_line(10, 0, 1.0), "2024-01-15 10:00:00,000 - INFO - Flushed 1 rows\n"])
+
+    index = LogIndex(log, ENERGY_RECORD_RE)
+    assert index.update()
+    assert index.records == 1
+
+    write_log(log, [energy_line(10, 5, 2.0), energy_line(11, 0, 3.0)])
+    index.update()
+    assert index.records == 3
+    assert index.offset == os.path.getsize(log)
+
+
+def test_partial_line_waits_for_newline(tmp_path):
+    log = tmp_path / "energy_monitor.log"
+    line = energy_line(10, 0, 1.0)
+    write_log(log, [line[:20]])
+
+    index = LogIndex(log, ENERGY_RECORD_RE)
+    index.update()
+    assert index.records == 0
+    assert index.offset == 0
+
+    write_log(log, [line[20:]])
+    index.update()
+    assert index.records == 1
+
+
+def test_offset_for_seeks_to_hour(tmp_path):
+    log = tmp_path / "energy_monitor.log"
+    lines = [energy_line(hour, minute, hour) for hour in range(8, 12) for minute in (0, 30)]
+    write_log(log, lines)
+
+    index = LogIndex(log, ENERGY_RECORD_RE)
+    index.update()
+    offset = index.offset_for("2024-01-15 10:15:00")
+    watts = [float(match.group(2)) for _, match in index.iter_records(offset)]
+    assert watts == [10.0, 10.0, 11.0, 11.0]
+    assert list(index.iter_records(index.offset_for("2024-01-16 00:00:00"))) == []
+
+
+def test_index_is_persisted(tmp_path):
+    log = tmp_path / "energy_monitor.log"
+    write_log(log, [energy_line(10, 0, 1.0)])
+    LogIndex(log, ENERGY_RECORD_RE).update()
+
+    reloaded = LogIndex(log, ENERGY_RECORD_RE)
+    assert reloaded.records == 1
+    assert reloaded.offset == os.path.getsize(log)
+
+
+def test_detects_rotation(tmp_path):
+    log = tmp_path / "energy_monitor.log"
+    write_log(log, [energy_line(10, m, 1.0) for m in range(5)])
+    index = LogIndex(log, ENERGY_RECORD_RE)
+    index.update()
+    assert index.records == 5
+
+    os.rename(log, tmp_path / "energy_monitor.log.1")
+    write_log(log, [energy_line(12, 0, 2.0)], mode='w')
+    index.update()
+    assert index.records == 1
+    assert [float(m.group(2)) for _, m in index.iter_records()] == [2.0]
+
+
+def test_rotated_log_reads_across_gzipped_segments(tmp_path):
+    import gzip
+    from log_index import RotatedLog
+
+    log = tmp_path / "energy_monitor.log"
+    with gzip.open(tmp_path / "energy_monitor.log.20240115-100000.gz", "wt") as f:
+        f.writelines([energy_line(9, 0, 1.0), energy_line(9, 30, 2.0)])
+    write_log(tmp_path / "energy_monitor.log.20240115-110000", [energy_line(10, 0, 3.0)])
+    write_log(log, [energy_line(11, 0, 4.0), energy_line(11, 30, 5.0)])
+
+    rotated = RotatedLog(LogIndex(log, ENERGY_RECORD_RE))
+    rotated.update()
+    assert rotated.records == 5
+
+    records = list(rotated.iter_records())
+    assert [float(m.group(2)) for _, m in records] == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+    # Resuming from a position inside the compressed segment
+    position = records[1][0]
+    assert position[0] == "20240115-100000"
+    assert [float(m.group(2)) for _, m in rotated.iter_records(position)] == [2.0, 3.0, 4.0, 5.0]
+
+    assert rotated.position_for("2024-01-15 10:00:00") == ("20240115-110000", 0)
+    assert rotated.position_for("2024-01-15 11:15:00")[0] is None
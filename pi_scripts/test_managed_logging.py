@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Tests for rotating, compressed, queued log files
+"""
+import gzip
+import logging
+import queue
+
+from managed_logging import ManagedFileHandler, NonBlockingQueueHandler
+
+
+def test_rotates_by_size_compresses_and_prunes(tmp_path):
+    log = tmp_path / "energy_monitor.log"
+    handler = ManagedFileHandler(log, max_bytes=200, backup_count=2, rotate_daily=False)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger = logging.getLogger("test_rotation")
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for i in range(40):
+            logger.warning(f"Time: 2024-01-15 10:00:{i:02d}, Power: {i}.00 W")
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    segments = handler.segments()
+    assert len(segments) == 2
+    assert all(path.endswith(".gz") for path in segments)
+    assert handler.rotations > 2
+    # Newest lines are in the live file, the previous ones in the newest segment
+    assert "Power: 39.00 W" in log.read_text()
+    with gzip.open(segments[-1], "rt") as f:
+        assert "Time: 2024-01-15" in f.read()
+
+
+def test_queue_handler_drops_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=2))
+    record = logging.LogRecord("x", logging.INFO, __file__, 1, "reading %s", (1,), None)
+
+    for _ in range(5):
+        handler.handle(record)
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+    assert handler.queue.get().msg == "reading 1"
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Tests for the Prometheus-style metrics and the sampler/API instrumentation
+"""
+import time
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import metrics
+import pipeline
+from pipeline import Pipeline, Sink
+
+
+def sample_lines(text, name):
+    return [line for line in text.splitlines() if line.startswith(name)]
+
+
+def test_render_counters_gauges_histograms_and_callbacks():
+    registry = metrics.Registry()
+    requests = metrics.Counter("requests", "Requests", ["path"], registry=registry)
+    depth = metrics.Gauge("depth", "Depth", registry=registry)
+    latency = metrics.Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0), registry=registry)
+    metrics.CallbackMetric("hits", "Hits", lambda: [(("a",), 3), (("b",), 1)],
+                           type="counter", labelnames=["cache"], registry=registry)
+
+    requests.labels('/say "hi"').inc()
+    requests.labels('/say "hi"').inc(2)
+    depth.set(7)
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value)
+
+    text = registry.render()
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{path="/say \\"hi\\""} 3' in text
+    assert "depth 7" in text
+    assert sample_lines(text, "latency_seconds") == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_count 4",
+        "latency_seconds_sum 3.65",
+    ]
+    assert sample_lines(text, "hits_total") == ['hits_total{cache="a"} 3', 'hits_total{cache="b"} 1']
+
+    with pytest.raises(ValueError):
+        metrics.Counter("requests", "Again", registry=registry)
+    with pytest.raises(ValueError):
+        requests.inc()  # Labelled metric used without labels
+
+
+def test_sidecar_exporter_serves_registry():
+    registry = metrics.Registry()
+    metrics.Gauge("answer", "The answer", registry=registry).set(42)
+    server = metrics.start_http_server(0, "127.0.0.1", registry=registry)
+    port = server.server_address[1]
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert "answer 42" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        server.shutdown()
+
+
+def test_request_middleware_labels_by_route_template():
+    registry = metrics.Registry()
+    histogram = metrics.Histogram("request_seconds", "Requests", ["method", "route", "status"],
+                                  registry=registry)
+    app = FastAPI()
+    app.add_middleware(metrics.RequestMetricsMiddleware, histogram=histogram)
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"id": item_id}
+
+    client = TestClient(app)
+    for item_id in (1, 2, 3):
+        client.get(f"/items/{item_id}")
+    client.get("/missing")
+
+    text = registry.render()
+    assert 'request_seconds_count{method="GET",route="/items/{item_id}",status="200"} 3' in text
+    assert 'request_seconds_count{method="GET",route="unmatched",status="404"} 1' in text
+
+
+class CollectSink(Sink):
+    name = "collect"
+
+    def handle(self, readings):
+        pass
+
+
+def test_pipeline_metrics():
+    registry = metrics.Registry()
+    samples_before = sum(pipeline.SAMPLE_SECONDS.labels().snapshot()[0])
+    read = lambda: [SimpleNamespace(watts=1.0, appliance_id=1, appliance_name="Main Appliance")]
+    p = Pipeline(read, [CollectSink()], interval=0.02)
+    p.register_metrics(registry)
+    p.start()
+    time.sleep(0.2)
+    assert p.stop()
+
+    text = registry.render()
+    assert 'energy_sink_handled_total{sink="collect"}' in text
+    assert 'energy_sink_queue_depth{sink="collect"} 0' in text
+    samples = int(sample_lines(text, "energy_samples_total")[0].split()[1])
+    assert samples >= 5
+    counts, _ = pipeline.SAMPLE_SECONDS.labels().snapshot()
+    assert sum(counts) - samples_before >= samples
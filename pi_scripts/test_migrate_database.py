@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Tests for the versioned migration runner
+"""
+import sqlite3
+import time
+
+import migrate_database
+from migrate_database import LATEST_VERSION, get_version, run_migrations
+
+
+def legacy_db(path, rows=25):
+    """The original two-column schema with some readings"""
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE usage (timestamp TEXT, watts REAL)")
+    conn.executemany(
+        "INSERT INTO usage VALUES (?, ?)",
+        [(f"2024-01-15 14:{i:02d}:00", float(i)) for i in range(rows)]
+    )
+    conn.commit()
+    return conn
+
+
+def epoch(text):
+    return int(time.mktime(time.strptime(text, '%Y-%m-%d %H:%M:%S')))
+
+
+def test_upgrades_legacy_schema(tmp_path):
+    conn = legacy_db(tmp_path / "energy.db")
+    assert run_migrations(conn, chunk_size=7, pause=0) == LATEST_VERSION
+    assert get_version(conn) == LATEST_VERSION
+
+    rows = conn.execute("SELECT timestamp, ts, appliance_id FROM usage").fetchall()
+    assert len(rows) == 25
+    assert all(ts == epoch(text) and appliance_id == 1 for text, ts, appliance_id in rows)
+    assert conn.execute("SELECT COUNT(*) FROM migration_progress").fetchone()[0] == 0
+
+
+def test_running_twice_is_noop(tmp_path):
+    conn = legacy_db(tmp_path / "energy.db")
+    run_migrations(conn, pause=0)
+    assert run_migrations(conn, pause=0) == LATEST_VERSION
+
+
+def test_slow_migrations_are_only_pending_on_large_databases(tmp_path):
+    conn = legacy_db(tmp_path / "energy.db")
+    assert migrate_database.pending_slow_migrations(conn, row_limit=25) == []
+    assert migrate_database.pending_slow_migrations(conn, row_limit=24) == [3, 4, 6, 8, 11]
+    run_migrations(conn, pause=0)
+    assert migrate_database.pending_slow_migrations(conn, row_limit=0) == []
+
+    new = sqlite3.connect(str(tmp_path / "new.db"))
+    assert migrate_database.pending_slow_migrations(new, row_limit=0) == []
+
+
+def test_backfill_resumes_after_interrupt(tmp_path, monkeypatch):
+    conn = legacy_db(tmp_path / "energy.db")
+    calls = []
+
+    def interrupt(seconds):
+        calls.append(seconds)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(migrate_database.time, "sleep", interrupt)
+    try:
+        run_migrations(conn, chunk_size=10, pause=1)
+    except KeyboardInterrupt:
+        pass
+    assert get_version(conn) == 2
+    assert conn.execute("SELECT COUNT(*) FROM usage WHERE ts IS NULL").fetchone()[0] == 15
+    assert conn.execute("SELECT cursor FROM migration_progress WHERE version = 3").fetchone()[0] == 16
+
+    monkeypatch.setattr(migrate_database.time, "sleep", lambda seconds: None)
+    assert run_migrations(conn, chunk_size=10, pause=1) == LATEST_VERSION
+    assert conn.execute("SELECT COUNT(*) FROM usage WHERE ts IS NULL").fetchone()[0] == 0
+
+
+def test_trigger_fills_ts_for_text_only_inserts(tmp_path):
+    conn = legacy_db(tmp_path / "energy.db", rows=0)
+    run_migrations(conn, pause=0)
+    conn.execute("INSERT INTO usage (timestamp, watts) VALUES ('2024-02-01 08:00:00', 5.0)")
+    assert conn.execute("SELECT ts FROM usage").fetchone()[0] == epoch('2024-02-01 08:00:00')
+
+
+def test_latest_reading_query_uses_index(tmp_path):
+    conn = legacy_db(tmp_path / "energy.db")
+    run_migrations(conn, pause=0)
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT ts, watts FROM usage "
+        "WHERE appliance_id = ? ORDER BY ts DESC LIMIT 1", (1,)
+    ).fetchall()
+    detail = " ".join(row[-1] for row in plan)
+    assert "idx_usage_appliance_ts" in detail
+    assert "TEMP B-TREE" not in detail
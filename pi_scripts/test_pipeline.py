@@ -0,0 +1,146 @@
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from migrate_database import run_migrations
+from pipeline import (NotifierSink, Pipeline, Reading, RingBuffer, Sampler,
+                      Sink, SQLiteSink)
+
+
+def measurement(watts, appliance_id=1):
+    return SimpleNamespace(watts=watts, appliance_id=appliance_id, appliance_name="Main Appliance")
+
+
+class CollectSink(Sink):
+    name = "collect"
+
+    def __init__(self, delay=0.0):
+        self.readings = []
+        self.delay = delay
+
+    def handle(self, readings):
+        time.sleep(self.delay)
+        self.readings.extend(readings)
+
+
+class FailingSink(Sink):
+    name = "failing"
+
+    def handle(self, readings):
+        raise RuntimeError("disk on fire")
+
+
+def test_ring_buffer_drops_oldest():
+    buffer = RingBuffer(3)
+    results = [buffer.put(i) for i in range(5)]
+
+    assert results == [True, True, True, False, False]
+    assert buffer.get_batch(timeout=0) == [2, 3, 4]
+    assert buffer.stats()["dropped"] == 2
+    buffer.close()
+    assert buffer.get_batch(timeout=0) is None
+
+
+def test_sampler_keeps_cadence_when_read_is_slow():
+    published = []
+    sampler = Sampler(lambda: time.sleep(0.03) or [measurement(1.0)], published.append,
+                      interval=0.05)
+    sampler.start()
+    time.sleep(0.52)
+    sampler.stop()
+    sampler.join()
+
+    # Deadlines don't drift by the read time: ~11 samples, not ~7
+    assert 9 <= sampler.samples <= 12
+    assert sampler.overruns == 0
+
+
+def test_sampler_survives_read_errors():
+    calls = []
+
+    def read():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("I2C error")
+        return [measurement(2.0)]
+
+    published = []
+    sampler = Sampler(read, published.append, interval=0.01)
+    sampler.start()
+    time.sleep(0.05)
+    sampler.stop()
+    sampler.join()
+
+    assert sampler.errors == 1
+    assert published and published[0].watts == 2.0
+
+
+def test_slow_and_failing_sinks_do_not_block_others():
+    fast, slow = CollectSink(), CollectSink(delay=0.05)
+    pipeline = Pipeline(lambda: [measurement(5.0)], [fast, slow, FailingSink()], interval=0.005)
+    pipeline.start()
+    time.sleep(0.1)
+    assert pipeline.stop(timeout=5) is True
+
+    stats = pipeline.stats()
+    assert len(fast.readings) == stats["sampler"]["samples"]
+    assert len(slow.readings) == len(fast.readings)  # Drained on shutdown
+    assert stats["sinks"]["failing"]["errors"] > 0
+
+
+def test_sqlite_sink_writes_readings(tmp_path):
+    db_path = tmp_path / "energy.db"
+    conn = sqlite3.connect(db_path)
+    run_migrations(conn)
+    conn.close()
+
+    sink = SQLiteSink(db_path, batch_size=100, flush_interval=60)
+    pipeline = Pipeline(lambda: [measurement(1.5), measurement(3.0, 2)], [sink], interval=0.01)
+    pipeline.start()
+    time.sleep(0.05)
+    assert pipeline.stop()
+
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT appliance_id, watts FROM usage").fetchall()
+    conn.close()
+    assert len(rows) == 2 * pipeline.sampler.samples
+    assert {r[0] for r in rows} == {1, 2}
+
+
+def test_sqlite_sink_keeps_batch_when_database_is_locked(tmp_path):
+    db_path = tmp_path / "energy.db"
+    conn = sqlite3.connect(db_path)
+    run_migrations(conn)
+    conn.close()
+
+    sink = SQLiteSink(db_path, batch_size=2, flush_interval=60)
+    sink.open()
+    sink.conn.execute("PRAGMA busy_timeout = 0")
+    blocker = sqlite3.connect(db_path)
+    blocker.execute("BEGIN IMMEDIATE")
+
+    readings = [Reading("2024-01-01 00:00:00", 1704067200 + i, float(i), 1, "Main Appliance") for i in range(6)]
+    with pytest.raises(sqlite3.OperationalError):
+        sink.handle(readings)
+    assert sink.writer.pending == 6
+
+    blocker.rollback()
+    blocker.close()
+    sink.close()
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT watts FROM usage ORDER BY ts").fetchall() == [(float(i),) for i in range(6)]
+    conn.close()
+
+
+def test_notifier_fires_once_per_crossing():
+    messages = []
+    sink = NotifierSink(1000, notify=messages.append, cooldown=0)
+    readings = [Reading("2024-01-01 00:00:00", ts, w, 1, "Kettle")
+                for ts, w in enumerate([500, 2000, 2100, 400, 1800])]
+
+    sink.handle(readings)
+
+    assert len(messages) == 2
+    assert "Kettle" in messages[0]
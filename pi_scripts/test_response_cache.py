@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Tests for the response cache and the data tokens it is keyed on
+"""
+import gzip
+import sqlite3
+
+from fastapi.responses import Response, StreamingResponse
+
+from db_writer import BufferedWriter, configure_connection
+from latest_cache import LatestReadingCache
+from log_index import LogIndex, RotatedLog, ENERGY_RECORD_RE
+from migrate_database import run_migrations
+from response_cache import ResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def body(size, fill=b"x"):
+    return Response(content=fill * size, media_type="application/json")
+
+
+def test_token_change_and_ttl_drop_entries():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=60, clock=clock)
+    assert cache.get("a", 1) is None
+    assert cache.put("a", 1, Response(content=b"[1]", media_type="application/json",
+                                      headers={"X-Next": "5"}))
+    entry = cache.get("a", 1)
+    assert entry.body == b"[1]" and entry.media_type == "application/json"
+    assert entry.headers == {"x-next": "5"}
+
+    assert cache.get("a", 2) is None  # New data landed
+    assert cache.put("a", 2, body(3), ttl=10)
+    clock.now = 11
+    assert cache.get("a", 2) is None
+    assert (cache.hits, cache.misses, cache.invalidations, cache.expirations) == (1, 3, 1, 1)
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+def test_evicts_least_recently_used_within_bounds():
+    cache = ResponseCache(max_entries=3, max_bytes=800)
+    for key in "abc":
+        cache.put(key, 0, body(50))
+    cache.get("a", 0)
+    cache.put("d", 0, body(50))
+    assert cache.get("b", 0) is None and cache.get("a", 0) is not None
+
+    assert cache.evictions == 1
+
+    cache = ResponseCache(max_entries=100, max_bytes=800)
+    for key in range(9):
+        cache.put(key, 0, body(100))
+    assert len(cache) == 8 and cache.bytes == 800 and cache.get(0, 0) is None
+
+    assert not cache.put("big", 0, body(101))  # Over max_bytes / 8
+    assert not cache.put("stream", 0, StreamingResponse(iter([b"x"])))
+    assert not cache.put("error", 0, Response(content=b"{}", status_code=500))
+    assert cache.stats()["entries"] == len(cache)
+
+
+def test_latest_cache_versions_per_appliance(tmp_path):
+    db = tmp_path / "energy.db"
+    conn = sqlite3.connect(str(db))
+    configure_connection(conn)
+    run_migrations(conn, pause=0)
+    writer = BufferedWriter(conn, batch_size=1)
+    writer.add("2024-01-15 14:30:00", 10.0, 1, "Main Appliance")
+    writer.add("2024-01-15 14:30:00", 50.0, 2, "Fridge")
+
+    cache = LatestReadingCache(db)
+    assert cache.data_version(1) is None
+    cache.refresh()
+    fridge, main = cache.data_version(2), cache.data_version(1)
+
+    writer.add("2024-01-15 14:30:05", 11.0, 1, "Main Appliance")
+    cache.refresh()
+    assert cache.data_version(2) == fridge
+    assert cache.data_version(1) != main
+    main = cache.data_version(1)
+
+    # Deleting old rows (retention, archiving) changes every token
+    with conn:
+        conn.execute("DELETE FROM usage WHERE rowid = (SELECT MIN(rowid) FROM usage)")
+    cache.refresh()
+    assert cache.data_version(2) != fridge and cache.data_version(1) != main
+
+
+def test_rotated_log_version_follows_appends_and_rotation(tmp_path):
+    log_path = tmp_path / "energy_monitor.log"
+    log_path.write_text("Time: 2024-12-04 10:30:45, Power: 125.50 W\n")
+    log = RotatedLog(LogIndex(log_path, ENERGY_RECORD_RE))
+    log.update()
+    version = log.version()
+    log.update()
+    assert log.version() == version
+
+    with open(log_path, "a") as f:
+        f.write("Time: 2024-12-04 10:30:50, Power: 126.00 W\n")
+    log.update()
+    assert log.version() != version
+    version = log.version()
+
+    with gzip.open(tmp_path / "energy_monitor.log.20241204-000000.gz", "wt") as f:
+        f.write("Time: 2024-12-03 10:30:50, Power: 1.00 W\n")
+    log.update()
+    assert log.version() != version
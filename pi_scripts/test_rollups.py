@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Tests for the minute/hour/day rollups
+"""
+import sqlite3
+
+import pytest
+
+import rollups
+from db_writer import BufferedWriter
+from migrate_database import run_migrations
+from rollups import RollupMaintainer
+
+BASE_TS = 1705329000  # On a minute boundary
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "energy.db"))
+    run_migrations(conn, pause=0)
+    yield conn
+    conn.close()
+
+
+def write(conn, readings, batch_size=4):
+    writer = BufferedWriter(conn, batch_size=batch_size, hooks=[RollupMaintainer()])
+    for offset, watts, appliance_id in readings:
+        ts = BASE_TS + offset
+        writer.add(f"reading {ts}", watts, appliance_id, ts=ts)
+    writer.close()
+
+
+def rollup_rows(conn, resolution):
+    return conn.execute(
+        f"SELECT appliance_id, bucket, count, sum_watts, min_watts, max_watts, wh "
+        f"FROM rollup_{resolution} ORDER BY appliance_id, bucket"
+    ).fetchall()
+
+
+def test_aggregates_per_bucket(conn):
+    write(conn, [(0, 100.0, 1), (30, 200.0, 1), (60, 300.0, 1), (0, 50.0, 2)])
+
+    minutes = rollup_rows(conn, "minute")
+    assert minutes[0][:6] == (1, BASE_TS, 2, 300.0, 100.0, 200.0)
+    assert minutes[1][:6] == (1, BASE_TS + 60, 1, 300.0, 300.0, 300.0)
+    assert minutes[2][:3] == (2, BASE_TS, 1)
+
+    hours = rollup_rows(conn, "hour")
+    assert [(row[0], row[2]) for row in hours] == [(1, 3), (2, 1)]
+
+
+def test_energy_is_trapezoidal_across_batches(conn):
+    # 100 W -> 200 W over 36 s, then 200 W -> 200 W over 36 s, split over two flushes
+    write(conn, [(0, 100.0, 1), (36, 200.0, 1), (72, 200.0, 1)], batch_size=2)
+    total_wh = sum(row[6] for row in rollup_rows(conn, "minute"))
+    assert total_wh == pytest.approx(1.5 + 2.0)
+
+
+def test_gaps_are_not_integrated(conn):
+    write(conn, [(0, 100.0, 1), (rollups.MAX_GAP + 1, 100.0, 1)])
+    assert sum(row[6] for row in rollup_rows(conn, "day")) == 0
+
+
+def test_rebuild_matches_incremental(conn, tmp_path):
+    readings = [(i * 7, float(i % 13) * 10, 1 + i % 2) for i in range(500)]
+    write(conn, readings, batch_size=9)
+    incremental = {res: rollup_rows(conn, res) for res in rollups.RESOLUTIONS}
+
+    rollups.rebuild(tmp_path / "energy.db", chunk_size=37, pause=0)
+    for resolution, rows in incremental.items():
+        rebuilt = rollup_rows(conn, resolution)
+        assert [row[:6] for row in rebuilt] == [row[:6] for row in rows]
+        assert [row[6] for row in rebuilt] == pytest.approx([row[6] for row in rows])
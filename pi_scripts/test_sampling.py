@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Tests for the multi-channel sampling engine and its RMS power maths
+"""
+import math
+
+import pytest
+
+from sampling import AUTO_INCREMENT, Channel, FakeBus, SamplingEngine, sine, POWER_SCALE
+
+
+def test_single_channel_true_rms():
+    bus = FakeBus({0: sine(1.0)})
+    engine = SamplingEngine(bus, [Channel(1, 0, calibration=10.0)], clock=bus.clock)
+
+    (m,) = engine.read()
+
+    # 1 V peak at the ADC -> 0.707 V RMS -> 7.07 A
+    assert m.appliance_id == 1
+    assert m.irms == pytest.approx(10 / math.sqrt(2), rel=0.02)
+    assert m.crest_factor == pytest.approx(math.sqrt(2), rel=0.05)
+    assert m.watts == pytest.approx(m.irms * 230 * POWER_SCALE)
+    assert m.sample_rate > 5000
+
+
+def test_multi_channel_uses_auto_increment_and_separates_appliances():
+    bus = FakeBus({0: sine(1.0), 2: sine(0.25)})
+    calls = []
+    read = bus.read_i2c_block_data
+    bus.read_i2c_block_data = lambda addr, control, n: calls.append(control) or read(addr, control, n)
+    engine = SamplingEngine(bus, [Channel(1, 0, calibration=1.0), Channel(7, 2, calibration=1.0)],
+                            clock=bus.clock)
+
+    first, second = engine.read()
+
+    assert set(calls) == {AUTO_INCREMENT}
+    assert (first.appliance_id, second.appliance_id) == (1, 7)
+    assert first.irms == pytest.approx(1 / math.sqrt(2), rel=0.03)
+    assert second.irms == pytest.approx(0.25 / math.sqrt(2), rel=0.05)
+
+
+def test_peaky_load_differs_from_peak_estimate():
+    # Peaky third harmonic: peak/sqrt(2) would overstate the RMS
+    bus = FakeBus({0: sine(0.5, harmonics=[(3, -0.6)])})
+    engine = SamplingEngine(bus, [Channel(1, 0, calibration=1.0)], clock=bus.clock)
+
+    (m,) = engine.read()
+
+    expected_rms = 0.5 * math.sqrt((1 + 0.6 ** 2) / 2)
+    assert m.irms == pytest.approx(expected_rms, rel=0.03)
+    assert m.crest_factor == pytest.approx(1.6 / math.sqrt(1.36 / 2), rel=0.05)
+    assert m.irms < 0.5 * 1.6 / math.sqrt(2) * 0.9
+
+
+def test_real_power_with_voltage_channel():
+    phase = math.pi / 3  # Current lags voltage by 60 degrees -> PF 0.5
+    bus = FakeBus({0: sine(1.0, phase=-phase), 3: sine(1.0)})
+    engine = SamplingEngine(bus, [Channel(1, 0, calibration=1.0)], voltage_channel=3,
+                            voltage_calibration=100.0, clock=bus.clock)
+
+    (m,) = engine.read()
+
+    assert m.vrms == pytest.approx(100 / math.sqrt(2), rel=0.03)
+    assert m.power_factor == pytest.approx(0.5, abs=0.05)
+
+
+def test_rejects_invalid_channel():
+    with pytest.raises(ValueError):
+        Channel(1, 4)